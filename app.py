@@ -2,9 +2,11 @@
 ConstellaChat - 星座検索アプリ
 """
 import streamlit as st
+import streamlit.components.v1 as components
 import json
 import os
-from datetime import datetime
+import uuid
+from datetime import datetime, timezone
 from dotenv import load_dotenv
 
 # .envファイルを読み込み
@@ -14,9 +16,26 @@ load_dotenv()
 import sys
 sys.path.append(os.path.dirname(__file__))
 
-from src.query_expander import QueryExpander, StoryGenerator
 from src.searcher import ConstellationSearcher
-from config import CONSTELLATION_DATA_PATH, INDEX_DIR, DEFAULT_LLM, DEFAULT_TOP_K
+from src.constellation_bm25_vec_rrf_search import get_index_version, get_versioned_index
+from src.openai_client import get_openai_client
+from src.llm_usage import create_chat_completion, get_usage_tracker
+from src.story_prefetch import StoryPrefetcher
+from src.star_catalogue import get_star_catalogue
+from src.deep_sky import get_deep_sky_catalogue
+from src.profiling import profile_request, is_profiling_enabled, top_hot_functions, format_hot_functions
+from src.query_log import trace_request, get_query_log
+from src.singleflight import coalesce, get_singleflight_stats
+from src.llm_scheduler import use_priority, get_scheduler_stats
+from src.query_planner import plan_query, get_planner_stats
+from src.index_registry import get_registry, get_router
+from src.typeahead import get_typeahead
+from src.warmup import start_background_warmup, get_warmup_status, format_status
+from config import (CONSTELLATION_DATA_PATH, INDEX_DIR, DEFAULT_LLM, DEFAULT_TOP_K, STORY_PREFETCH_TOP_N,
+                    DEFAULT_OBSERVER_LAT, DEFAULT_OBSERVER_LON, STAR_CATALOGUE_PATH, STAR_CARD_COUNT,
+                    DEEP_SKY_CATALOGUE_PATH, DEEP_SKY_CARD_COUNT, DEEP_SKY_RESULT_COUNT,
+                    QUICK_SEARCH_PRESETS, WARMUP_ON_START,
+                    TYPEAHEAD_DEBOUNCE_MS, TYPEAHEAD_COMPONENT_DIR, TYPEAHEAD_JUMP_CARDS, DEFAULT_CORPORA)
 
 # ページ設定
 st.set_page_config(
@@ -254,6 +273,12 @@ st.markdown("""
         color: #ffffff !important;
     }
     
+    .bright-stars {
+        margin-top: 0.8rem;
+        font-size: 0.85rem;
+        color: #ffffff !important;
+    }
+    
     .score-badge {
         background: rgba(200, 180, 255, 0.3);
         border: 1px solid rgba(200, 180, 255, 0.4);
@@ -418,20 +443,45 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 
+@st.cache_resource
+def get_story_prefetcher() -> StoryPrefetcher:
+    """全セッションで共有するストーリー先読み器"""
+    return StoryPrefetcher(model=DEFAULT_LLM, version_fn=get_data_version)
+
+
+@st.cache_resource
+def get_searcher() -> ConstellationSearcher:
+    """全セッションで共有する検索器（星座カタログは読み取り専用で 1 つだけ持つ）"""
+    return ConstellationSearcher(CONSTELLATION_DATA_PATH, INDEX_DIR)
+
+
+def get_constellation_catalogue():
+    """全セッションで共有する id -> 星座情報 の読み取り専用マッピング"""
+    return get_searcher().constellations_by_id
+
+
+def get_data_version() -> str:
+    """星座データの更新時刻とインデックスの版から作るバージョン文字列（カードHTMLのキャッシュキー）"""
+    paths = [CONSTELLATION_DATA_PATH, STAR_CATALOGUE_PATH, DEEP_SKY_CATALOGUE_PATH]
+    return "-".join([get_index_version()] + [str(p.stat().st_mtime_ns) for p in paths if p.exists()])
+
+
 def init_session_state():
     """セッション状態の初期化"""
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
     if "search_results" not in st.session_state:
         st.session_state.search_results = []
     if "expanded_query" not in st.session_state:
         st.session_state.expanded_query = None
-    if "expanded_stories" not in st.session_state:
-        st.session_state.expanded_stories = {}
-    if "searcher" not in st.session_state:
-        # searcher を初期化してセッションに保存（関連星座の参照用）
-        try:
-            st.session_state.searcher = ConstellationSearcher(CONSTELLATION_DATA_PATH, INDEX_DIR)
-        except Exception as e:
-            st.session_state.searcher = None
+    if "expanded_story_ids" not in st.session_state:
+        # ストーリー本文は共有の先読みキャッシュにあるので、セッションには開いている id だけ持つ
+        st.session_state.expanded_story_ids = set()
+    if "deep_sky_results" not in st.session_state:
+        st.session_state.deep_sky_results = []
+    if "jump_ids" not in st.session_state:
+        # 入力中の候補から選んだ星座（検索せずにカードを出す）
+        st.session_state.jump_ids = []
 
 
 def get_month_names(months: list) -> str:
@@ -447,7 +497,8 @@ def get_month_names(months: list) -> str:
 
 
 @st.cache_data(ttl=3600)  # 1時間キャッシュ
-def get_related_constellations(constellation_id: str, myth_summary: str, top_k: int = 5, use_query_expansion: bool = False):
+def get_related_constellations(constellation_id: str, myth_summary: str, top_k: int = 5, use_query_expansion: bool = False,
+                               index_version: str = None):
     """
     myth_summaryから関連星座を検索（キャッシュ付き）
     
@@ -456,6 +507,7 @@ def get_related_constellations(constellation_id: str, myth_summary: str, top_k:
         myth_summary: 検索クエリとして使う神話の要約
         top_k: 返す関連星座の数
         use_query_expansion: クエリ拡張を使うかどうか（デフォルト: False）
+        index_version: インデックスの版（キャッシュキー用。新しい版が公開されたら引き直す）
     
     Returns:
         関連星座の情報のリスト [{"jp_name": "...", "id": "...", "myth_summary": "..."}, ...]
@@ -493,22 +545,22 @@ def get_related_constellations(constellation_id: str, myth_summary: str, top_k:
                 pass
         
         # 関連星座を検索（自分自身を除外するため多めに取得）
-        related_results = hybrid_search_constellations(
-            query=query,
-            k_bm25=10,
-            k_vec=10,
-            topk=top_k + 1  # 自分を除くため+1
-        )
+        # カードの飾りなので、ベクトル検索は利用者の検索より後回しにする
+        with use_priority("decorative"):
+            related_results = hybrid_search_constellations(
+                query=query,
+                k_bm25=10,
+                k_vec=10,
+                topk=top_k + 1  # 自分を除くため+1
+            )
         
         # 自分自身を除外して上位top_k件を取得
         related_list = []
         for result in related_results:
             if result['id'] != constellation_id and len(related_list) < top_k:
-                # searcher から完全なmyth_summaryを取得
-                full_myth = ""
-                if st.session_state.searcher:
-                    full_info = st.session_state.searcher.constellations_by_id.get(result['id'], {})
-                    full_myth = full_info.get('myth_summary', '')
+                # 共有カタログから完全なmyth_summaryを取得
+                full_info = get_constellation_catalogue().get(result['id'], {})
+                full_myth = full_info.get('myth_summary', '')
                 
                 related_list.append({
                     'jp_name': result['jp_name'],
@@ -537,106 +589,227 @@ def format_myth_for_related(myth_summary: str, constellation_name: str) -> str:
         return ""
     
     try:
-        from openai import OpenAI
-        client = OpenAI()
-        
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {
-                    "role": "system",
-                    "content": "あなたは星座の神話を読みやすく整形する専門家です。与えられた神話を2-3文（50-80文字程度）の読みやすい形に整形してください。重要なポイントを残しつつ、自然な日本語にしてください。"
-                },
-                {
-                    "role": "user",
-                    "content": f"星座名: {constellation_name}\n神話: {myth_summary}\n\n整形:"
-                }
-            ],
-            max_tokens=150,
-            temperature=0.5
-        )
-        
-        formatted_text = response.choices[0].message.content.strip()
-        # 余分な記号を削除
-        formatted_text = formatted_text.replace('"', '').replace('「', '').replace('」', '').strip()
-        return formatted_text
+        # 別セッションが同じ星座を整形中なら、その結果を待って使う
+        return coalesce("related_format", (constellation_name, myth_summary),
+                        _format_myth_with_llm, myth_summary, constellation_name)
     except Exception as e:
         # エラー時は最初の80文字を返す
         return myth_summary[:80] + "..." if len(myth_summary) > 80 else myth_summary
 
 
-def render_constellation_card(constellation: dict, score: float = None, index: int = 0):
-    """星座カードをレンダリング（ストーリー展開機能 + 関連星座表示付き）"""
-    card_id = constellation['id']
+def _format_myth_with_llm(myth_summary: str, constellation_name: str) -> str:
+    """format_myth_for_related の LLM 呼び出し部分（相乗りの単位）"""
+    client = get_openai_client()
+    
+    response = create_chat_completion(
+        client,
+        "related_format",
+        model="gpt-4o-mini",
+        messages=[
+            {
+                "role": "system",
+                "content": "あなたは星座の神話を読みやすく整形する専門家です。与えられた神話を2-3文（50-80文字程度）の読みやすい形に整形してください。重要なポイントを残しつつ、自然な日本語にしてください。"
+            },
+            {
+                "role": "user",
+                "content": f"星座名: {constellation_name}\n神話: {myth_summary}\n\n整形:"
+            }
+        ],
+        max_tokens=150,
+        temperature=0.5
+    )
+    
+    formatted_text = response.choices[0].message.content.strip()
+    # 余分な記号を削除
+    formatted_text = formatted_text.replace('"', '').replace('「', '').replace('」', '').strip()
+    return formatted_text
+
+
+@st.cache_data(ttl=3600)  # 1時間キャッシュ
+def build_card_html(constellation_id: str, data_version: str, _constellation: dict,
+                    with_related: bool = True) -> str:
+    """
+    星座カード本体（関連星座セクション込み）のHTMLを作る
     
-    # カード本体
-    with st.container():
-        st.markdown(f"""
-        <div class="constellation-card">
-            <div class="constellation-name">
-                ⭐ {constellation['jp_name']}
-            </div>
-            <div class="constellation-english">{constellation['id']}</div>
-            <div class="myth-text">{constellation.get('myth_summary', '神話情報なし')}</div>
-            <div class="best-months">🌙 見頃: {get_month_names(constellation.get('best_months', []))}</div>
-        """, unsafe_allow_html=True)
+    (constellation_id, data_version, with_related) ごとにキャッシュするので、
+    ストーリーの開閉などで再実行されても関連星座の検索や整形は走らない。
+    _constellation はキャッシュキーに含めない（アンダースコア始まり）。
+    with_related=False なら関連星座セクションを作らない（検索も LLM の整形もしない軽いカード）。
+    """
+    constellation = _constellation
+    card_id = constellation_id
+    
+    # 関連星座セクション（myth_summaryから動的に検索）
+    related_html = ""
+    myth_summary = constellation.get('myth_summary', '')
+    if myth_summary and with_related:
+        related_list = get_related_constellations(card_id, myth_summary, top_k=5,
+                                                  index_version=get_index_version())
         
-        # 関連星座セクション（myth_summaryから動的に検索、キャッシュ付き）
-        myth_summary = constellation.get('myth_summary', '')
-        if myth_summary:
-            related_list = get_related_constellations(card_id, myth_summary, top_k=5)
-            
-            if related_list:
-                related_items_html = []
-                for rel in related_list:
-                    # 神話本文をLLMで整形（2-3文、読みやすく）
-                    formatted_myth = format_myth_for_related(rel['myth_summary'], rel['jp_name'])
-                    
-                    # HTMLエスケープを防ぐため、シンプルな構造に
-                    item_html = f'<span class="related-item"><span class="related-name">🔗 {rel["jp_name"]}</span><span class="related-desc">{formatted_myth}</span></span>'
-                    related_items_html.append(item_html)
+        if related_list:
+            related_items_html = []
+            for rel in related_list:
+                # 神話本文をLLMで整形（2-3文、読みやすく）
+                formatted_myth = format_myth_for_related(rel['myth_summary'], rel['jp_name'])
                 
-                related_html = ''.join(related_items_html)
-                st.markdown(f"""
-                <div class="related-constellations">
-                    <div class="related-title">✨ 関連する星座</div>
-                    {related_html}
-                </div>
-                """, unsafe_allow_html=True)
-        
-        st.markdown("</div>", unsafe_allow_html=True)
+                # HTMLエスケープを防ぐため、シンプルな構造に
+                item_html = f'<span class="related-item"><span class="related-name">🔗 {rel["jp_name"]}</span><span class="related-desc">{formatted_myth}</span></span>'
+                related_items_html.append(item_html)
+            
+            related_html = f"""
+            <div class="related-constellations">
+                <div class="related-title">✨ 関連する星座</div>
+                {''.join(related_items_html)}
+            </div>
+            """
+    
+    # 主な星（輝星カタログから明るい順に）
+    stars_html = ""
+    stars = get_star_catalogue()
+    if stars is not None:
+        bright = stars.constellation_stars(card_id, limit=STAR_CARD_COUNT)
+        if bright:
+            names = "、".join(f"{s['jp_name']}（{s['vmag']:.1f}等）" for s in bright)
+            stars_html = f'<div class="bright-stars">✨ 主な星: {names}</div>'
+    
+    # 見どころの天体（星雲・星団・銀河を明るい順に）
+    deep_sky = get_deep_sky_catalogue()
+    if deep_sky is not None:
+        objects = deep_sky.objects_in_constellation(card_id, limit=DEEP_SKY_CARD_COUNT)
+        if objects:
+            names = "、".join(f"{o['display_name']}（{o['type_jp']}・{o['vmag']:.1f}等）" for o in objects)
+            stars_html += f'<div class="bright-stars">🔭 見どころの天体: {names}</div>'
+    
+    return f"""
+    <div class="constellation-card">
+        <div class="constellation-name">
+            ⭐ {constellation['jp_name']}
+        </div>
+        <div class="constellation-english">{card_id}</div>
+        <div class="myth-text">{constellation.get('myth_summary', '神話情報なし')}</div>
+        <div class="best-months">🌙 見頃: {get_month_names(constellation.get('best_months', []))}</div>
+        {stars_html}
+        {related_html}
+    </div>
+    """
+
+
+@st.cache_resource
+def start_warmup() -> bool:
+    """
+    WARMUP_ON_START なら、プロセスで 1 回だけ人気のクエリでキャッシュを温め始める（裏で動く）
+
+    warm_card は ScriptRunContext の無いスレッドから build_card_html を呼ぶが、st.cache_data の
+    保存先はセッションではなくプロセス（Runtime）に 1 つなので、温めたカードは全セッションで当たる。
+    """
+    if WARMUP_ON_START:
+        start_background_warmup(
+            get_searcher(), get_story_prefetcher(),
+            warm_card=lambda c: build_card_html(c["id"], get_data_version(), c, with_related=True),
+        )
+    return WARMUP_ON_START
+
+
+def find_deep_sky_objects(query: str) -> list:
+    """
+    クエリが星雲・星団・銀河の種類や天体の名前に触れていれば、カタログから条件に合う天体を返す
+    （LLM を使わないので、クエリ拡張が失敗しても出せる）
+    """
+    catalogue = get_deep_sky_catalogue()
+    if catalogue is None:
+        return []
+    _, filters = catalogue.parse_query(query)
+    if "types" not in filters and not catalogue.mentioned(query):
+        return []
+    results, _ = catalogue.query(query, top_k=DEEP_SKY_RESULT_COUNT)
+    return results
+
+
+def toggle_story(constellation: dict):
+    """ストーリーボタンのコールバック（開閉を切り替える）"""
+    card_id = constellation['id']
+    if card_id in st.session_state.expanded_story_ids:
+        # 閉じる
+        st.session_state.expanded_story_ids.discard(card_id)
+    else:
+        # 開く（先読み済みならキャッシュから、なければその場で生成して共有キャッシュに入れる）
+        # 先読みのヒットや API 呼び出しは、検索とは別のストーリーの記録としてログに残す
+        error = None
+        with trace_request() as trace:
+            try:
+                with trace.stage("story"):
+                    get_story_prefetcher().get_story(constellation)
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+        query_log = get_query_log()
+        if query_log is not None:
+            query_log.log_story(trace, card_id, session_id=st.session_state.session_id, error=error)
+        st.session_state.expanded_story_ids.add(card_id)
+
+
+@st.fragment
+def render_constellation_card(constellation: dict, score: float = None, index: int = 0,
+                              with_related: bool = True):
+    """
+    星座カードをレンダリング（ストーリー展開機能 + 関連星座表示付き）
+    
+    フラグメントなので、ストーリーボタンを押してもこのカードだけが再実行される。
+    with_related=False なら関連星座のない軽いカードにする（入力中の候補から出すカード）。
+    """
+    card_id = constellation['id']
+    
+    with st.container():
+        # カード本体（キャッシュ済みHTML）
+        # （キャッシュキーは渡した引数だけで作られるので、with_related は既定値でも必ず渡す）
+        st.markdown(build_card_html(card_id, get_data_version(), constellation, with_related=with_related),
+                    unsafe_allow_html=True)
         
         # ストーリーボタン
         if constellation.get('myth_summary'):
-            button_label = "✨ ストーリーを閉じる" if card_id in st.session_state.expanded_stories else f"✨ {constellation['jp_name']}のストーリーをもっと聞く"
+            button_label = "✨ ストーリーを閉じる" if card_id in st.session_state.expanded_story_ids else f"✨ {constellation['jp_name']}のストーリーをもっと聞く"
             
-            if st.button(button_label, key=f"story_{card_id}_{index}"):
-                if card_id in st.session_state.expanded_stories:
-                    # 閉じる
-                    del st.session_state.expanded_stories[card_id]
-                else:
-                    # 開く（ストーリー生成）
-                    try:
-                        generator = StoryGenerator(model=DEFAULT_LLM)
-                        story = generator.generate(constellation)
-                        st.session_state.expanded_stories[card_id] = story
-                    except Exception as e:
-                        st.session_state.expanded_stories[card_id] = constellation.get('myth_summary', '神話情報がありません')
-                st.rerun()
+            # 状態の切り替えはコールバックで行うので、st.rerun() なしでラベルも更新される
+            st.button(button_label, key=f"story_{card_id}_{index}",
+                      on_click=toggle_story, args=(constellation,))
             
             # ストーリーが展開されていたらボタンの下に表示
-            if card_id in st.session_state.expanded_stories:
+            if card_id in st.session_state.expanded_story_ids:
+                # 生成に失敗していたら元の神話を表示
+                story = get_story_prefetcher().peek(card_id) or constellation.get('myth_summary', '神話情報がありません')
                 st.markdown(f"""
                 <div class="story-box">
                     <div class="story-title">📖 {constellation['jp_name']}の物語</div>
-                    <div class="story-content">{st.session_state.expanded_stories[card_id]}</div>
+                    <div class="story-content">{story}</div>
                 </div>
                 """, unsafe_allow_html=True)
 
 
+# 入力中の候補用の入力欄（最後のキー入力から TYPEAHEAD_DEBOUNCE_MS 経ってから値を送ってくる）
+_typeahead_input = components.declare_component("typeahead_input", path=str(TYPEAHEAD_COMPONENT_DIR))
+
+
+@st.fragment
+def render_typeahead():
+    """
+    名前の一部から星座カードへ直接移動する（LLM もベクトル検索も使わない）。
+    フラグメントなので、入力のたびに再実行されるのはこの部分だけ。
+    """
+    prefix = _typeahead_input(placeholder="⚡ 名前で探す（例: おりおん、カペラ、cyg）",
+                              debounce_ms=TYPEAHEAD_DEBOUNCE_MS, key="typeahead", default="")
+    suggestions = get_typeahead().suggest(prefix or "")
+    if not suggestions:
+        return
+    cols = st.columns(4)
+    for i, s in enumerate(suggestions):
+        if cols[i % 4].button(s["label"], key=f"typeahead_{i}_{s['label']}", use_container_width=True):
+            st.session_state.jump_ids = s["ids"]
+            st.rerun()
+
+
 def main():
     """メイン関数"""
     init_session_state()
+    start_warmup()
     
     # ヘッダー
     st.markdown('<h1 class="main-title">🌟 ConstellaChat 🌟</h1>', unsafe_allow_html=True)
@@ -667,16 +840,42 @@ def main():
         # 検索設定
         top_k = st.slider("表示する星座の数", 1, 10, DEFAULT_TOP_K)
         
+        # 検索するコーパス（config.CORPORA に登録したもの。1 つだけなら選ばせない）
+        corpus_labels = get_registry().labels()
+        corpora = DEFAULT_CORPORA
+        if len(corpus_labels) > 1:
+            corpora = st.multiselect("検索するコーパス", list(corpus_labels), default=DEFAULT_CORPORA,
+                                     format_func=lambda name: corpus_labels[name]) or DEFAULT_CORPORA
+        
         # 現在の月を表示
         current_month = datetime.now().month
         st.info(f"📅 今月: {current_month}月")
         
+        # 観測地（今夜見える星座を優先する）
+        use_visibility = st.checkbox("🔭 今夜見える星座を優先", value=False)
+        observer = None
+        if use_visibility:
+            lat = st.number_input("緯度", -90.0, 90.0, DEFAULT_OBSERVER_LAT, step=0.5)
+            lon = st.number_input("経度", -180.0, 180.0, DEFAULT_OBSERVER_LON, step=0.5)
+            only_visible = st.checkbox("見えない星座は表示しない", value=False)
+            observer = {"lat": lat, "lon": lon, "datetime": datetime.now(timezone.utc)}
+        
         # クイック検索
         st.subheader("🚀 クイック検索")
         quick_search = st.selectbox(
             "季節で探す",
-            ["選択してください", "春の星座", "夏の星座", "秋の星座", "冬の星座"]
+            ["選択してください", *QUICK_SEARCH_PRESETS]
         )
+        
+        # キャッシュ温めの状況
+        warmup_status = get_warmup_status()
+        if warmup_status["state"] != "cold":
+            st.caption(f"🔥 {format_status(warmup_status)}")
+        
+        # クエリログが書けなくなっていたら知らせる（検索は止めない）
+        query_log = get_query_log()
+        if query_log is not None and query_log.error:
+            st.warning(f"⚠️ クエリログを書き込めません（{query_log.dropped}件を破棄）: {query_log.error}")
     
     # メイン検索エリア
     col1, col2 = st.columns([3, 1])
@@ -691,57 +890,116 @@ def main():
     with col2:
         search_button = st.button("検索 🔭", type="primary", use_container_width=True)
     
+    render_typeahead()
+    
     # クイック検索の処理
     if quick_search != "選択してください":
-        season_map = {
-            "春の星座": "春の暖かい日",
-            "夏の星座": "夏の暑い日",
-            "秋の星座": "秋の涼しい日",
-            "冬の星座": "冬の寒い日"
-        }
-        query = season_map.get(quick_search, "")
+        query = QUICK_SEARCH_PRESETS.get(quick_search, "")
         search_button = True
     
     # 検索処理
     if search_button and query:
-        with st.spinner("星座を探しています... ✨"):
+        with st.spinner("星座を探しています... ✨"), profile_request("search"), trace_request() as trace:
+            expanded, results, error = None, [], None
+            # 時間予算からクエリ拡張・ベクトル検索をするか決める（決定はログに残す）
+            plan = plan_query(query)
+            visibility_mode = "filter" if observer and only_visible else "boost"
+            st.session_state.deep_sky_results = find_deep_sky_objects(query)
+            st.session_state.jump_ids = []
             try:
-                # コンポーネント初期化
-                expander = QueryExpander(model=DEFAULT_LLM)
-                searcher = ConstellationSearcher(CONSTELLATION_DATA_PATH, INDEX_DIR)
-                
-                # searcher をセッション状態に保存
-                st.session_state.searcher = searcher
-                
-                # クエリ拡張
-                expanded = expander.expand(query)
+                # 星座名の短絡 -> クエリ拡張 -> 検索（query_replay と同じ入口）
+                expanded, results = get_searcher().search_query(
+                    query, top_k=top_k, observer=observer, visibility_mode=visibility_mode,
+                    plan=plan, corpora=corpora, trace=trace,
+                )
                 st.session_state.expanded_query = expanded
-                
-                # 検索実行
-                results = searcher.search(expanded, top_k=top_k)
                 st.session_state.search_results = results
                 
                 # 展開されたストーリーをリセット
-                st.session_state.expanded_stories = {}
+                st.session_state.expanded_story_ids = set()
+                
+                # 上位N件のストーリーをバックグラウンドで先読み（前回の先読みは置き換え）
+                get_story_prefetcher().prefetch(
+                    st.session_state.session_id,
+                    [c for c, _ in results[:STORY_PREFETCH_TOP_N]],
+                )
                 
             except Exception as e:
+                error = f"{type(e).__name__}: {e}"
                 st.error(f"エラーが発生しました: {e}")
                 st.info("💡 OpenAI API Keyが設定されているか確認してください")
+            
+            # 構造化ログ（失敗した検索も残す。書き込みはバックグラウンド）
+            query_log = get_query_log()
+            if query_log is not None:
+                query_log.log_search(trace, query, expanded, results,
+                                     session_id=st.session_state.session_id,
+                                     top_k=top_k, visibility_mode=visibility_mode, error=error, corpora=corpora,
+                                     plan=plan.to_dict() if plan else None,
+                                     observer={"lat": round(observer["lat"], 1),
+                                               "lon": round(observer["lon"], 1)} if observer else None)
+    
+    # 入力中の候補から選んだ星座（関連星座なしの軽いカードを TYPEAHEAD_JUMP_CARDS 件まで）
+    if st.session_state.jump_ids:
+        st.markdown("---")
+        st.subheader("📍 名前から見つけた星座")
+        catalogue = get_constellation_catalogue()
+        jump_ids = [cid for cid in st.session_state.jump_ids if cid in catalogue]
+        for idx, cid in enumerate(jump_ids[:TYPEAHEAD_JUMP_CARDS]):
+            render_constellation_card(catalogue[cid], index=1000 + idx, with_related=False)
+        if len(jump_ids) > TYPEAHEAD_JUMP_CARDS:
+            names = "、".join(catalogue[cid]["jp_name"] for cid in jump_ids[TYPEAHEAD_JUMP_CARDS:])
+            st.caption(f"ほかに {len(jump_ids) - TYPEAHEAD_JUMP_CARDS} 星座: {names}")
     
     # 検索結果の表示
     if st.session_state.search_results:
         st.markdown("---")
         
+        # 表記ゆれ・打ち間違いから星座名を引き当てたときは、どの名前として探したかを出す
+        name_match = (st.session_state.expanded_query or {}).get("name_match")
+        if name_match and name_match["distance"] > 0:
+            st.caption(f"🔤 「{name_match['surface']}」として探しました（確信度 {name_match['confidence']:.0%}）")
+        
         # クエリ拡張結果の表示（デバッグ用）
         with st.expander("🔧 クエリ拡張結果を見る"):
             st.json(st.session_state.expanded_query)
         
+        with st.expander("📊 API利用量（トークン数・レイテンシ）"):
+            st.json(get_usage_tracker().summary())
+            st.caption("同時に同じ呼び出しがあって相乗りした回数")
+            st.json(get_singleflight_stats())
+            st.caption("優先度クラスごとの待ち行列（待ち時間はミリ秒）")
+            st.json(get_scheduler_stats())
+            st.caption("クエリプランナーの決定（段階:行動:理由）と段階ごとの見積もり")
+            st.json(get_planner_stats())
+            st.caption("検索に使っているインデックスの版と差し替えの回数")
+            st.json(get_versioned_index().stats())
+            st.caption("コーパスごとの検索（ルーター経由の回数・レイテンシ・読み込んだ版）")
+            st.json(get_router().stats())
+            query_log = get_query_log()
+            if query_log is not None:
+                st.caption("クエリログの書き込み")
+                st.json(query_log.stats())
+        
+        if is_profiling_enabled():
+            with st.expander("🔥 プロファイル（全検索で重い関数）"):
+                st.code(format_hot_functions(top_hot_functions(15)))
+        
         st.subheader(f"🌌 見つかった星座 ({len(st.session_state.search_results)}件)")
         
         # 結果をカード形式で表示
         for idx, (constellation, score) in enumerate(st.session_state.search_results):
             render_constellation_card(constellation, score, index=idx)
     
+    # 星雲・星団・銀河（クエリが触れていたときだけ）
+    if st.session_state.deep_sky_results:
+        st.subheader("🔭 条件に合う星雲・星団・銀河")
+        for obj in st.session_state.deep_sky_results:
+            st.markdown(
+                f"- **{obj['display_name']}** {obj['type_jp']}・{obj['vmag']:.1f}等"
+                f"（{obj['constellation']['jp_name']}、見頃: {get_month_names(obj['best_months'])}）"
+            )
+    
     # フッター
     st.markdown("---")
     st.markdown("""
@@ -16,14 +16,138 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY") or os.getenv("OPENAI_KEY", "")
 DEFAULT_LLM = "gpt-4o-mini"
 DEFAULT_TOP_K = 5  # 検索結果の上位K件
 
+# OpenAI クライアント（コネクションプール）設定
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "8"))  # 同時リクエスト数 = プールサイズ
+OPENAI_KEEPALIVE_EXPIRY = 30.0  # アイドルなコネクションを保持する秒数
+OPENAI_TIMEOUT = 60.0
+OPENAI_MAX_RETRIES = 2
+
+# 外向きの API 呼び出しのスケジューラ（優先度つきの待ち行列 + レート制限）
+# 上限は 1 プロセスあたり。複数プロセスで動かすときは割った値を環境変数で渡す
+OPENAI_RPM_LIMIT = int(os.getenv("OPENAI_RPM_LIMIT", "500"))      # 1 分あたりのリクエスト数
+OPENAI_TPM_LIMIT = int(os.getenv("OPENAI_TPM_LIMIT", "200000"))   # 1 分あたりのトークン数
+# 優先度の高い順。クラスごとの同時実行数と、待ち行列で待つ上限（秒、過ぎたら諦めてフォールバック）
+LLM_PRIORITY_CLASSES = ("interactive", "story", "decorative", "prefetch")
+LLM_CLASS_CONCURRENCY = {"interactive": 8, "story": 4, "decorative": 3, "prefetch": 2}
+LLM_QUEUE_TIMEOUT_SEC = {"interactive": 30.0, "story": 60.0, "decorative": 10.0, "prefetch": 120.0}
+# 段階名 -> 優先度クラス（use_priority() で上書きできる）
+LLM_STAGE_PRIORITY = {
+    "query_expansion": "interactive",
+    "vector_search": "interactive",
+    "story": "story",
+    "related_format": "decorative",
+}
+
+# 同じ API 呼び出しの相乗り（singleflight）
+# SKYLORE_SINGLEFLIGHT_DIR を設定すると、同じマシンの別プロセスとも相乗りする（ロックファイルの置き場所）
+SINGLEFLIGHT_DIR = os.getenv("SKYLORE_SINGLEFLIGHT_DIR")
+SINGLEFLIGHT_WAIT_SEC = OPENAI_TIMEOUT * (OPENAI_MAX_RETRIES + 1)  # 別プロセスの呼び出しを待つ上限
+SINGLEFLIGHT_RESULT_TTL_SEC = 60.0  # 別プロセス向けの結果ファイルを残しておく秒数
+
+# ストーリー先読み設定
+STORY_PREFETCH_TOP_N = 3     # 検索結果の上位何件を先読みするか
+STORY_PREFETCH_WORKERS = 2   # 先読み用のスレッド数
+STORY_CACHE_SIZE = 256       # 共有ストーリーキャッシュの上限件数（88星座より大きければ追い出されない）
+STORY_PREFETCH_SESSIONS = 64 # 先読みの対象を覚えておくセッション数（古いセッションの分から捨てる）
+
+# プロセス内で共有する結果キャッシュ（正規化したクエリごと）
+EXPANSION_CACHE_SIZE = 1024   # クエリ拡張の結果
+SEARCH_CACHE_SIZE = 1024      # ハイブリッド検索の結果（可視判定の前）
+
 # ファイルパス
 PROJECT_ROOT = Path(__file__).resolve().parent
 DATA_DIR = PROJECT_ROOT / "data"
 CONSTELLATION_DATA_PATH = DATA_DIR / "constellation_data_with_keywords.json"
+CONSTELLATION_COORDS_PATH = DATA_DIR / "constellation_coordinates.json"  # 各星座の中心の赤経・赤緯
+VISIBILITY_TABLE_DIR = DATA_DIR / "visibility_table"  # 前計算した可視ビット表
+STAR_CATALOGUE_PATH = DATA_DIR / "bright_stars.csv"  # 輝星カタログ（J2000 の赤経・赤緯・V等級）
+DEEP_SKY_CATALOGUE_PATH = DATA_DIR / "deep_sky.csv"  # 星雲・星団・銀河（メシエ天体、J2000）
+INVERTED_INDEX_PATH = DATA_DIR / "inverted_index.json"  # 見出し語 -> 星座 id（入力中の候補に使う）
 INDEX_DIR = DATA_DIR / "index_constellation"
+# インデックスの版（src/index_versions）: INDEX_DIR/versions/<版> に書き、INDEX_DIR/CURRENT で切り替える
+INDEX_POLL_SECONDS = 2.0   # 動いているプロセスが CURRENT を見に行く間隔（新しい版は裏で読み込んで差し替える）
+INDEX_KEEP_VERSIONS = 3    # 構築後に残す古い版の数（ロールバック用。CURRENT の版は必ず残す）
 
 VECTOR_STORE_ID = "vs_6936a06353e48191ab2d280aedb802d6"
 
+# 検索対象のコーパス（名前 -> 成果物のディレクトリとベクトルストア）
+# 成果物は constellation_bm25_build と同じファイル名で置く。index_registry が初回利用時に読み込む
+# backend: "bm25"（成果物の BM25 + ベクトルストア）か "constellations"（星座向けのハイブリッド検索）
+CORPORA = {
+    "constellations": {"label": "星座", "index_dir": INDEX_DIR, "vector_store_id": VECTOR_STORE_ID,
+                       "backend": "constellations"},
+}
+DEFAULT_CORPORA = ["constellations"]   # アプリの検索で最初に選んでおくコーパス
+ROUTER_MAX_WORKERS = 4   # 複数コーパスに同時に投げる数
+
+# 1 リクエストの時間予算で検索の段階を選ぶ（src/query_planner）
+PLANNER_ENABLED = os.getenv("SKYLORE_PLANNER", "1") == "1"
+PLANNER_BUDGET_MS = float(os.getenv("SKYLORE_LATENCY_BUDGET_MS", "3000"))
+PLANNER_K_BM25 = 20                   # hybrid_search_constellations の既定と同じ
+PLANNER_K_VEC = 20
+PLANNER_DECISIVE_MARGIN = 0.5         # BM25 の 1 位と k 位のスコア差（1 位に対する割合）がこれ以上ならベクトル検索を省く
+PLANNER_SKIP_EXPANSION_COVERAGE = 0.6  # クエリの内容語のうちインデックスにある語の割合がこれ以上ならクエリ拡張を省く
+PLANNER_LOAD_QUEUED = 1               # interactive の待ち行列がこれ以上なら高負荷とみなして k を半分にする
+PLANNER_PRIOR_MS = {"expansion": 1500.0, "bm25": 30.0, "vector": 800.0}  # 実測が無いうちの見積もり
+
+# 入力中の候補（src/typeahead）
+TYPEAHEAD_MAX_RESULTS = 8
+TYPEAHEAD_DEBOUNCE_MS = 150   # 最後のキー入力からこれだけ経ってから候補を引く
+TYPEAHEAD_JUMP_CARDS = 6      # 候補から出すカードの上限（「冬（31星座）」などを選んだとき）
+TYPEAHEAD_COMPONENT_DIR = PROJECT_ROOT / "components" / "typeahead"
+
+# 表記ゆれ・打ち間違いに強い星座名の引き当て（src/fuzzy_names）
+FUZZY_MAX_EDIT = 2          # 削除索引に前計算する最大の削除数（= 許す編集距離の上限）
+FUZZY_CONFIDENCE = 0.75     # これ以上の確信度ならクエリ拡張とベクトル検索を飛ばして名前で返す
+
+# 英語・ローマ字のクエリを LLM を使わずに日本語の語へ置き換える（src/query_normalizer）
+LOCAL_NORMALIZE_ENABLED = os.getenv("SKYLORE_LOCAL_NORMALIZE", "1") == "1"
+
+# 大きなコーパスのインデックス構築（src/index_builder）
+BUILD_WORKERS = int(os.getenv("SKYLORE_BUILD_WORKERS", str(os.cpu_count() or 1)))  # トークナイズするプロセス数
+BUILD_BATCH_DOCS = 2000    # ワーカーに 1 回で渡す文書数（1 回分が 1 本のランとしてディスクに書かれる）
+BUILD_MERGE_FANIN = 64     # 一度にマージするランの数（これより多ければ何段かに分けてマージする）
+
+# BM25 のシャード数（1 ならシャード分割しない）と並列方式（"thread" / "process"）
+BM25_SHARDS = int(os.getenv("BM25_SHARDS", "1"))
+BM25_SHARD_EXECUTOR = os.getenv("BM25_SHARD_EXECUTOR", "thread")
+# postings の形式（"list" / "compressed"）。シャードモードでは list のまま使う
+BM25_POSTINGS_FORMAT = os.getenv("BM25_POSTINGS_FORMAT", "list")
+# アナライザ（"mecab" / "ngram" / "fused"）。fused は両方の順位を RRF で合わせる
+BM25_ANALYZER = os.getenv("BM25_ANALYZER", "mecab")
+# トークン位置を使った並べ替え（0 で無効）とスニペットの長さ
+BM25_PHRASE_BOOST = 0.5      # クエリの隣接トークン対が文書でも隣接している割合に掛ける
+BM25_PROXIMITY_BOOST = 0.3   # クエリ語がどれだけ近くにまとまって出てくるかに掛ける
+SNIPPET_WIDTH = 120
+
+# プロファイリング（--debug か SKYLORE_PROFILE=1 で有効）
+PROFILE_ENABLED = os.getenv("SKYLORE_PROFILE", "0") == "1"
+PROFILE_DIR = Path(os.getenv("SKYLORE_PROFILE_DIR", PROJECT_ROOT / "profiles"))
+PROFILE_KEEP = 50                    # 保存しておくリクエストの数（古いものから消す）
+PROFILE_SAMPLE_INTERVAL_SEC = 0.002  # スタックをサンプリングする間隔
+
+# 検索クエリの構造化ログ（JSONL、サイズでローテーション）
+QUERY_LOG_ENABLED = os.getenv("SKYLORE_QUERY_LOG", "1") == "1"
+QUERY_LOG_PATH = Path(os.getenv("SKYLORE_QUERY_LOG_PATH", PROJECT_ROOT / "logs" / "query_log.jsonl"))
+QUERY_LOG_MAX_BYTES = 10 * 1024 * 1024
+QUERY_LOG_BACKUPS = 5
+QUERY_LOG_QUEUE_SIZE = 10000    # 書き込み待ちの上限（あふれた分は捨てる）
+
+# クイック検索（サイドバーの「季節で探す」）の選択肢 -> クエリ
+QUICK_SEARCH_PRESETS = {
+    "春の星座": "春の暖かい日",
+    "夏の星座": "夏の暑い日",
+    "秋の星座": "秋の涼しい日",
+    "冬の星座": "冬の寒い日",
+}
+
+# 起動時のキャッシュ温め（クイック検索 + クエリログの上位 + WARMUP_QUERIES_PATH の各行）
+WARMUP_ON_START = os.getenv("SKYLORE_WARMUP", "0") == "1"
+WARMUP_TOP_N = int(os.getenv("SKYLORE_WARMUP_TOP_N", "20"))   # クエリログから何件使うか
+WARMUP_QUERIES_PATH = os.getenv("SKYLORE_WARMUP_QUERIES")      # 1 行 1 クエリのファイル（任意）
+WARMUP_CONCURRENCY = 4
+WARMUP_BUDGET_SEC = 60.0        # これを過ぎたら残りは諦める
+
 # 月と季節のマッピング
 MONTH_TO_SEASON = {
     1: "冬", 2: "冬", 3: "春",
@@ -39,6 +163,25 @@ SEASON_TO_MONTHS = {
     "冬": [12, 1, 2]
 }
 
+# 観測地と可視判定の設定（デフォルトは東京。夜の時刻は観測地の経度から求める）
+DEFAULT_OBSERVER_LAT = 35.68
+DEFAULT_OBSERVER_LON = 139.77
+VISIBILITY_HORIZON_DEG = 20.0     # この高度以上なら「見える」
+VISIBILITY_GRID_DEG = 1.0         # キャッシュ用に観測地を丸める単位（度）
+VISIBILITY_TIME_BUCKET_MIN = 15   # キャッシュ用に時刻を丸める単位（分）
+VISIBILITY_BOOST = 0.5            # 見える時間の割合に応じてスコアを最大何割上げるか
+VISIBILITY_TABLE_LAT_STEP = 5.0   # 可視ビット表の緯度帯の幅（度）
+
+# 輝星カタログの設定
+STAR_CARD_COUNT = 3               # 星座カードに載せる主な星の数
+STAR_NEAR_RADIUS_DEG = 15.0       # 「星座の近くの星」とみなす中心からの角距離（度）
+
+# 星雲・星団・銀河のカタログ
+DEEP_SKY_BRIGHT_MAG = 7.0         # 「明るい」と言われたときの等級の上限（双眼鏡で楽に見える程度）
+DEEP_SKY_NAKED_EYE_MAG = 5.5      # 「肉眼で」と言われたときの等級の上限
+DEEP_SKY_CARD_COUNT = 3           # 星座カードに載せる天体の数
+DEEP_SKY_RESULT_COUNT = 5         # 検索結果の下に出す天体の数
+
 # 気温と季節の目安（日本基準）
 TEMP_TO_SEASON = {
     (None, 10): "冬",
@@ -49,12 +192,18 @@ TEMP_TO_SEASON = {
 
 
 def get_args():
-    """コマンドライン引数を取得"""
+    """
+    コマンドライン引数を取得
+    
+    streamlit run app.py -- --debug のように渡す。
+    知らない引数（streamlit やテストランナーのもの）は無視する。
+    """
     parser = argparse.ArgumentParser(description="SkyLore - 星座検索アプリ")
     parser.add_argument("--llm", type=str, default=DEFAULT_LLM,
                         help="使用するLLMモデル")
     parser.add_argument("--top_k", type=int, default=DEFAULT_TOP_K,
                         help="表示する星座の数")
     parser.add_argument("--debug", action="store_true",
-                        help="デバッグモード")
-    return parser.parse_args()
+                        help="デバッグモード（検索ごとのプロファイルを保存）")
+    args, _ = parser.parse_known_args()
+    return args
@@ -0,0 +1,101 @@
+# analyzer_bench.py
+# 形態素（fugashi / MeCab）と文字 n-gram の 2 つのアナライザを、既存の docs で比べるスクリプト
+#   - 分かち書きのスループット（文字/秒）
+#   - インデックスの大きさ（語彙数・postings 数・pickle したバイト数）
+#   - クエリのレイテンシ（mecab / ngram / fused）
+#   - 適合性（keywords から作ったクエリと手書きクエリでの Recall@5 と MRR）
+
+import argparse
+import json
+import pickle
+import time
+
+from config import CONSTELLATION_DATA_PATH
+from .constellation_bm25_build import InvertedIndexArray, tokenize_ja, tokenize_ngram
+from .constellation_bm25_vec_rrf_search import _bm25_doc_ids, docs_list, keys
+
+# 複合語・言い換えを含む手書きのクエリと正解の星座
+HANDWRITTEN_QUERIES = [
+    ("冬の大三角", {"Orion", "Canis Major", "Canis Minor"}),
+    ("夏の大三角", {"Lyra", "Aquila", "Cygnus"}),
+    ("北斗七星", {"Ursa Major"}),
+    ("北極星", {"Ursa Minor"}),
+    ("織姫と彦星", {"Lyra", "Aquila"}),
+    ("さそりに刺された狩人", {"Orion", "Scorpius"}),
+    ("白鳥に姿を変えたゼウス", {"Cygnus"}),
+    ("アンドロメダ姫を救った英雄", {"Perseus", "Andromeda"}),
+    ("ヘラクレスに退治された獅子", {"Leo"}),
+    ("金の毛の羊", {"Aries"}),
+]
+
+
+def keyword_queries() -> list:
+    """各星座の keywords をクエリにし、その keyword を持つ星座すべてを正解とする"""
+    with open(CONSTELLATION_DATA_PATH, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    relevant = {}
+    for entry in data:
+        for kw in entry.get("keywords", []):
+            if len(kw) >= 2:
+                relevant.setdefault(kw, set()).add(entry["id"])
+    return sorted(relevant.items())
+
+
+def _throughput(tokenizer, docs, repeat: int = 5) -> float:
+    n_chars = sum(len(d) for d in docs) * repeat
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for d in docs:
+            tokenizer(d)
+    return n_chars / (time.perf_counter() - start)
+
+
+def _index_size(tokenizer, docs) -> dict:
+    index = InvertedIndexArray()
+    index.build(docs, tokenizer=tokenizer)
+    return {
+        "vocab": len(index.postings),
+        "postings": sum(len(p) for p in index.postings.values()),
+        "bytes": len(pickle.dumps(index.postings)),
+    }
+
+
+def _relevance(analyzer: str, queries: list, k: int = 5) -> dict:
+    recall, rr = 0.0, 0.0
+    for query, relevant in queries:
+        ranked = [keys[doc_id] for doc_id, score in _bm25_doc_ids(query, k, analyzer) if score > 0]
+        recall += len(relevant & set(ranked)) / len(relevant)
+        rr += next((1.0 / rank for rank, cid in enumerate(ranked, start=1) if cid in relevant), 0.0)
+    return {"recall@5": recall / len(queries), "mrr": rr / len(queries)}
+
+
+def _latency_ms(analyzer: str, queries: list, k: int = 20) -> float:
+    start = time.perf_counter()
+    for query, _ in queries:
+        _bm25_doc_ids(query, k, analyzer)
+    return (time.perf_counter() - start) * 1000 / len(queries)
+
+
+def benchmark():
+    print(f"docs={len(docs_list)} chars={sum(len(d) for d in docs_list)}")
+
+    print("\n=== 分かち書き / インデックスの大きさ ===")
+    for name, tokenizer in (("mecab", tokenize_ja), ("ngram", tokenize_ngram)):
+        size = _index_size(tokenizer, docs_list)
+        print(f"  {name:6s}: {_throughput(tokenizer, docs_list) / 1e6:6.2f} M chars/s  "
+              f"vocab={size['vocab']:6d} postings={size['postings']:7d} {size['bytes'] / 1024:7.1f} KiB")
+
+    kw_queries = keyword_queries()
+    print(f"\n=== クエリ（keywords {len(kw_queries)} 件 / 手書き {len(HANDWRITTEN_QUERIES)} 件）===")
+    for analyzer in ("mecab", "ngram", "fused"):
+        kw = _relevance(analyzer, kw_queries)
+        hw = _relevance(analyzer, HANDWRITTEN_QUERIES)
+        print(f"  {analyzer:6s}: {_latency_ms(analyzer, kw_queries):6.3f} ms/query  "
+              f"keywords R@5={kw['recall@5']:.3f} MRR={kw['mrr']:.3f}  "
+              f"手書き R@5={hw['recall@5']:.3f} MRR={hw['mrr']:.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="形態素と文字 n-gram のアナライザの比較")
+    parser.parse_args()
+    benchmark()
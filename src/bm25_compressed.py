@@ -0,0 +1,387 @@
+# bm25_compressed.py
+# InvertedIndexArray の postings（[(doc_id, tf), ...] の Python リスト）を
+# 圧縮形式に変換した BM25 インデックス
+#   - doc_id は差分（delta）にして varint でバイト列に詰める
+#   - tf も varint（ほとんど 1 バイト）で別のバイト列に詰める
+#   - BLOCK_SIZE 件ごとにスキップポインタ（直前の doc_id とバイト位置）を持つ
+# デコードとスコア計算は NumPy でまとめて行う
+
+import argparse
+import math
+import pickle
+import sys
+import time
+
+import numpy as np
+
+from .constellation_bm25_build import InvertedIndexArray, tokenize_ja
+
+BLOCK_SIZE = 128
+
+# これより短いバイト列は NumPy を使わずに Python でデコードした方が速い
+_SMALL_DECODE_BYTES = 48
+
+# 文書数がこれ以下なら、スコア計算も NumPy を使わずに Python で行う（呼び出しの固定費の方が大きい）
+_SMALL_INDEX_DOCS = 2048
+
+
+# ================================================================
+# varint エンコード / デコード
+# ================================================================
+
+def varint_encode(values: np.ndarray) -> np.ndarray:
+    """非負整数の配列を varint（7bit ずつ、上位ビットが継続フラグ）のバイト列にする"""
+    v = np.asarray(values, dtype=np.uint64)
+    nbytes = np.ones(len(v), dtype=np.int64)
+    for shift in (7, 14, 21, 28, 35, 42, 49, 56):
+        nbytes += v >= (np.uint64(1) << np.uint64(shift))
+
+    out = np.empty(int(nbytes.sum()), dtype=np.uint8)
+    starts = np.cumsum(nbytes) - nbytes
+    for k in range(int(nbytes.max()) if len(v) else 0):
+        mask = nbytes > k
+        byte = (v[mask] >> np.uint64(7 * k)) & np.uint64(0x7F)
+        cont = (nbytes[mask] > k + 1).astype(np.uint64) << np.uint64(7)
+        out[starts[mask] + k] = (byte | cont).astype(np.uint8)
+    return out
+
+
+def varint_decode(buf: np.ndarray) -> np.ndarray:
+    """varint のバイト列を int64 の配列に戻す（NumPy でベクトル化）"""
+    if len(buf) == 0:
+        return np.zeros(0, dtype=np.int64)
+    ends = buf < 0x80
+    group = np.cumsum(ends) - ends          # 各バイトが何番目の値に属するか
+    starts = np.flatnonzero(np.concatenate(([True], ends[:-1])))
+    pos = np.arange(len(buf)) - starts[group]
+    vals = (buf & 0x7F).astype(np.int64) << (7 * pos)
+    return np.add.reduceat(vals, starts)
+
+
+def _varint_decode_py(buf) -> list:
+    """短いバイト列用の Python 版デコード"""
+    out = []
+    val = 0
+    shift = 0
+    if isinstance(buf, np.ndarray):
+        buf = buf.tobytes()
+    for byte in buf:
+        val |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            out.append(val)
+            val = 0
+            shift = 0
+        else:
+            shift += 7
+    return out
+
+
+# ================================================================
+# 圧縮インデックス
+# ================================================================
+
+class CompressedInvertedIndex:
+    """
+    InvertedIndexArray と同じ bm25_search(query, topk) を持つ圧縮 postings 版
+
+    語ごとの情報は term_id で引く配列に持つ:
+      df[t]                       : postings の件数
+      doc_off[t] .. doc_off[t+1]  : doc_bytes 内の範囲
+      tf_off[t]  .. tf_off[t+1]   : tf_bytes 内の範囲
+      skip_off[t] .. skip_off[t+1]: スキップテーブル内の範囲（1ブロック1行）
+    """
+
+    def __init__(self):
+        self.term_ids = {}
+        self.df = np.zeros(0, dtype=np.int64)
+        self.doc_off = np.zeros(1, dtype=np.int64)
+        self.tf_off = np.zeros(1, dtype=np.int64)
+        self.skip_off = np.zeros(1, dtype=np.int64)
+        self.doc_bytes = np.zeros(0, dtype=np.uint8)
+        self.tf_bytes = np.zeros(0, dtype=np.uint8)
+        # スキップテーブル: ブロック直前の doc_id、ブロック末尾の doc_id、各バイト列での開始位置
+        self.skip_base = np.zeros(0, dtype=np.int64)
+        self.skip_last = np.zeros(0, dtype=np.int64)
+        self.skip_doc_pos = np.zeros(0, dtype=np.int64)
+        self.skip_tf_pos = np.zeros(0, dtype=np.int64)
+        self.doc_count = 0
+        self.avgdl = 0.0
+        self.doc_lens = np.zeros(0, dtype=np.int64)
+        self._small_view = None
+
+    @classmethod
+    def from_index(cls, index: InvertedIndexArray, block_size: int = BLOCK_SIZE):
+        """構築済みの InvertedIndexArray を圧縮形式に変換する"""
+        writer = CompressedIndexWriter(block_size)
+        for term in sorted(index.postings):
+            plist = index.postings[term]
+            ids = np.fromiter((d for d, _ in plist), dtype=np.int64, count=len(plist))
+            tfs = np.fromiter((f for _, f in plist), dtype=np.int64, count=len(plist))
+            writer.add(term, ids, tfs)
+        return writer.finish(index.doc_lens, avgdl=index.avgdl)
+
+    def _decode_span(self, t: int, block_lo: int, block_hi: int):
+        """term t のブロック [block_lo, block_hi) をデコードして (doc_ids, tfs) を返す"""
+        s0 = self.skip_off[t]
+        doc_start = self.skip_doc_pos[s0 + block_lo]
+        tf_start = self.skip_tf_pos[s0 + block_lo]
+        if s0 + block_hi < self.skip_off[t + 1]:
+            doc_end = self.skip_doc_pos[s0 + block_hi]
+            tf_end = self.skip_tf_pos[s0 + block_hi]
+        else:
+            doc_end = self.doc_off[t + 1]
+            tf_end = self.tf_off[t + 1]
+        base = self.skip_base[s0 + block_lo]
+
+        doc_buf = self.doc_bytes[doc_start:doc_end]
+        tf_buf = self.tf_bytes[tf_start:tf_end]
+        if len(doc_buf) <= _SMALL_DECODE_BYTES:
+            deltas = _varint_decode_py(doc_buf)
+            ids, cur = [], base
+            for d in deltas:
+                cur += d
+                ids.append(cur)
+            return np.asarray(ids, dtype=np.int64), np.asarray(_varint_decode_py(tf_buf), dtype=np.int64)
+        return np.cumsum(varint_decode(doc_buf)) + base, varint_decode(tf_buf)
+
+    def postings(self, term: str):
+        """term の postings をすべてデコードして (doc_ids, tfs) を返す"""
+        t = self.term_ids.get(term)
+        if t is None:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return self._decode_span(t, 0, int(self.skip_off[t + 1] - self.skip_off[t]))
+
+    def postings_range(self, term: str, lo: int, hi: int):
+        """
+        doc_id が [lo, hi) の postings だけを返す。
+        スキップテーブルで範囲外のブロックはデコードせずに飛ばす。
+        """
+        t = self.term_ids.get(term)
+        if t is None:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        s0, s1 = self.skip_off[t], self.skip_off[t + 1]
+        block_lo = int(np.searchsorted(self.skip_last[s0:s1], lo, side="left"))
+        # ブロック j の doc_id は skip_base[j] より大きい（先頭ブロックだけは skip_base 以上）
+        block_hi = int(np.searchsorted(self.skip_base[s0:s1], hi, side="left"))
+        if block_lo >= block_hi:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        ids, tfs = self._decode_span(t, block_lo, block_hi)
+        mask = (ids >= lo) & (ids < hi)
+        return ids[mask], tfs[mask]
+
+    def bm25_scores(self, query_terms, k1=1.5, b=0.75) -> np.ndarray:
+        """BM25 スコアを全文書分の配列で返す（InvertedIndexArray.bm25 と同じ値）"""
+        scores = np.zeros(self.doc_count, dtype=np.float64)
+        for term in query_terms:
+            t = self.term_ids.get(term)
+            if t is None:
+                continue
+            df = int(self.df[t])
+            idf = math.log((self.doc_count - df + 0.5) / (df + 0.5) + 1)
+
+            ids, tf = self.postings(term)
+            dl = self.doc_lens[ids]
+            denom = tf + k1 * (1 - b + b * dl / self.avgdl)
+            scores[ids] += idf * (tf * (k1 + 1)) / denom
+        return scores
+
+    def bm25(self, query_terms, k1=1.5, b=0.75):
+        """InvertedIndexArray.bm25 と同じ doc_id -> score の辞書を返す"""
+        return dict(enumerate(self.bm25_scores(query_terms, k1, b).tolist()))
+
+    def _bm25_small(self, query_terms, k1=1.5, b=0.75) -> list:
+        """小さいインデックス用の Python 版 BM25（InvertedIndexArray.bm25 と同じ計算）"""
+        scores = [0.0] * self.doc_count
+        doc_lens, doc_buf, tf_buf, doc_off, tf_off, dfs = self._small_view
+        for term in query_terms:
+            t = self.term_ids.get(term)
+            if t is None:
+                continue
+            df = dfs[t]
+            idf = math.log((self.doc_count - df + 0.5) / (df + 0.5) + 1)
+
+            doc_id = 0
+            deltas = _varint_decode_py(doc_buf[doc_off[t]:doc_off[t + 1]])
+            tfs = _varint_decode_py(tf_buf[tf_off[t]:tf_off[t + 1]])
+            for delta, tf in zip(deltas, tfs):
+                doc_id += delta
+                dl = doc_lens[doc_id]
+                denom = tf + k1 * (1 - b + b * dl / self.avgdl)
+                scores[doc_id] += idf * (tf * (k1 + 1)) / denom
+        return scores
+
+    def search_terms(self, query_terms, topk=10):
+        """トークン列で検索して上位文書を返す（doc_id, score のリスト）"""
+        if self.doc_count <= _SMALL_INDEX_DOCS:
+            if self._small_view is None:
+                # Python から触りやすい形（bytes と list）に一度だけ変換しておく
+                self._small_view = (self.doc_lens.tolist(), self.doc_bytes.tobytes(),
+                                    self.tf_bytes.tobytes(), self.doc_off.tolist(),
+                                    self.tf_off.tolist(), self.df.tolist())
+            scores = self._bm25_small(query_terms)
+            ranked = sorted(enumerate(scores), key=lambda x: x[1], reverse=True)
+            return ranked[:topk]
+
+        scores = self.bm25_scores(query_terms)
+        neg = -scores
+        if topk < len(scores):
+            # k 番目のスコア以上の候補だけを並べる（同点は doc_id 昇順）
+            kth = np.partition(neg, topk - 1)[topk - 1]
+            cand = np.flatnonzero(neg <= kth)
+        else:
+            cand = np.arange(len(scores))
+        order = cand[np.lexsort((cand, neg[cand]))][:topk]
+        return list(zip(order.tolist(), scores[order].tolist()))
+
+    def bm25_search(self, query, topk=10):
+        """クエリ文字列を入力して上位文書を返す（InvertedIndexArray.bm25_search と同じ結果）"""
+        return self.search_terms(tokenize_ja(query), topk=topk)
+
+    def __getstate__(self):
+        # Python 用の展開済みビューは保存しない
+        state = self.__dict__.copy()
+        state["_small_view"] = None
+        return state
+
+    def nbytes(self) -> int:
+        """postings 部分（バイト列 + オフセット + スキップテーブル）のバイト数"""
+        arrays = (self.df, self.doc_off, self.tf_off, self.skip_off, self.doc_bytes, self.tf_bytes,
+                  self.skip_base, self.skip_last, self.skip_doc_pos, self.skip_tf_pos)
+        return sum(a.nbytes for a in arrays)
+
+
+class CompressedIndexWriter:
+    """
+    語を辞書順に add(term, doc_ids, tfs) していき、finish() で CompressedInvertedIndex にする。
+
+    spill_dir を渡すと doc_id / tf のバイト列はファイルに追記していき、finish() では
+    memmap として持たせる（postings 全体をヒープに載せずに作れる。index_builder 用）。
+    """
+
+    def __init__(self, block_size: int = BLOCK_SIZE, spill_dir=None):
+        self.block_size = block_size
+        self.terms = []
+        self.df = []
+        self.doc_off, self.tf_off, self.skip_off = [0], [0], [0]
+        self.skip_base, self.skip_last, self.skip_doc_pos, self.skip_tf_pos = [], [], [], []
+        self.spill_dir = spill_dir
+        self._doc_chunks, self._tf_chunks = [], []
+        self._doc_file = self._tf_file = None
+        if spill_dir is not None:
+            self._doc_file = open(f"{spill_dir}/doc_bytes.bin", "wb")
+            self._tf_file = open(f"{spill_dir}/tf_bytes.bin", "wb")
+
+    def add(self, term: str, ids: np.ndarray, tfs: np.ndarray):
+        """term の postings（doc_id 昇順）を追加する。term は前回より辞書順で後ろであること"""
+        deltas = np.diff(ids, prepend=0)
+        doc_enc = varint_encode(deltas)
+        tf_enc = varint_encode(tfs)
+        doc_base, tf_base = self.doc_off[-1], self.tf_off[-1]
+
+        # 各値が何バイトだったかから、ブロック先頭のバイト位置を求める
+        doc_ends = np.flatnonzero(doc_enc < 0x80) + 1
+        tf_ends = np.flatnonzero(tf_enc < 0x80) + 1
+        for start in range(0, len(ids), self.block_size):
+            last = min(start + self.block_size, len(ids)) - 1
+            self.skip_base.append(int(ids[start - 1]) if start else 0)
+            self.skip_last.append(int(ids[last]))
+            self.skip_doc_pos.append(doc_base + (int(doc_ends[start - 1]) if start else 0))
+            self.skip_tf_pos.append(tf_base + (int(tf_ends[start - 1]) if start else 0))
+
+        self.terms.append(term)
+        self.df.append(len(ids))
+        if self.spill_dir is None:
+            self._doc_chunks.append(doc_enc)
+            self._tf_chunks.append(tf_enc)
+        else:
+            self._doc_file.write(doc_enc.tobytes())
+            self._tf_file.write(tf_enc.tobytes())
+        self.doc_off.append(doc_base + len(doc_enc))
+        self.tf_off.append(tf_base + len(tf_enc))
+        self.skip_off.append(len(self.skip_base))
+
+    def _bytes(self, chunks: list, file) -> np.ndarray:
+        if self.spill_dir is None:
+            return np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.uint8)
+        size = file.tell()
+        file.close()
+        if size == 0:
+            return np.zeros(0, dtype=np.uint8)
+        return np.memmap(file.name, dtype=np.uint8, mode="r")
+
+    def finish(self, doc_lens, avgdl: float | None = None) -> CompressedInvertedIndex:
+        comp = CompressedInvertedIndex()
+        comp.doc_lens = np.asarray(doc_lens, dtype=np.int64)
+        comp.doc_count = len(comp.doc_lens)
+        comp.avgdl = avgdl if avgdl is not None else float(comp.doc_lens.sum()) / max(1, comp.doc_count)
+        comp.term_ids = {term: i for i, term in enumerate(self.terms)}
+        comp.df = np.asarray(self.df, dtype=np.int64)
+        comp.doc_off = np.asarray(self.doc_off, dtype=np.int64)
+        comp.tf_off = np.asarray(self.tf_off, dtype=np.int64)
+        comp.skip_off = np.asarray(self.skip_off, dtype=np.int64)
+        comp.doc_bytes = self._bytes(self._doc_chunks, self._doc_file)
+        comp.tf_bytes = self._bytes(self._tf_chunks, self._tf_file)
+        comp.skip_base = np.asarray(self.skip_base, dtype=np.int64)
+        comp.skip_last = np.asarray(self.skip_last, dtype=np.int64)
+        comp.skip_doc_pos = np.asarray(self.skip_doc_pos, dtype=np.int64)
+        comp.skip_tf_pos = np.asarray(self.skip_tf_pos, dtype=np.int64)
+        return comp
+
+
+# ================================================================
+# ベンチマーク：現行の list 形式との比較
+# ================================================================
+
+def _list_postings_nbytes(postings: dict) -> int:
+    """list 形式の postings のメモリ量（リスト + タプル + int、小さい int のキャッシュは無視）"""
+    total = 0
+    for plist in postings.values():
+        total += sys.getsizeof(plist)
+        for pair in plist:
+            total += sys.getsizeof(pair) + sum(sys.getsizeof(x) for x in pair)
+    return total
+
+
+def benchmark(corpus_sizes=(2000, 20000, 60000), topk=10):
+    from .bm25_sharded import make_synthetic_corpus
+
+    for n_docs in corpus_sizes:
+        docs, queries = make_synthetic_corpus(n_docs)
+        index = InvertedIndexArray()
+        index.build(docs, tokenizer=str.split)
+        n_postings = sum(len(p) for p in index.postings.values())
+
+        start = time.perf_counter()
+        comp = CompressedInvertedIndex.from_index(index)
+        convert_sec = time.perf_counter() - start
+
+        print(f"\n=== docs={n_docs} postings={n_postings} (変換 {convert_sec:.2f}s) ===")
+        for name, obj, mem in (("list", index, _list_postings_nbytes(index.postings)),
+                               ("compressed", comp, comp.nbytes())):
+            blob = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+            start = time.perf_counter()
+            for _ in range(3):
+                pickle.loads(blob)
+            load_ms = (time.perf_counter() - start) * 1000 / 3
+
+            if name == "list":
+                search = lambda q: sorted(obj.bm25(q).items(), key=lambda x: x[1], reverse=True)[:topk]
+            else:
+                search = lambda q: obj.search_terms(q, topk)
+            start = time.perf_counter()
+            results = [search(q) for q in queries]
+            query_ms = (time.perf_counter() - start) * 1000 / len(queries)
+            if name == "list":
+                expected = results
+            same = "" if name == "list" else ("OK" if results == expected else "MISMATCH")
+
+            print(f"  {name:10s}: mem {mem / n_postings:6.2f} B/posting, "
+                  f"pickle {len(blob) / n_postings:6.2f} B/posting, "
+                  f"load {load_ms:8.1f} ms, query {query_ms:7.2f} ms {same}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="圧縮 postings のベンチマーク")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[2000, 20000, 60000])
+    args = parser.parse_args()
+    benchmark(args.sizes)
@@ -0,0 +1,60 @@
+# bm25_positional_bench.py
+# トークン位置付きインデックス（フレーズ・近接スコア、クエリに合わせたスニペット）の
+# 追加コストを測るスクリプト。既存の docs と keywords から作ったクエリを使う。
+
+import argparse
+import pickle
+import time
+
+from .analyzer_bench import HANDWRITTEN_QUERIES, keyword_queries
+from .constellation_bm25_build import InvertedIndexArray, tokenize_ja
+from .constellation_bm25_vec_rrf_search import docs_list
+
+
+def _per_query_us(fn, queries, repeat: int = 5) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for q in queries:
+            fn(q)
+    return (time.perf_counter() - start) * 1e6 / (repeat * len(queries))
+
+
+def benchmark(k: int = 10):
+    plain = InvertedIndexArray()
+    plain.build(docs_list)
+    positional = InvertedIndexArray()
+    positional.build(docs_list, with_positions=True)
+
+    plain_bytes = len(pickle.dumps(plain))
+    pos_bytes = len(pickle.dumps(positional))
+    print(f"docs={len(docs_list)} index: {plain_bytes / 1024:.1f} KiB -> "
+          f"{pos_bytes / 1024:.1f} KiB with positions (+{(pos_bytes - plain_bytes) / 1024:.1f} KiB)")
+
+    queries = [q for q, _ in keyword_queries()] + [q for q, _ in HANDWRITTEN_QUERIES]
+    tokenized = {q: tokenize_ja(q) for q in queries}
+    ranked = {q: positional.bm25_search(q, topk=k * 2) for q in queries}
+
+    def rerank(q):
+        positional.positional_rerank(tokenized[q], ranked[q])
+
+    def snippets(q):
+        for doc_id, _ in ranked[q][:k]:
+            positional.snippet(doc_id, docs_list[doc_id], tokenized[q])
+
+    def phrase(q):
+        for doc_id, score in ranked[q]:
+            if score > 0:
+                positional.phrase_count(doc_id, tokenized[q])
+
+    print(f"queries={len(queries)} k={k}")
+    print(f"  bm25_search (tokenize + score) : {_per_query_us(lambda q: positional.bm25_search(q, topk=k * 2), queries):8.1f} us/query")
+    print(f"  + phrase/proximity rerank      : {_per_query_us(rerank, queries):8.1f} us/query")
+    print(f"  + phrase filter (2k candidates): {_per_query_us(phrase, queries):8.1f} us/query")
+    print(f"  + {k} query-biased snippets     : {_per_query_us(snippets, queries):8.1f} us/query")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="トークン位置付きインデックスのレイテンシ計測")
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+    benchmark(args.k)
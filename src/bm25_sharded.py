@@ -0,0 +1,222 @@
+# bm25_sharded.py
+# InvertedIndexArray を doc_id の範囲で N 個のシャードに分割し、
+# シャードごとに並列でスコアリングして上位 k 件をヒープでマージする（scatter-gather）
+# idf / avgdl は全体の統計を使うので、結果は分割しない bm25_search と一致する
+
+import argparse
+import heapq
+import math
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from .constellation_bm25_build import InvertedIndexArray, tokenize_ja
+
+
+def _rank_key(item):
+    # bm25_search の sorted(..., reverse=True) と同じ並び（スコア降順、同点は doc_id 昇順）
+    doc_id, score = item
+    return (-score, doc_id)
+
+
+class IndexShard:
+    """doc_id が [start, end) の文書だけを持つシャード（doc_id は全体の通し番号のまま）"""
+
+    def __init__(self, start: int, end: int, doc_lens: list, postings: dict):
+        self.start = start
+        self.end = end
+        self.doc_lens = doc_lens   # doc_lens[doc_id - start]
+        self.postings = postings   # term -> [(doc_id, tf), ...]
+
+
+def _score_shard(shard, weighted_terms, k1, b, avgdl, topk):
+    """1シャード分の BM25 を計算して、シャード内の上位 topk を返す"""
+    scores = {}
+
+    for term, idf in weighted_terms:
+        plist = shard.postings.get(term)
+        if not plist:
+            continue
+        for doc_id, tf in plist:
+            dl = shard.doc_lens[doc_id - shard.start]
+            denom = tf + k1 * (1 - b + b * dl / avgdl)
+            score = idf * (tf * (k1 + 1)) / denom
+            scores[doc_id] = scores.get(doc_id, 0.0) + score
+
+    top = heapq.nsmallest(topk, scores.items(), key=_rank_key)
+
+    # 元の bm25_search はスコア 0 の文書も doc_id 順で返すので、足りない分を埋める
+    doc_id = shard.start
+    while len(top) < topk and doc_id < shard.end:
+        if doc_id not in scores:
+            top.append((doc_id, 0.0))
+        doc_id += 1
+    return top
+
+
+# プロセス並列時は、各ワーカーに最初に一度だけシャードを渡しておく
+_worker_shards = None
+
+
+def _init_worker(shards):
+    global _worker_shards
+    _worker_shards = shards
+
+
+def _score_shard_in_worker(shard_idx, weighted_terms, k1, b, avgdl, topk):
+    return _score_shard(_worker_shards[shard_idx], weighted_terms, k1, b, avgdl, topk)
+
+
+class ShardedInvertedIndex:
+    """
+    InvertedIndexArray と同じ bm25_search(query, topk) を持つシャード版インデックス
+
+    executor は "thread" か "process"。
+    純 Python のスコア計算は GIL で直列化されるので、速度が欲しいときは "process"。
+    """
+
+    def __init__(self, n_shards: int = 4, executor: str = "thread"):
+        self.n_shards = n_shards
+        self.executor = executor
+        self.shards = []
+        self.df = {}          # term -> 全体の文書頻度
+        self.doc_count = 0
+        self.avgdl = 0.0
+        self._pool = None
+
+    @classmethod
+    def from_index(cls, index: InvertedIndexArray, n_shards: int = 4, executor: str = "thread"):
+        """構築済みの InvertedIndexArray をシャードに分割する"""
+        sharded = cls(n_shards=n_shards, executor=executor)
+        sharded.doc_count = index.doc_count
+        sharded.avgdl = index.avgdl
+        sharded.df = {term: len(plist) for term, plist in index.postings.items()}
+
+        n = max(1, min(n_shards, index.doc_count))
+        bounds = [index.doc_count * i // n for i in range(n + 1)]
+        shard_postings = [{} for _ in range(n)]
+
+        for term, plist in index.postings.items():
+            s = 0
+            for doc_id, tf in plist:   # plist は doc_id 順
+                while doc_id >= bounds[s + 1]:
+                    s += 1
+                shard_postings[s].setdefault(term, []).append((doc_id, tf))
+
+        sharded.shards = [
+            IndexShard(bounds[i], bounds[i + 1], index.doc_lens[bounds[i]:bounds[i + 1]], shard_postings[i])
+            for i in range(n)
+        ]
+        sharded.n_shards = n
+        return sharded
+
+    def _get_pool(self):
+        if self._pool is None:
+            if self.executor == "process":
+                self._pool = ProcessPoolExecutor(max_workers=self.n_shards,
+                                                 initializer=_init_worker,
+                                                 initargs=(self.shards,))
+            else:
+                self._pool = ThreadPoolExecutor(max_workers=self.n_shards,
+                                                thread_name_prefix="bm25-shard")
+        return self._pool
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __getstate__(self):
+        # プールは pickle できないので保存対象から外す
+        state = self.__dict__.copy()
+        state["_pool"] = None
+        return state
+
+    def _weighted_terms(self, query_terms):
+        """クエリ語ごとに全体統計から idf を計算（重複語もそのまま残す）"""
+        weighted = []
+        for term in query_terms:
+            df = self.df.get(term, 0)
+            if df == 0:
+                continue
+            idf = math.log((self.doc_count - df + 0.5) / (df + 0.5) + 1)
+            weighted.append((term, idf))
+        return weighted
+
+    def search_terms(self, query_terms, topk=10, k1=1.5, b=0.75):
+        """トークン列で検索して上位文書を返す（doc_id, score のリスト）"""
+        weighted = self._weighted_terms(query_terms)
+        pool = self._get_pool()
+
+        if self.executor == "process":
+            futures = [pool.submit(_score_shard_in_worker, i, weighted, k1, b, self.avgdl, topk)
+                       for i in range(len(self.shards))]
+        else:
+            futures = [pool.submit(_score_shard, shard, weighted, k1, b, self.avgdl, topk)
+                       for shard in self.shards]
+
+        partials = [f.result() for f in futures]
+        return heapq.nsmallest(topk, heapq.merge(*partials, key=_rank_key), key=_rank_key)
+
+    def bm25_search(self, query, topk=10):
+        """クエリ文字列を入力して上位文書を返す（InvertedIndexArray.bm25_search と同じ結果）"""
+        return self.search_terms(tokenize_ja(query), topk=topk)
+
+
+# ================================================================
+# スケーリングのベンチマーク（合成コーパス）
+# ================================================================
+
+def make_synthetic_corpus(n_docs: int, vocab_size: int = 20000, doc_len: int = 60, seed: int = 0):
+    """Zipf 分布っぽい語彙からスペース区切りの文書を作る"""
+    rng = random.Random(seed)
+    vocab = [f"w{i}" for i in range(vocab_size)]
+    weights = [1.0 / (r + 1) for r in range(vocab_size)]
+    docs = []
+    for _ in range(n_docs):
+        n = max(1, int(rng.gauss(doc_len, doc_len / 4)))
+        docs.append(" ".join(rng.choices(vocab, weights=weights, k=n)))
+    queries = [rng.choices(vocab[:2000], k=3) for _ in range(50)]
+    return docs, queries
+
+
+def _unsharded_search(index, terms, topk):
+    scores = index.bm25(terms)
+    ranked = sorted(scores.items(), key=lambda x: x[1], reverse=True)
+    return ranked[:topk]
+
+
+def benchmark(corpus_sizes=(10000, 50000, 200000), shard_counts=(1, 2, 4, 8),
+              executors=("thread", "process"), topk=10):
+    for n_docs in corpus_sizes:
+        docs, queries = make_synthetic_corpus(n_docs)
+        index = InvertedIndexArray()
+        index.build(docs, tokenizer=str.split)
+        n_postings = sum(len(p) for p in index.postings.values())
+
+        start = time.perf_counter()
+        expected = [_unsharded_search(index, q, topk) for q in queries]
+        base_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        print(f"\n=== docs={n_docs} postings={n_postings} ===")
+        print(f"  unsharded            : {base_ms:8.2f} ms/query")
+
+        for executor in executors:
+            for n_shards in shard_counts:
+                sharded = ShardedInvertedIndex.from_index(index, n_shards=n_shards, executor=executor)
+                sharded.search_terms(queries[0], topk)  # プールの起動を計測から外す
+                start = time.perf_counter()
+                got = [sharded.search_terms(q, topk) for q in queries]
+                ms = (time.perf_counter() - start) * 1000 / len(queries)
+                sharded.close()
+                same = "OK" if got == expected else "MISMATCH"
+                print(f"  {executor:7s} shards={n_shards:<3d}: {ms:8.2f} ms/query "
+                      f"(x{base_ms / ms:4.2f}) {same}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="シャード版BM25のスケーリングベンチマーク")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 50000, 200000])
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--executors", nargs="+", default=["thread", "process"])
+    args = parser.parse_args()
+    benchmark(args.sizes, args.shards, args.executors)
@@ -6,12 +6,19 @@
 import json
 import math
 import re
+import unicodedata
+from array import array
+from bisect import bisect_left
 from collections import Counter
+from operator import itemgetter
 from pathlib import Path
 
 import joblib
 from fugashi import Tagger
 
+from config import INDEX_DIR
+from .star_catalogue import get_star_catalogue
+
 
 # ================================================================
 # 設定
@@ -20,9 +27,7 @@ from fugashi import Tagger
 # 星座データ（すでに keywords 付きにした JSON）
 DATA_PATH = Path("./data/constellation_data_with_keywords.json")
 
-# BM25インデックスを保存するディレクトリ
-INDEX_DIR = Path("index_constellation")
-INDEX_DIR.mkdir(exist_ok=True, parents=True)
+# BM25インデックスは config.INDEX_DIR（検索側と同じ場所）の versions/<版> に書く
 
 
 # ================================================================
@@ -59,6 +64,55 @@ def tokenize_ja(text: str):
     return tokens
 
 
+def token_spans(text: str, tokens: list) -> list:
+    """
+    トークン列の各トークンが text のどこにあるか（start, end の文字位置）を先頭から順に探す。
+    tokenize_ja のトークンは text の部分文字列なので、再解析せずに位置が求まる。
+    見つからないトークン（正規化で形が変わったもの）は直前の位置の幅 0 にする。
+    """
+    spans = []
+    cursor = 0
+    for tok in tokens:
+        start = text.find(tok, cursor)
+        if start < 0:
+            spans.append((cursor, cursor))
+            continue
+        cursor = start + len(tok)
+        spans.append((start, cursor))
+    return spans
+
+
+# 文字 n-gram 用の区切り（空白・句読点・括弧など）。長音「ー」はカタカナ語の一部なので区切らない
+_NGRAM_SPLIT = re.compile(r"[\s、。,.!?！？「」『』（）()【】・:;/]+")
+NGRAM_SIZES = (2, 3)
+
+
+def tokenize_ngram(text: str, sizes=NGRAM_SIZES):
+    """
+    MeCab を使わない文字 n-gram（既定は 2-gram と 3-gram）の分かち書き。
+    NFKC + 小文字化したうえで句読点・空白で区切り、区間ごとに n-gram を作る。
+    最短の n より短い区間（「冬」など）はそのまま 1 トークンにする。
+    """
+    text = unicodedata.normalize("NFKC", normalize(text)).lower()
+    tokens = []
+    for run in _NGRAM_SPLIT.split(text):
+        if not run:
+            continue
+        if len(run) < min(sizes):
+            tokens.append(run)
+            continue
+        for n in sizes:
+            tokens.extend(run[i:i + n] for i in range(len(run) - n + 1))
+    return tokens
+
+
+# アナライザ名 -> トークナイザ（BM25_ANALYZER や検索時の analyzer 引数で選ぶ）
+ANALYZERS = {
+    "mecab": tokenize_ja,
+    "ngram": tokenize_ngram,
+}
+
+
 # ================================================================
 # 検索用テキストの構築
 # myth_summary + keywords + best_months を1本の文字列にする
@@ -70,6 +124,7 @@ def build_index_text(entry: dict) -> str:
     - myth_summary
     - keywords
     - best_months（例: 11,12,1 → "11月 12月 1月"）
+    - 輝星カタログにある、その星座の星の和名（keywords に無いものだけ）
     """
     parts = []
 
@@ -81,6 +136,12 @@ def build_index_text(entry: dict) -> str:
     if keywords:
         parts.append(" ".join(keywords))
 
+    stars = get_star_catalogue()
+    if stars is not None:
+        star_names = [n for n in stars.keywords_for(entry.get("id", "")) if n not in keywords]
+        if star_names:
+            parts.append(" ".join(star_names))
+
     months = entry.get("best_months", [])
     if months:
         month_tokens = [f"{m}月" for m in months]
@@ -93,6 +154,10 @@ def build_index_text(entry: dict) -> str:
 # 転置インデックス + BM25（授業ノート準拠）
 # ================================================================
 
+# スニペットで単独ではハイライトしないトークン（ひらがな 1 文字の助詞など）
+_PARTICLE = re.compile(r"^[ぁ-ん]$")
+
+
 class InvertedIndexArray:
     def __init__(self):
         self.vocab = []
@@ -100,16 +165,29 @@ class InvertedIndexArray:
         self.doc_count = 0
         self.avgdl = 0.0
         self.doc_lens = []
-
-    def build(self, docs):
-        """TF付き転置インデックスを構築"""
+        # with_positions=True で作ったときだけ使う（古い joblib には無い）
+        # positions[term] は 1 本の配列で、先頭 df+1 個が postings ごとの区切り、その後ろがトークン番号
+        self.positions = None
+        # 全文書のトークンの開始・終了文字位置を 1 本に詰めたもの（doc_id の分は token_base[doc_id] から）
+        self.token_base = None
+        self.token_starts = None
+        self.token_ends = None
+
+    def build(self, docs, tokenizer=tokenize_ja, with_positions=False):
+        """
+        TF付き転置インデックスを構築（tokenizer はベンチマーク用に差し替え可能）
+        with_positions=True なら、フレーズ検索・スニペット用にトークン位置と文字位置も持つ
+        （文字位置はトークンが文書の部分文字列である tokenize_ja を前提にしている）。
+        """
         self.doc_count = len(docs)
         vocab_set = set()
         postings = {}
+        doc_positions = {}   # term -> [[pos, ...] (doc_id 順)]
         self.doc_lens = []
+        starts, ends = [], []
 
         for doc_id, doc in enumerate(docs):
-            tokens = tokenize_ja(doc)
+            tokens = tokenizer(doc)
             tf_counts = Counter(tokens)
             self.doc_lens.append(len(tokens))
 
@@ -117,6 +195,16 @@ class InvertedIndexArray:
                 vocab_set.add(term)
                 postings.setdefault(term, []).append((doc_id, tf))
 
+            if with_positions:
+                for start, end in token_spans(doc, tokens):
+                    starts.append(start)
+                    ends.append(end)
+                term_pos = {}
+                for pos, term in enumerate(tokens):
+                    term_pos.setdefault(term, []).append(pos)
+                for term, pos_list in term_pos.items():
+                    doc_positions.setdefault(term, []).append(pos_list)
+
         self.avgdl = sum(self.doc_lens) / max(1, len(self.doc_lens))
         self.vocab = sorted(vocab_set)
 
@@ -125,6 +213,150 @@ class InvertedIndexArray:
             postings[t] = sorted(postings[t], key=lambda x: x[0])
         self.postings = postings
 
+        self.positions = self.token_base = self.token_starts = self.token_ends = None
+        if with_positions:
+            # 値が収まるなら 2 バイト、収まらなければ 4 バイトの配列にする
+            code = "H" if max([len(starts), *ends, 0]) < 2 ** 16 else "I"
+            self.token_starts = array(code, starts)
+            self.token_ends = array(code, ends)
+            self.token_base = array("I", [0])
+            for n in self.doc_lens[:-1]:
+                self.token_base.append(self.token_base[-1] + n)
+
+            # postings と同じ doc_id 順に、区切り + 位置を 1 本の配列に詰める
+            self.positions = {}
+            for term, pos_lists in doc_positions.items():
+                offsets, flat = [0], []
+                for pos_list in pos_lists:
+                    flat.extend(pos_list)
+                    offsets.append(len(flat))
+                self.positions[term] = array(code, offsets + flat)
+
+    # ------------------------------------------------------------
+    # トークン位置（フレーズ・近接・スニペット）
+    # ------------------------------------------------------------
+
+    def has_positions(self) -> bool:
+        return getattr(self, "positions", None) is not None
+
+    def doc_positions(self, term, doc_id):
+        """term が doc_id に出てくるトークン番号（昇順）。無ければ空"""
+        plist = self.postings.get(term)
+        if not plist:
+            return ()
+        i = bisect_left(plist, doc_id, key=itemgetter(0))
+        if i == len(plist) or plist[i][0] != doc_id:
+            return ()
+        packed = self.positions[term]
+        head = len(plist) + 1
+        return packed[head + packed[i]:head + packed[i + 1]]
+
+    def phrase_count(self, doc_id, terms) -> int:
+        """terms がこの順に連続して出てくる回数"""
+        if not terms:
+            return 0
+        later = [set(self.doc_positions(t, doc_id)) for t in terms[1:]]
+        return sum(1 for p in self.doc_positions(terms[0], doc_id)
+                   if all(p + i + 1 in s for i, s in enumerate(later)))
+
+    def adjacent_pair_ratio(self, doc_id, terms) -> float:
+        """クエリの隣り合うトークン対のうち、文書でも隣り合って出てくる対の割合（部分フレーズの一致度）"""
+        if len(terms) < 2:
+            return 0.0
+        pos = {t: self.doc_positions(t, doc_id) for t in set(terms)}
+        hits = 0
+        for a, b in zip(terms, terms[1:]):
+            if pos[a] and pos[b]:
+                following = set(pos[b])
+                hits += any(p + 1 in following for p in pos[a])
+        return hits / (len(terms) - 1)
+
+    def min_window(self, doc_id, terms):
+        """
+        文書に出てくるクエリ語（異なり）をすべて含む最短のトークン区間の長さと、その語数。
+        2 語未満しか出てこなければ (None, 語数)
+        """
+        events = []
+        for k, t in enumerate(dict.fromkeys(terms)):
+            events.extend((p, k) for p in self.doc_positions(t, doc_id))
+        present = len({k for _, k in events})
+        if present < 2:
+            return None, present
+        events.sort()
+
+        best = None
+        counts = Counter()
+        left = 0
+        for right, (pos, k) in enumerate(events):
+            counts[k] += 1
+            while len(counts) == present:
+                width = pos - events[left][0] + 1
+                best = width if best is None else min(best, width)
+                lk = events[left][1]
+                counts[lk] -= 1
+                if counts[lk] == 0:
+                    del counts[lk]
+                left += 1
+        return best, present
+
+    def positional_rerank(self, query_terms, ranked, phrase_boost=0.5, proximity_boost=0.3):
+        """
+        BM25 の (doc_id, score) を、部分フレーズの一致と近接度で掛け算して並べ直す。
+        score * (1 + phrase_boost * 隣接対の一致率 + proximity_boost * 語数 / 最短区間)
+        """
+        if not self.has_positions():
+            return ranked
+        rescored = []
+        for doc_id, score in ranked:
+            if score > 0:
+                window, present = self.min_window(doc_id, query_terms)
+                proximity = present / window if window else 0.0
+                score *= 1.0 + phrase_boost * self.adjacent_pair_ratio(doc_id, query_terms) \
+                    + proximity_boost * proximity
+            rescored.append((doc_id, score))
+        rescored.sort(key=lambda x: (-x[1], x[0]))
+        return rescored
+
+    def snippet(self, doc_id, text, query_terms, width=120):
+        """
+        クエリ語がいちばん多く入る width 文字の区間を切り出す（文書の再解析はしない）。
+
+        Returns:
+            (スニペット文字列, [(start, end), ...] スニペット内のハイライト位置)
+        """
+        hits = []
+        if self.has_positions():
+            base = self.token_base[doc_id]
+            for t in set(query_terms):
+                hits.extend((self.token_starts[base + p], self.token_ends[base + p])
+                            for p in self.doc_positions(t, doc_id))
+        # 連続するハイライトは 1 つにまとめ（「冬の大三角」）、助詞 1 文字だけのものは落とす
+        merged = []
+        for s, e in sorted(h for h in hits if h[1] > h[0]):
+            if merged and s <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(e, merged[-1][1]))
+            else:
+                merged.append((s, e))
+        hits = [(s, e) for s, e in merged if not _PARTICLE.match(text[s:e])]
+        if not hits:
+            return text[:width].replace("\n", " "), []
+
+        # width 文字に収まるハイライトが最多になる区間（同数なら前の方）
+        best_i, best_j, j = 0, 1, 0
+        for i in range(len(hits)):
+            j = max(j, i + 1)
+            while j < len(hits) and hits[j][1] - hits[i][0] <= width:
+                j += 1
+            if j - i > best_j - best_i:
+                best_i, best_j = i, j
+
+        span_start, span_end = hits[best_i][0], hits[best_j - 1][1]
+        start = max(0, span_start - max(0, width - (span_end - span_start)) // 2)
+        end = min(len(text), start + width)
+        start = max(0, end - width)
+        highlights = [(s - start, e - start) for s, e in hits if s >= start and e <= end]
+        return text[start:end].replace("\n", " "), highlights
+
     def bm25(self, query_terms, k1=1.5, b=0.75):
         """BM25スコアを計算"""
         scores = {doc_id: 0.0 for doc_id in range(self.doc_count)}
@@ -144,9 +376,9 @@ class InvertedIndexArray:
 
         return scores
 
-    def bm25_search(self, query, topk=10):
+    def bm25_search(self, query, topk=10, tokenizer=tokenize_ja):
         """クエリ文字列を入力して上位文書を返す（doc_id, score のリスト）"""
-        terms = tokenize_ja(query)
+        terms = tokenizer(query)
         scores = self.bm25(terms)
         ranked = sorted(scores.items(), key=lambda x: x[1], reverse=True)
         return ranked[:topk]
@@ -183,16 +415,31 @@ def build_constellation_index():
     docs_list = list(docs.values())
 
     index = InvertedIndexArray()
-    index.build(docs_list)
+    index.build(docs_list, with_positions=True)
+
+    # MeCab を使わない文字 n-gram 版も同じ docs_list から作っておく
+    ngram_index = InvertedIndexArray()
+    ngram_index.build(docs_list, tokenizer=tokenize_ngram)
+
+    # index_registry が mmap で開ける圧縮版
+    from .bm25_compressed import CompressedInvertedIndex
+    compressed = CompressedInvertedIndex.from_index(index)
+
+    def write(out_dir: Path):
+        # 授業ノートと同じように4ファイルに分けて保存
+        joblib.dump(index, out_dir / "bm25_index.joblib")
+        joblib.dump(docs_list, out_dir / "docs.joblib")
+        joblib.dump(keys, out_dir / "keys.joblib")
+        joblib.dump(titles, out_dir / "titles.joblib")
+        joblib.dump(ngram_index, out_dir / "bm25_ngram_index.joblib")
+        joblib.dump(compressed, out_dir / "bm25_compressed.joblib")
 
-    # 授業ノートと同じように4ファイルに分けて保存
-    joblib.dump(index, INDEX_DIR / "bm25_index.joblib")
-    joblib.dump(docs_list, INDEX_DIR / "docs.joblib")
-    joblib.dump(keys, INDEX_DIR / "keys.joblib")
-    joblib.dump(titles, INDEX_DIR / "titles.joblib")
+    # 新しい版として書き切ってから CURRENT を切り替える（動いている検索は次の確認で差し替える）
+    from .index_versions import publish_version
+    version = publish_version(write, INDEX_DIR, meta={"builder": "constellation_bm25_build", "docs": len(docs)})
 
     print(f"✅ Indexed {len(docs)} constellations")
-    print(f"📦 Saved to {INDEX_DIR.resolve()}")
+    print(f"📦 Saved to {(INDEX_DIR / 'versions' / version).resolve()} (CURRENT -> {version})")
 
 
 # ================================================================
@@ -200,10 +447,12 @@ def build_constellation_index():
 # ================================================================
 
 def test_bm25():
-    index = joblib.load(INDEX_DIR / "bm25_index.joblib")
-    docs_list = joblib.load(INDEX_DIR / "docs.joblib")
-    keys = joblib.load(INDEX_DIR / "keys.joblib")
-    titles = joblib.load(INDEX_DIR / "titles.joblib")
+    from .index_versions import resolve_dir
+    index_dir = resolve_dir(INDEX_DIR)
+    index = joblib.load(index_dir / "bm25_index.joblib")
+    docs_list = joblib.load(index_dir / "docs.joblib")
+    keys = joblib.load(index_dir / "keys.joblib")
+    titles = joblib.load(index_dir / "titles.joblib")
 
     query = "冬の明るい星が目立つ星座"
     results = index.bm25_search(query, topk=5)
@@ -219,7 +468,7 @@ def test_bm25():
 
 
 if __name__ == "__main__":
-    # ① インデックスを作成（毎回上書きでOK）
+    # ① インデックスを作成（毎回新しい版として公開する）
     build_constellation_index()
 
     # ② 簡単なBM25テスト
@@ -4,16 +4,25 @@
 
 from pathlib import Path
 import os
+import time
 import joblib
-from openai import OpenAI
-from .constellation_bm25_build import InvertedIndexArray
+from .constellation_bm25_build import InvertedIndexArray, tokenize_ja, tokenize_ngram
+from .openai_client import get_openai_client
+from .llm_usage import get_usage_tracker
+from .singleflight import coalesce
+from .llm_scheduler import get_scheduler
 from dotenv import load_dotenv
-from config import PROJECT_ROOT, INDEX_DIR, VECTOR_STORE_ID
+from .bm25_sharded import ShardedInvertedIndex
+from .bm25_compressed import CompressedInvertedIndex
+from .index_versions import VersionedIndex
+from config import (PROJECT_ROOT, INDEX_DIR, VECTOR_STORE_ID,
+                    BM25_SHARDS, BM25_SHARD_EXECUTOR, BM25_POSTINGS_FORMAT, BM25_ANALYZER,
+                    BM25_PHRASE_BOOST, BM25_PROXIMITY_BOOST, SNIPPET_WIDTH)
+import re
 import sys
 
 
 load_dotenv(dotenv_path=PROJECT_ROOT / ".env")
-client = OpenAI()
 
 if __name__ != "__main__":
     # InvertedIndexArrayクラスを現在の実行環境の__main__に一時的に追加
@@ -23,36 +32,147 @@ if __name__ != "__main__":
 # BM25 インデックスのロード
 # =========================
 
-bm25_index = joblib.load(INDEX_DIR / "bm25_index.joblib")   # InvertedIndexArray
-docs_list  = joblib.load(INDEX_DIR / "docs.joblib")         # List[str] index_text
-keys       = joblib.load(INDEX_DIR / "keys.joblib")         # List[str] "Orion" など
-titles     = joblib.load(INDEX_DIR / "titles.joblib")       # dict[id] -> jp_name
+class SearchIndex:
+    """
+    1 つの版の成果物（index_versions が管理するディレクトリ 1 つ分）から作った検索用のインデックス一式。
+    検索中に版が差し替わっても混ざらないように、検索関数は 1 回の検索で同じ SearchIndex だけを使う。
+    """
+
+    def __init__(self, index_dir: Path):
+        self.bm25_index = joblib.load(index_dir / "bm25_index.joblib")   # InvertedIndexArray
+        self.docs_list = joblib.load(index_dir / "docs.joblib")          # List[str] index_text
+        self.keys = joblib.load(index_dir / "keys.joblib")               # List[str] "Orion" など
+        self.titles = joblib.load(index_dir / "titles.joblib")           # dict[id] -> jp_name
+
+        # フレーズ・近接スコアとスニペット用のトークン位置付きインデックス
+        # （位置なしで保存された古いインデックスなら、読み込み時に docs_list から一度だけ作る）
+        if self.bm25_index.has_positions():
+            self.positional_index = self.bm25_index
+        else:
+            self.positional_index = InvertedIndexArray()
+            self.positional_index.build(self.docs_list, with_positions=True)
+
+        # シャードモード：同じ bm25_search を持つシャード版に置き換える
+        # 圧縮モード：ビルド時に書き出した圧縮版（bm25_compressed.joblib）を mmap で開く
+        #   （無い古いインデックスだけ、ここで postings を delta + varint の圧縮形式に変換する。
+        #    python -m src.index_registry --compact で書き出しておける）
+        if BM25_SHARDS > 1:
+            self.bm25_index = ShardedInvertedIndex.from_index(self.bm25_index, n_shards=BM25_SHARDS,
+                                                              executor=BM25_SHARD_EXECUTOR)
+        elif BM25_POSTINGS_FORMAT == "compressed":
+            compressed_path = index_dir / "bm25_compressed.joblib"
+            if compressed_path.exists():
+                self.bm25_index = joblib.load(compressed_path, mmap_mode="r")
+            else:
+                print(f"⚠️ {compressed_path} が無いので圧縮形式にその場で変換します")
+                self.bm25_index = CompressedInvertedIndex.from_index(self.bm25_index)
+
+        # 文字 n-gram 版（ビルド済みのものが無ければ docs_list からその場で作る）
+        ngram_path = index_dir / "bm25_ngram_index.joblib"
+        if ngram_path.exists():
+            self.ngram_index = joblib.load(ngram_path)
+        else:
+            self.ngram_index = InvertedIndexArray()
+            self.ngram_index.build(self.docs_list, tokenizer=tokenize_ngram)
+
+        # id -> doc_id の逆引きテーブル
+        self.id2doc_id = {cid: i for i, cid in enumerate(self.keys)}
+
+    def close(self):
+        """差し替えで使われなくなったときに呼ばれる（シャード版の並列プールを止める）"""
+        if isinstance(self.bm25_index, ShardedInvertedIndex):
+            self.bm25_index.close()
+
+
+# CURRENT が指す版を読み込み、新しい版が公開されたら検索を止めずに差し替える
+_versioned = VersionedIndex(SearchIndex, INDEX_DIR)
+
 
-# id -> doc_id の逆引きテーブル
-id2doc_id = {cid: i for i, cid in enumerate(keys)}
+def get_versioned_index() -> VersionedIndex:
+    return _versioned
+
+
+def get_index_version() -> str:
+    """いま検索に使っているインデックスの版（版ごとのキャッシュのキーに入れる）"""
+    _versioned.maybe_refresh()
+    return _versioned.version
+
+
+def __getattr__(name: str):
+    # 以前のモジュール変数（bm25_index, docs_list, keys, ...）は、いまの版のものを返す
+    if name in ("bm25_index", "docs_list", "keys", "titles", "positional_index", "ngram_index", "id2doc_id"):
+        return getattr(_versioned.index, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 # =========================
 # BM25 検索
 # =========================
 
-def search_constellations_bm25(query: str, k: int = 10):
+def _bm25_doc_ids(query: str, k: int, analyzer: str, index: SearchIndex = None):
+    """アナライザごとの BM25 検索（doc_id, score のリスト）。index を省くといまの版で引く"""
+    if index is None:
+        with _versioned.acquire() as index:
+            return _bm25_doc_ids(query, k, analyzer, index)
+    bm25_index, ngram_index = index.bm25_index, index.ngram_index
+    if analyzer == "ngram":
+        return ngram_index.bm25_search(query, topk=k, tokenizer=tokenize_ngram)
+    if analyzer == "fused":
+        # 形態素版と n-gram 版の順位を RRF で合わせる（スコアは RRF スコア）
+        fused = {}
+        for ranked in (bm25_index.bm25_search(query, topk=k),
+                       ngram_index.bm25_search(query, topk=k, tokenizer=tokenize_ngram)):
+            for rank, (doc_id, score) in enumerate(ranked, start=1):
+                if score > 0:
+                    fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (60 + rank)
+        return sorted(fused.items(), key=lambda x: (-x[1], x[0]))[:k]
+    return bm25_index.bm25_search(query, topk=k)
+
+
+_QUOTED = re.compile(r'["“”]([^"“”]+)["“”]')
+
+
+def search_constellations_bm25(query: str, k: int = 10, analyzer: str = None, index: SearchIndex = None):
     """
-    BM25 だけで検索して、id / jp_name / score / snippet を返す。
+    BM25 だけで検索して、id / jp_name / score / snippet / highlights を返す。
+    analyzer は "mecab" / "ngram" / "fused"（省略時は config.BM25_ANALYZER）。
+    index を省くといまの版で引く（ベクトル検索と同じ版で引くときは acquire した index を渡す）。
+
+    - クエリ語が隣り合って・近くに出てくる文書ほどスコアを上げる（トークン位置を使用）
+    - "冬の大三角" のように引用符で囲んだ部分は、その並びで出てくる文書だけに絞る
+    - snippet はクエリ語が多く入る区間、highlights はその中のクエリ語の (start, end)
     """
-    results = bm25_index.bm25_search(query, topk=k)
+    if index is not None:
+        return _search_bm25(index, query, k, analyzer)
+    with _versioned.acquire() as index:
+        return _search_bm25(index, query, k, analyzer)
+
+
+def _search_bm25(index: SearchIndex, query: str, k: int, analyzer: str):
+    positional_index, keys, titles, docs_list = index.positional_index, index.keys, index.titles, index.docs_list
+    phrases = [tokenize_ja(p) for p in _QUOTED.findall(query)]
+    query = _QUOTED.sub(lambda m: m.group(1), query)
+    terms = tokenize_ja(query)
+
+    results = _bm25_doc_ids(query, k * 2, analyzer or BM25_ANALYZER, index)
+    if phrases:
+        results = [(doc_id, score) for doc_id, score in results
+                   if all(positional_index.phrase_count(doc_id, p) for p in phrases)]
+    if BM25_PHRASE_BOOST or BM25_PROXIMITY_BOOST:
+        results = positional_index.positional_rerank(terms, results, BM25_PHRASE_BOOST, BM25_PROXIMITY_BOOST)
 
     out = []
-    for doc_id, score in results:
+    for doc_id, score in results[:k]:
         cid = keys[doc_id]
         jp_name = titles.get(cid, cid)
-        snippet = docs_list[doc_id][:120].replace("\n", "")
+        snippet, highlights = positional_index.snippet(doc_id, docs_list[doc_id], terms, SNIPPET_WIDTH)
         out.append(
             {
                 "id": cid,
                 "jp_name": jp_name,
                 "score": float(score),
                 "snippet": snippet,
+                "highlights": highlights,
             }
         )
     return out
@@ -62,18 +182,40 @@ def search_constellations_bm25(query: str, k: int = 10):
 # ベクトル検索（Vector Store）
 # =========================
 
-def search_constellations_vec(query: str, k: int = 10):
+def search_constellations_vec(query: str, k: int = 10, index: SearchIndex = None):
     """
     OpenAI Vector Store に対して semantic search。
     constellation_vec_upload.py で attributes["filename"] = id を入れている前提。
+    同じ (query, k) の API 呼び出しが実行中なら、その結果を待って使う。
+    結果の jp_name / snippet は index（省略時はいまの版）から引く。
     """
-    res = client.vector_stores.search(
-        vector_store_id=VECTOR_STORE_ID,
-        query=query,
-        max_num_results=k,
-        # rewrite_query=False  # 必要なら明示的に
-    )
+    res = coalesce("vector_search", (VECTOR_STORE_ID, query, k), _search_constellations_vec, query, k)
+    if index is not None:
+        return _vec_results(index, res, k)
+    with _versioned.acquire() as index:
+        return _vec_results(index, res, k)
+
+
+def _search_constellations_vec(query: str, k: int):
+    """Vector Store の API 呼び出し（相乗りの単位。戻り値は共有されるので書き換えないこと）"""
+    def call():
+        start = time.perf_counter()
+        res = get_openai_client().vector_stores.search(
+            vector_store_id=VECTOR_STORE_ID,
+            query=query,
+            max_num_results=k,
+            # rewrite_query=False  # 必要なら明示的に
+        )
+        # トークンの usage は返らないのでレイテンシだけ記録
+        get_usage_tracker().record("vector_search", None, time.perf_counter() - start)
+        return res
+
+    # クエリの埋め込み分だけ TPM を見積もる
+    return get_scheduler().run("vector_search", call, est_tokens=len(query))
+
 
+def _vec_results(index: SearchIndex, res, k: int):
+    id2doc_id, titles, docs_list = index.id2doc_id, index.titles, index.docs_list
     out = []
 
     for item in res.data[:k]:
@@ -162,12 +304,15 @@ def reciprocal_rank_fusion(bm25_results, vec_results, rrf_k: int = 60):
     return merged_list
 
 
-def hybrid_search_constellations(query: str, k_bm25: int = 20, k_vec: int = 20, topk: int = 10):
+def hybrid_search_constellations(query: str, k_bm25: int = 20, k_vec: int = 20, topk: int = 10,
+                                 analyzer: str = None):
     """
     BM25 + ベクトル検索を RRF でマージして上位 topk を返す。
+    途中で版が差し替わっても混ざらないように、両方とも同じ版（1 回の acquire）で引く。
     """
-    bm25_results = search_constellations_bm25(query, k=k_bm25)
-    vec_results = search_constellations_vec(query, k=k_vec)
+    with _versioned.acquire() as index:
+        bm25_results = search_constellations_bm25(query, k=k_bm25, analyzer=analyzer, index=index)
+        vec_results = search_constellations_vec(query, k=k_vec, index=index)
     merged = reciprocal_rank_fusion(bm25_results, vec_results, rrf_k=60)
     return merged[:topk]
 
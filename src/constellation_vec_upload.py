@@ -1,19 +1,23 @@
 # constellation_vec_upload.py
 # 星座 88 件を OpenAI Vector Store にアップロードするだけのスクリプト
 # BM25 部分には一切触らない
+#
+# 使い方（プロジェクトのルートで。共有クライアントを使うのでパッケージとして実行する）:
+#     python -m src.constellation_vec_upload
 
 from pathlib import Path
-import os
 import joblib
-from openai import OpenAI
 
-# === API キーを環境変数から取得 ===
-api_key = os.environ["OPENAI_API_KEY"]  # 設定されていないと KeyError になります
-client = OpenAI(api_key=api_key)
+from config import INDEX_DIR as INDEX_ROOT
+from .openai_client import get_openai_client
+from .index_versions import resolve_dir
+
+# === 共有クライアントを取得（APIキーが設定されていないと ValueError になります） ===
+client = get_openai_client()
 
 # === パス設定 ===
 PROJECT_ROOT = Path(__file__).resolve().parent
-INDEX_DIR = PROJECT_ROOT / "index_constellation"
+INDEX_DIR = resolve_dir(INDEX_ROOT)  # CURRENT が指す版（版が無ければ INDEX_DIR 直下）
 TMP_DIR = PROJECT_ROOT / "vs_constellation_files"
 TMP_DIR.mkdir(exist_ok=True)
 
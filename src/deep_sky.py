@@ -0,0 +1,442 @@
+"""
+SkyLore - 星雲・星団・銀河（メシエ天体）のカタログモジュール
+同梱のカタログ（data/deep_sky.csv）を列ごとの NumPy 配列で持ち、
+
+- 等級・赤経・赤緯: 値で並べた索引（searchsorted で範囲を切り出す）
+- 種類・所属する星座・見頃の月: 値ごとのビットマップ索引
+
+を作っておく。「冬に見える明るい星雲」のようなクエリは parse_query() で
+文字列の部分と数値の条件に分け、条件のビット集合を先に AND してから、
+残った候補だけを BM25 で採点する。結果は constellation_data_with_keywords.json の星座に紐づける。
+"""
+import argparse
+import csv
+import json
+import math
+import re
+import time
+from pathlib import Path
+
+import numpy as np
+
+from config import (
+    CONSTELLATION_DATA_PATH,
+    DEEP_SKY_CATALOGUE_PATH,
+    DEEP_SKY_BRIGHT_MAG,
+    DEEP_SKY_NAKED_EYE_MAG,
+    DEFAULT_OBSERVER_LAT,
+    SEASON_TO_MONTHS,
+)
+from .constellation_bm25_build import InvertedIndexArray, tokenize_ja
+
+# 種類 -> (表示名, 検索用の語)
+TYPE_LABELS = {
+    "galaxy": ("銀河", "銀河 系外銀河"),
+    "globular_cluster": ("球状星団", "球状星団 星団"),
+    "open_cluster": ("散開星団", "散開星団 星団"),
+    "emission_nebula": ("散光星雲", "散光星雲 星雲 ガス"),
+    "reflection_nebula": ("反射星雲", "反射星雲 星雲"),
+    "planetary_nebula": ("惑星状星雲", "惑星状星雲 星雲"),
+    "supernova_remnant": ("超新星残骸", "超新星残骸 星雲"),
+    "star_cloud": ("スタークラウド", "スタークラウド 天の川"),
+    "double_star": ("二重星", "二重星"),
+    "asterism": ("星群", "星群"),
+}
+TYPES = list(TYPE_LABELS)
+
+# クエリ中の語 -> 種類（長い語から先に照合する）
+_TYPE_WORDS = [
+    ("惑星状星雲", {"planetary_nebula"}),
+    ("超新星残骸", {"supernova_remnant"}),
+    ("球状星団", {"globular_cluster"}),
+    ("散開星団", {"open_cluster"}),
+    ("散光星雲", {"emission_nebula"}),
+    ("反射星雲", {"reflection_nebula"}),
+    ("銀河", {"galaxy"}),
+    ("星雲", {"emission_nebula", "reflection_nebula", "planetary_nebula", "supernova_remnant"}),
+    ("星団", {"globular_cluster", "open_cluster"}),
+    ("二重星", {"double_star"}),
+]
+_MAG_PATTERN = re.compile(r"(\d+(?:\.\d+)?)\s*等(?:級)?(?:星)?\s*(?:より明るい|以下|まで|以内|よりも明るい)")
+_MONTH_PATTERN = re.compile(r"(1[0-2]|[1-9])\s*月")
+_PARTICLE = re.compile(r"[ぁ-ん]")   # 「の」「に」などの 1 文字の助詞は採点に使わない
+
+_MONTH_NAMES = {m: s for s, months in SEASON_TO_MONTHS.items() for m in months}
+
+
+# ================================================================
+# ビット集合（np.packbits した uint8 配列）
+# ================================================================
+
+def _bits_from_idx(idx, n: int) -> np.ndarray:
+    mask = np.zeros(n, dtype=bool)
+    mask[idx] = True
+    return np.packbits(mask)
+
+
+def _bits_to_idx(bits: np.ndarray, n: int) -> np.ndarray:
+    return np.flatnonzero(np.unpackbits(bits, count=n))
+
+
+def _union(bit_sets: list, n: int) -> np.ndarray:
+    out = np.zeros((n + 7) // 8, dtype=np.uint8)
+    for bits in bit_sets:
+        out |= bits
+    return out
+
+
+class _SortedIndex:
+    """1 列を値で並べた索引（範囲 [lo, hi] の行番号をビット集合で返す）"""
+
+    def __init__(self, values: np.ndarray):
+        self.order = np.argsort(values, kind="stable")
+        self.sorted = values[self.order]
+        self.n = len(values)
+
+    def range_bits(self, lo: float = None, hi: float = None) -> np.ndarray:
+        start = 0 if lo is None else int(np.searchsorted(self.sorted, lo, side="left"))
+        end = self.n if hi is None else int(np.searchsorted(self.sorted, hi, side="right"))
+        return _bits_from_idx(self.order[start:end], self.n)
+
+
+class DeepSkyCatalogue:
+    """
+    星雲・星団・銀河のカタログ（列ごとの NumPy 配列 + 範囲索引 + ビットマップ索引 + BM25）
+
+    constellation_months を渡すと、所属する星座の見頃の月をその天体の見頃とみなす。
+    """
+
+    def __init__(self, rows: list, constellation_months: dict | None = None,
+                 constellation_names: dict | None = None, tokenizer=tokenize_ja):
+        constellation_months = constellation_months or {}
+        self.constellation_names = constellation_names or {}
+        self.ids = [r["id"] for r in rows]
+        self.ngc = [r.get("ngc", "") for r in rows]
+        self.names = [r.get("name", "") for r in rows]
+        self.jp_names = [r.get("jp_name", "") for r in rows]
+        self.ra_deg = np.asarray([float(r["ra_deg"]) for r in rows], dtype=np.float64)
+        self.dec_deg = np.asarray([float(r["dec_deg"]) for r in rows], dtype=np.float64)
+        self.vmag = np.asarray([float(r["vmag"]) for r in rows], dtype=np.float32)
+        self.type_code = np.asarray([TYPES.index(r["type"]) for r in rows], dtype=np.int8)
+        self.constellation_ids = sorted({r["constellation"] for r in rows})
+        con_index = {cid: i for i, cid in enumerate(self.constellation_ids)}
+        self.constellation = np.asarray([con_index[r["constellation"]] for r in rows], dtype=np.int16)
+        n = len(rows)
+
+        # 範囲索引
+        self._by_mag = _SortedIndex(self.vmag)
+        self._by_ra = _SortedIndex(self.ra_deg)
+        self._by_dec = _SortedIndex(self.dec_deg)
+
+        # ビットマップ索引
+        self._type_bits = {t: _bits_from_idx(np.flatnonzero(self.type_code == i), n)
+                           for i, t in enumerate(TYPES)}
+        self._con_bits = {cid: _bits_from_idx(np.flatnonzero(self.constellation == i), n)
+                          for cid, i in con_index.items()}
+        months = [set(constellation_months.get(r["constellation"], ())) for r in rows]
+        self._month_bits = {m: _bits_from_idx([i for i, ms in enumerate(months) if m in ms], n)
+                            for m in range(1, 13)}
+        self._all_bits = np.packbits(np.ones(n, dtype=bool))
+
+        # 文字列の部分（名前・種類・星座名・季節）の BM25
+        self.months = months
+        self.text_index = InvertedIndexArray()
+        self.text_index.build([self._doc_text(i) for i in range(n)], tokenizer=tokenizer)
+        self._tokenizer = tokenizer
+
+    @classmethod
+    def load(cls, path: str | Path = DEEP_SKY_CATALOGUE_PATH,
+             constellation_path: str | Path = CONSTELLATION_DATA_PATH):
+        """CSV（id, ngc, name, jp_name, type, ra_deg, dec_deg, vmag, constellation）と星座データから作る"""
+        with Path(path).open("r", encoding="utf-8", newline="") as f:
+            rows = list(csv.DictReader(f))
+        with Path(constellation_path).open("r", encoding="utf-8") as f:
+            constellations = json.load(f)
+        return cls(rows,
+                   constellation_months={c["id"]: c.get("best_months", []) for c in constellations},
+                   constellation_names={c["id"]: c.get("jp_name", c["id"]) for c in constellations})
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _doc_text(self, i: int) -> str:
+        cid = self.constellation_ids[self.constellation[i]]
+        seasons = sorted({_MONTH_NAMES[m] for m in self.months[i]})
+        return " ".join([self.ids[i], self.ngc[i], self.names[i], self.jp_names[i],
+                         TYPE_LABELS[TYPES[self.type_code[i]]][1],
+                         self.constellation_names.get(cid, cid), *seasons])
+
+    def display_name(self, i: int) -> str:
+        return f"{self.jp_names[i]}（{self.ids[i]}）" if self.jp_names[i] else self.ids[i]
+
+    def object(self, i: int) -> dict:
+        """1 天体分の情報（所属する星座へのリンク付き）"""
+        cid = self.constellation_ids[self.constellation[i]]
+        return {
+            "id": self.ids[i],
+            "ngc": self.ngc[i],
+            "name": self.names[i],
+            "jp_name": self.jp_names[i],
+            "display_name": self.display_name(i),
+            "type": TYPES[self.type_code[i]],
+            "type_jp": TYPE_LABELS[TYPES[self.type_code[i]]][0],
+            "ra_deg": float(self.ra_deg[i]),
+            "dec_deg": float(self.dec_deg[i]),
+            "vmag": round(float(self.vmag[i]), 2),
+            "constellation": {"id": cid, "jp_name": self.constellation_names.get(cid, cid)},
+            "best_months": sorted(self.months[i]),
+        }
+
+    # ------------------------------------------------------------
+    # 絞り込み（ビット集合）
+    # ------------------------------------------------------------
+
+    def filter_bits(self, mag_min: float = None, mag_max: float = None, types=None, constellations=None,
+                    months=None, ra_range: tuple = None, dec_range: tuple = None) -> np.ndarray:
+        """
+        条件すべてを満たす天体のビット集合。
+        types / constellations / months はそれぞれの中では OR、条件どうしは AND。
+        ra_range は (lo, hi) で、lo > hi なら 0 度をまたぐ範囲とみなす。
+        """
+        n = len(self)
+        bits = self._all_bits.copy()
+        if mag_min is not None or mag_max is not None:
+            bits &= self._by_mag.range_bits(mag_min, mag_max)
+        if types:
+            bits &= _union([self._type_bits[t] for t in types if t in self._type_bits], n)
+        if constellations:
+            bits &= _union([self._con_bits[c] for c in constellations if c in self._con_bits], n)
+        if months:
+            bits &= _union([self._month_bits[m] for m in months if m in self._month_bits], n)
+        if ra_range is not None:
+            lo, hi = ra_range
+            if lo <= hi:
+                bits &= self._by_ra.range_bits(lo, hi)
+            else:
+                bits &= self._by_ra.range_bits(lo, None) | self._by_ra.range_bits(None, hi)
+        if dec_range is not None:
+            bits &= self._by_dec.range_bits(*dec_range)
+        return bits
+
+    def objects_in_constellation(self, constellation_id: str, limit: int = None) -> list:
+        """その星座に属する天体（明るい順）"""
+        bits = self._con_bits.get(constellation_id)
+        if bits is None:
+            return []
+        idx = _bits_to_idx(bits, len(self))
+        idx = idx[np.argsort(self.vmag[idx], kind="stable")][:limit]
+        return [self.object(i) for i in idx.tolist()]
+
+    # ------------------------------------------------------------
+    # 文字列 + 条件の検索
+    # ------------------------------------------------------------
+
+    def _bm25_candidates(self, terms: list, candidates: np.ndarray, k1: float = 1.5, b: float = 0.75) -> dict:
+        """候補（行番号の bool 配列）に入っている文書だけを BM25 で採点する"""
+        index = self.text_index
+        scores = {}
+        for term in terms:
+            if _PARTICLE.fullmatch(term):
+                continue
+            plist = index.postings.get(term)
+            if not plist:
+                continue
+            df = len(plist)
+            idf = math.log((index.doc_count - df + 0.5) / (df + 0.5) + 1)
+            for doc_id, tf in plist:
+                if candidates[doc_id]:
+                    dl = index.doc_lens[doc_id]
+                    denom = tf + k1 * (1 - b + b * dl / index.avgdl)
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * (tf * (k1 + 1)) / denom
+        return scores
+
+    def search(self, text: str = "", top_k: int = 10, **filters) -> list:
+        """
+        filters で絞った候補を text の BM25 で並べる（同点・一致なしは明るい順）。
+        text に一致しなかった候補も、条件を満たしていれば明るい順に後ろに並ぶ。
+        """
+        n = len(self)
+        mask = np.unpackbits(self.filter_bits(**filters), count=n).astype(bool)
+        idx = np.flatnonzero(mask)
+        if len(idx) == 0:
+            return []
+        scores = self._bm25_candidates(self._tokenizer(text), mask) if text else {}
+        ranked = sorted(idx.tolist(), key=lambda i: (-scores.get(i, 0.0), float(self.vmag[i])))
+        return [dict(self.object(i), score=scores.get(i, 0.0)) for i in ranked[:top_k]]
+
+    def parse_query(self, query: str) -> tuple:
+        """
+        クエリを (文字列の部分, 条件の dict) に分ける。
+        例: 「冬に見える明るい星雲」-> ("に見える", {"months": [12, 1, 2], "mag_max": 7.0, "types": [...]})
+        """
+        text = query
+        filters = {}
+
+        types = set()
+        for word, word_types in _TYPE_WORDS:
+            if word in text:
+                types |= word_types
+                text = text.replace(word, " ")
+        if types:
+            filters["types"] = sorted(types)
+
+        constellations = [cid for cid, name in self.constellation_names.items()
+                          if name and name in text and cid in self._con_bits]
+        for cid in constellations:
+            text = text.replace(self.constellation_names[cid], " ")
+        if constellations:
+            filters["constellations"] = constellations
+
+        months = {int(m) for m in _MONTH_PATTERN.findall(text)}
+        text = _MONTH_PATTERN.sub(" ", text)
+        for season, season_months in SEASON_TO_MONTHS.items():
+            if season in text:
+                months |= set(season_months)
+                text = text.replace(season, " ")
+        if months:
+            filters["months"] = sorted(months)
+
+        mag = _MAG_PATTERN.search(text)
+        if mag:
+            filters["mag_max"] = float(mag.group(1))
+            text = _MAG_PATTERN.sub(" ", text)
+        elif "肉眼" in text:
+            filters["mag_max"] = DEEP_SKY_NAKED_EYE_MAG
+        elif "明るい" in text or "双眼鏡" in text:
+            filters["mag_max"] = DEEP_SKY_BRIGHT_MAG
+        text = text.replace("明るい", " ")
+
+        if "南天" in text:
+            filters["dec_range"] = (-90.0, 0.0)
+            text = text.replace("南天", " ")
+        elif "北天" in text:
+            filters["dec_range"] = (0.0, 90.0)
+            text = text.replace("北天", " ")
+        elif "日本" in text:
+            # 観測地で南の地平線から 10 度以上に上るもの
+            filters["dec_range"] = (DEFAULT_OBSERVER_LAT - 80.0, 90.0)
+
+        return re.sub(r"\s+", " ", text).strip(), filters
+
+    def mentioned(self, query: str) -> list:
+        """クエリに名前（和名・英名・M 番号）が出てくる天体の行番号"""
+        q = query.upper()
+        hits = []
+        for i in range(len(self)):
+            if (self.jp_names[i] and self.jp_names[i].split("（")[0] in query) \
+                    or (self.names[i] and self.names[i].upper() in q) \
+                    or re.search(rf"(?<![0-9A-Z]){self.ids[i]}(?![0-9])", q):
+                hits.append(i)
+        return hits
+
+    def _strip_names(self, query: str, rows: list) -> str:
+        """query から rows の天体の名前（和名・英名・M 番号）を取り除く"""
+        for i in rows:
+            for name in (self.jp_names[i] and self.jp_names[i].split("（")[0], self.names[i]):
+                if name:
+                    query = re.sub(re.escape(name), " ", query, flags=re.IGNORECASE)
+            query = re.sub(rf"(?<![0-9A-Z]){self.ids[i]}(?![0-9])", " ", query, flags=re.IGNORECASE)
+        return query
+
+    def query(self, query: str, top_k: int = 10) -> tuple:
+        """
+        parse_query してから search する。(結果, 条件) を返す。
+        名前や M 番号で直接言われた天体は（条件を満たしていれば）先頭に並べる。
+        条件が 1 つも無く名前だけで言われたとき（「M31」など）は、その天体だけを返す。
+        """
+        text, filters = self.parse_query(query)
+        mentioned = self.mentioned(query)
+        # 名前の中の語（「アンドロメダ銀河」の「銀河」など）は条件に数えない
+        if mentioned and not self.parse_query(self._strip_names(query, mentioned))[1]:
+            ranked = sorted(mentioned, key=lambda i: float(self.vmag[i]))
+            return [dict(self.object(i), score=0.0) for i in ranked[:top_k]], {}
+        results = self.search(text, top_k=len(self), **filters)
+        named = {self.ids[i] for i in mentioned}
+        results.sort(key=lambda r: r["id"] not in named)
+        return results[:top_k], filters
+
+
+_catalogue = None
+
+
+def get_deep_sky_catalogue() -> DeepSkyCatalogue | None:
+    """共有カタログを返す（カタログファイルが無ければ None）"""
+    global _catalogue
+    if _catalogue is None and Path(DEEP_SKY_CATALOGUE_PATH).exists():
+        _catalogue = DeepSkyCatalogue.load()
+    return _catalogue
+
+
+# ================================================================
+# ベンチマーク（合成カタログ）
+# ================================================================
+
+def make_synthetic_catalogue(n_objects: int, seed: int = 0) -> DeepSkyCatalogue:
+    """全天に一様に散らばった合成カタログ（文字列は空白区切りで分かち書きする）"""
+    rng = np.random.default_rng(seed)
+    ra = rng.uniform(0.0, 360.0, n_objects)
+    dec = np.degrees(np.arcsin(rng.uniform(-1.0, 1.0, n_objects)))
+    vmag = np.clip(4.0 + rng.exponential(3.0, n_objects), 1.0, 16.0)
+    types = rng.integers(0, len(TYPES), n_objects)
+    cons = [f"C{i:02d}" for i in range(88)]
+    months = {c: sorted(rng.choice(np.arange(1, 13), 3, replace=False).tolist()) for c in cons}
+    rows = [{"id": f"X{i}", "name": f"obj{i % 5000}", "jp_name": "", "type": TYPES[types[i]],
+             "ra_deg": ra[i], "dec_deg": dec[i], "vmag": vmag[i], "constellation": cons[i % 88]}
+            for i in range(n_objects)]
+    return DeepSkyCatalogue(rows, constellation_months=months, tokenizer=str.split)
+
+
+def _score_then_filter(cat: DeepSkyCatalogue, text: str, top_k: int, **filters) -> list:
+    """比較用: 全文書を BM25 で採点してから、行ごとに条件を確かめる"""
+    every = np.ones(len(cat), dtype=bool)
+    scores = cat._bm25_candidates(cat._tokenizer(text), every)
+    types = {TYPES.index(t) for t in filters.get("types", [])}
+    months = set(filters.get("months", []))
+    hits = [i for i in range(len(cat))
+            if cat.vmag[i] <= filters.get("mag_max", math.inf)
+            and (not types or cat.type_code[i] in types)
+            and (not months or cat.months[i] & months)]
+    return sorted(hits, key=lambda i: (-scores.get(i, 0.0), float(cat.vmag[i])))[:top_k]
+
+
+def benchmark(sizes=(10000, 100000), n_queries: int = 50, top_k: int = 10):
+    rng = np.random.default_rng(1)
+    for n in sizes:
+        start = time.perf_counter()
+        cat = make_synthetic_catalogue(n)
+        build_ms = (time.perf_counter() - start) * 1000
+        queries = [(f"obj{rng.integers(0, 5000)}",
+                    {"mag_max": float(rng.uniform(6.0, 9.0)),
+                     "types": [TYPES[rng.integers(0, 3)]],
+                     "months": [int(rng.integers(1, 13))]}) for _ in range(n_queries)]
+        print(f"\n=== objects={n} (build {build_ms:.0f} ms) ===")
+
+        ok = all([r["id"] for r in cat.search(t, top_k, **f)] ==
+                 [cat.ids[i] for i in _score_then_filter(cat, t, top_k, **f)] for t, f in queries[:5])
+        for label, fn in (("bitset -> score", lambda t, f: cat.search(t, top_k, **f)),
+                          ("score -> filter", lambda t, f: _score_then_filter(cat, t, top_k, **f))):
+            start = time.perf_counter()
+            for t, f in queries:
+                fn(t, f)
+            ms = (time.perf_counter() - start) * 1000 / n_queries
+            print(f"  {label:16s}: {ms:8.3f} ms/query {'OK' if ok else 'MISMATCH'}")
+
+        start = time.perf_counter()
+        for _, f in queries:
+            cat.filter_bits(**f)
+        print(f"  filter_bits only : {(time.perf_counter() - start) * 1000 / n_queries:8.3f} ms/query")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="星雲・星団・銀河のカタログ検索とベンチマーク")
+    parser.add_argument("--query", type=str, default="冬に見える明るい星雲")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    args = parser.parse_args()
+
+    catalogue = get_deep_sky_catalogue()
+    results, filters = catalogue.query(args.query)
+    print(f"カタログ: {len(catalogue)} 天体 / クエリ: {args.query} -> 条件 {filters}")
+    for r in results:
+        print(f"  {r['display_name']} {r['type_jp']} {r['vmag']:.1f}等 "
+              f"[{r['constellation']['jp_name']}] score={r['score']:.2f}")
+    benchmark(args.sizes)
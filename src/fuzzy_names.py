@@ -0,0 +1,245 @@
+"""
+SkyLore - 表記ゆれ・打ち間違いに強い星座名の引き当て（SymSpell 方式）
+「オリアン」「おりおん」「カシオペヤ」「オリオーン座」のような名前は、いまは LLM のクエリ拡張と
+ベクトル検索まで行って意図を取り戻している。ここでは和名・英名・keywords を
+
+- 正規化（NFKC・小文字・カタカナはひらがな・長音や中黒や末尾の「座」を除く・小書きのかなを並字に）
+- 正規化した語から最大 FUZZY_MAX_EDIT 文字を消した形をすべて前計算した削除索引
+
+に入れておき、入力も同じように削った形で索引を引いて、候補だけ編集距離を計算する。
+結果には編集距離と確信度が付き、確信できるものは ConstellationSearcher.search_name が
+クエリ拡張とベクトル検索を飛ばして直接返す。
+
+    python -m src.fuzzy_names --query オリアン カシオペヤ cygnas
+"""
+import argparse
+import json
+import random
+import re
+import time
+from itertools import combinations
+from pathlib import Path
+
+from config import CONSTELLATION_DATA_PATH, FUZZY_MAX_EDIT, FUZZY_CONFIDENCE
+from .typeahead import normalize_prefix
+
+# 小書きのかな -> 並字、ゔ -> ぶ（「ヴ」と「ブ」のゆれ）
+_KANA_FOLD = str.maketrans("ぁぃぅぇぉっゃゅょゎゕゖゔ", "あいうえおつやゆよわかけぶ")
+_IGNORED = re.compile(r"[ー〜~・･\-_.,、。'\"]")
+# 名前のあとによく付く言い回し（「オリオン座が見たい」の「が見たい」）
+_TRAILING = re.compile(r"(は|が|を|って|について)?(見たい|みたい|知りたい|しりたい|教えて|おしえて|どこ|どれ)?[?？!！。]*$")
+
+# 見出し語の種類ごとの重み（同じ距離の候補が並んだときの順）
+KIND_WEIGHTS = {"name": 1.0, "id": 0.9, "keyword": 0.5}
+
+
+def fold(text: str) -> str:
+    """表記ゆれを畳んだ形（引き当てのキー）"""
+    text = normalize_prefix(text).translate(_KANA_FOLD)
+    text = _IGNORED.sub("", text)
+    if len(text) > 1 and text.endswith("座"):
+        text = text[:-1]
+    return text
+
+
+def edit_distance(a: str, b: str, max_distance: int) -> int:
+    """
+    隣り合う 2 文字の入れ替えも 1 と数える編集距離（OSA）。
+    max_distance を超えると分かった時点で max_distance + 1 を返す。
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    prev2 = None
+    prev = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        cur = [i] + [0] * len(b)
+        row_min = cur[0]
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + cost)
+            if i > 1 and j > 1 and prev2 is not None and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                cur[j] = min(cur[j], prev2[j - 2] + 1)
+            row_min = min(row_min, cur[j])
+        if row_min > max_distance:
+            return max_distance + 1
+        prev2, prev = prev, cur
+    return prev[-1]
+
+
+def _deletes(term: str, max_edit: int) -> set:
+    """term から 1〜max_edit 文字を消した形（term 自身も含む）"""
+    out = {term}
+    for d in range(1, min(max_edit, len(term) - 1) + 1):
+        for idx in combinations(range(len(term)), d):
+            out.add("".join(ch for i, ch in enumerate(term) if i not in idx))
+    return out
+
+
+class FuzzyNameIndex:
+    """
+    add(surface, ids, kind) で見出し語を足して lookup(text) で引く。
+    見出し語は fold() した形で持ち、同じ形になる語は 1 つにまとめる。
+
+    lookup の結果は距離の小さい順・重い順の
+    {"surface", "ids", "kind", "distance", "confidence"} のリスト。
+    """
+
+    def __init__(self, max_edit: int = FUZZY_MAX_EDIT):
+        self.max_edit = max_edit
+        self.terms = {}     # fold した語 -> (見出し語, ids, 種類)
+        self.deletes = {}   # 削った形 -> fold した語のリスト
+
+    def add(self, surface: str, ids, kind: str):
+        term = fold(surface)
+        if not term:
+            return
+        old = self.terms.get(term)
+        if old is not None and KIND_WEIGHTS[old[2]] >= KIND_WEIGHTS[kind]:
+            return
+        if old is None:
+            for d in _deletes(term, self.max_edit):
+                self.deletes.setdefault(d, []).append(term)
+        self.terms[term] = (surface, tuple(ids), kind)
+
+    def max_distance_for(self, term: str) -> int:
+        """短い語ほど許す距離を小さくする（2 文字の語を 2 文字変えれば何にでも当たる）"""
+        if len(term) <= 2:
+            return 0
+        if len(term) <= 4:
+            return min(1, self.max_edit)
+        return self.max_edit
+
+    def lookup(self, text: str, limit: int = 5) -> list:
+        query = fold(text)
+        if not query:
+            return []
+        exact = self.terms.get(query)
+        if exact is not None:
+            # 畳んだ形で一致したら距離 0 で決まり（削除形は作らない）
+            surface, ids, kind = exact
+            return [{"surface": surface, "ids": list(ids), "kind": kind, "distance": 0, "confidence": 1.0}]
+        max_d = self.max_distance_for(query)
+        found = {}
+        for d in _deletes(query, max_d):
+            for term in self.deletes.get(d, ()):
+                if term in found:
+                    continue
+                found[term] = edit_distance(query, term, max_d)
+
+        results = []
+        for term, distance in found.items():
+            if distance > max_d:
+                continue
+            surface, ids, kind = self.terms[term]
+            # 距離を長い方の長さで割った分だけ下げる
+            similarity = 1.0 - distance / max(len(query), len(term))
+            results.append({"surface": surface, "ids": list(ids), "kind": kind,
+                            "distance": distance, "confidence": similarity})
+        results.sort(key=lambda r: (r["distance"], -KIND_WEIGHTS[r["kind"]], -r["confidence"], r["surface"]))
+
+        # 同じ距離で別の星座を指す候補があれば、どれか決めきれないので確信度を半分にする
+        if len(results) > 1 and results[0]["distance"] > 0:
+            best = results[0]
+            if any(r["distance"] == best["distance"] and r["ids"] != best["ids"] for r in results[1:]):
+                best["confidence"] *= 0.5
+        for r in results:
+            r["confidence"] = round(r["confidence"], 3)
+        return results[:limit]
+
+    def best(self, text: str, min_confidence: float = FUZZY_CONFIDENCE, kinds: tuple | None = None):
+        """
+        確信度が min_confidence 以上の一番の候補（無ければ None）。名前のあとの言い回しは除いて引く。
+        kinds を渡すとその種類（"name" / "id" / "keyword"）の候補だけから選ぶ。
+        """
+        text = _TRAILING.sub("", text.strip()) or text
+        results = self.lookup(text, limit=2 if kinds is None else len(self.terms))
+        if kinds is not None:
+            results = [r for r in results if r["kind"] in kinds]
+        if results and results[0]["confidence"] >= min_confidence:
+            return results[0]
+        return None
+
+    def __len__(self):
+        return len(self.terms)
+
+
+def build_fuzzy_index(data_path: str | Path = CONSTELLATION_DATA_PATH) -> FuzzyNameIndex:
+    """星座データの和名・英名・keywords から作る"""
+    with Path(data_path).open("r", encoding="utf-8") as f:
+        constellations = json.load(f)
+
+    index = FuzzyNameIndex()
+    for c in constellations:
+        index.add(c.get("jp_name", c["id"]), [c["id"]], "name")
+        index.add(c["id"], [c["id"]], "id")
+
+    keyword_ids = {}
+    for c in constellations:
+        for kw in c.get("keywords", []):
+            keyword_ids.setdefault(kw, set()).add(c["id"])
+    for kw, ids in keyword_ids.items():
+        if not kw.isdigit():
+            index.add(kw, sorted(ids), "keyword")
+    return index
+
+
+_index = None
+
+
+def get_fuzzy_index() -> FuzzyNameIndex:
+    global _index
+    if _index is None:
+        _index = build_fuzzy_index()
+    return _index
+
+
+# ================================================================
+# ベンチマーク: 名前をランダムに 1〜2 文字崩して引き当てる
+# ================================================================
+
+def _perturb(text: str, n_edits: int, rng: random.Random, alphabet: str) -> str:
+    chars = list(text)
+    for _ in range(n_edits):
+        op = rng.choice(("sub", "del", "ins", "swap"))
+        i = rng.randrange(len(chars))
+        if op == "sub":
+            chars[i] = rng.choice(alphabet)
+        elif op == "del" and len(chars) > 3:
+            del chars[i]
+        elif op == "ins":
+            chars.insert(i, rng.choice(alphabet))
+        elif op == "swap" and i + 1 < len(chars):
+            chars[i], chars[i + 1] = chars[i + 1], chars[i]
+    return "".join(chars)
+
+
+def benchmark(index: FuzzyNameIndex, n_queries: int = 2000, seed: int = 0):
+    rng = random.Random(seed)
+    names = [(surface, ids) for surface, ids, kind in index.terms.values() if kind in ("name", "id")]
+    alphabet = "".join(sorted({ch for s, _ in names for ch in s}))
+    for n_edits in (0, 1, 2):
+        cases = []
+        for _ in range(n_queries):
+            surface, ids = rng.choice(names)
+            cases.append((_perturb(surface, n_edits, rng, alphabet), ids))
+        start = time.perf_counter()
+        matches = [index.best(q) for q, _ in cases]
+        us = (time.perf_counter() - start) * 1e6 / n_queries
+        confident = sum(1 for m in matches if m is not None)
+        correct = sum(1 for m, (_, ids) in zip(matches, cases) if m is not None and m["ids"] == list(ids))
+        print(f"  edits={n_edits}: {us:6.1f} µs/回, 確信あり {confident / n_queries:6.1%}, "
+              f"うち正解 {correct / max(1, confident):6.1%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="表記ゆれ・打ち間違いに強い星座名の引き当て")
+    parser.add_argument("--query", type=str, nargs="*",
+                        default=["オリアン", "おりおん", "カシオペヤ", "オリオーン座", "cygnas", "さそり", "はくちよう座"])
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    fuzzy = get_fuzzy_index()
+    print(f"build: {(time.perf_counter() - start) * 1000:.1f} ms, 見出し語 {len(fuzzy)}, 削除形 {len(fuzzy.deletes)}")
+    for q in args.query:
+        print(f"{q}: {fuzzy.lookup(q, limit=3)}")
+    benchmark(fuzzy)
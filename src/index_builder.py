@@ -0,0 +1,345 @@
+"""
+SkyLore - 大きなコーパス向けの並列・外部メモリのインデックス構築
+build_constellation_index は JSON を丸ごと読み、1 つの tagger で順にトークナイズして
+postings をすべて Python の dict に持ってから joblib.dump する。メモリに載らない大きさの
+コーパスは作れず、コアも 1 つしか使わない。ここでは map-reduce で作る。
+
+- map: JSON Lines を BUILD_BATCH_DOCS 行ずつ読み、プロセスプール（ワーカーごとに tagger 1 つ）で
+  トークナイズする。ワーカーはバッチ分の postings を語の辞書順に並べたラン（run）としてディスクに書く
+- reduce: ランを k-way マージして、語ごとに postings をつなげながら圧縮形式で書き出す。
+  ランが BUILD_MERGE_FANIN 本より多ければ、先に何段かに分けてマージする
+
+出力は index_registry が読む形（bm25_compressed.joblib / docs / keys / titles）で、
+config.CORPORA に index_dir を足せばそのまま検索できる。大きなコーパスでは本文を持たず、
+docs.joblib にはスニペットに使う先頭 SNIPPET_WIDTH 文字だけを入れる。
+
+    python -m src.index_builder --input corpus.jsonl --out data/index_corpus --workers 4
+    python -m src.index_builder --input corpus.jsonl --out data/index_corpus --publish   # 版として公開
+    python -m src.index_builder --bench --docs 20000 --workers 1 2 4
+"""
+import argparse
+import heapq
+import itertools
+import json
+import os
+import pickle
+import random
+import shutil
+import tempfile
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from operator import itemgetter
+from pathlib import Path
+
+import joblib
+import numpy as np
+from fugashi import Tagger
+
+from config import (
+    CONSTELLATION_DATA_PATH,
+    SNIPPET_WIDTH,
+    BUILD_WORKERS,
+    BUILD_BATCH_DOCS,
+    BUILD_MERGE_FANIN,
+)
+from . import constellation_bm25_build
+from .constellation_bm25_build import InvertedIndexArray, build_index_text, tokenize_ja
+from .bm25_compressed import CompressedIndexWriter
+from .index_versions import publish_version
+
+
+# ================================================================
+# map: バッチをトークナイズしてランを書く（ワーカープロセスで動く）
+# ================================================================
+
+def _init_worker():
+    # fork 元の tagger を共有せず、ワーカーごとに作り直す
+    constellation_bm25_build._tagger = Tagger()
+
+
+def _record_text(record: dict) -> str:
+    """text があればそれを、無ければ星座データと同じ形（myth_summary + keywords + ...）で作る"""
+    return record.get("text") or build_index_text(record)
+
+
+def _write_run(path: str, postings: dict):
+    """postings（語 -> (doc_id の配列, tf の配列)）を語の辞書順に 1 件ずつ pickle で書く"""
+    with open(path, "wb") as f:
+        for term in sorted(postings):
+            ids, tfs = postings[term]
+            pickle.dump((term, ids, tfs), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _read_run(path: str):
+    with open(path, "rb") as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+def _map_batch(base_doc_id: int, lines: list, run_path: str) -> dict:
+    """lines（JSON Lines の行）の文書に base_doc_id から番号を振り、ランを 1 本書く"""
+    postings = {}
+    doc_lens = array("I")
+    keys, titles, snippets = [], [], []
+    for offset, line in enumerate(lines):
+        doc_id = base_doc_id + offset
+        record = json.loads(line)
+        text = _record_text(record)
+        key = str(record.get("id", doc_id))
+        keys.append(key)
+        titles.append(record.get("title") or record.get("jp_name") or key)
+        snippets.append(text[:SNIPPET_WIDTH])
+
+        tokens = tokenize_ja(text)
+        doc_lens.append(len(tokens))
+        tf_counts = {}
+        for token in tokens:
+            tf_counts[token] = tf_counts.get(token, 0) + 1
+        for term, tf in tf_counts.items():
+            entry = postings.get(term)
+            if entry is None:
+                entry = postings[term] = (array("I"), array("I"))
+            entry[0].append(doc_id)
+            entry[1].append(tf)
+
+    _write_run(run_path, postings)
+    return {"run": run_path, "doc_lens": doc_lens, "keys": keys, "titles": titles,
+            "snippets": snippets, "postings": sum(len(ids) for ids, _ in postings.values())}
+
+
+# ================================================================
+# reduce: ランの k-way マージ
+# ================================================================
+
+def _merged_terms(run_paths: list):
+    """
+    ランをまとめて語の辞書順に読み、語ごとに (語, doc_id の配列, tf の配列) を返す。
+    ランはそれぞれ連続した doc_id の範囲を受け持つので、先頭の doc_id 順につなげれば昇順になる。
+    """
+    merged = heapq.merge(*(_read_run(p) for p in run_paths), key=itemgetter(0))
+    for term, group in itertools.groupby(merged, key=itemgetter(0)):
+        chunks = sorted(group, key=lambda r: r[1][0])
+        if len(chunks) == 1:
+            yield chunks[0]
+            continue
+        ids, tfs = array("I"), array("I")
+        for _, chunk_ids, chunk_tfs in chunks:
+            ids.extend(chunk_ids)
+            tfs.extend(chunk_tfs)
+        yield term, ids, tfs
+
+
+def _merge_to_run(run_paths: list, out_path: str):
+    with open(out_path, "wb") as f:
+        for item in _merged_terms(run_paths):
+            pickle.dump(item, f, protocol=pickle.HIGHEST_PROTOCOL)
+    for path in run_paths:
+        os.remove(path)
+
+
+def _reduce_fanin(run_paths: list, spill_dir: str, fanin: int) -> tuple:
+    """ランが fanin 本以下になるまで、fanin 本ずつ中間マージする。(ラン, 段数) を返す"""
+    passes = 0
+    while len(run_paths) > fanin:
+        passes += 1
+        next_paths = []
+        for i in range(0, len(run_paths), fanin):
+            out_path = os.path.join(spill_dir, f"merge{passes}-{i // fanin:06d}.run")
+            _merge_to_run(run_paths[i:i + fanin], out_path)
+            next_paths.append(out_path)
+        run_paths = next_paths
+    return run_paths, passes
+
+
+# ================================================================
+# 構築
+# ================================================================
+
+def _read_batches(input_path: str | Path, batch_docs: int):
+    """JSON Lines を batch_docs 行ずつ (行のリスト, バイト数) で返す（空行は飛ばす）"""
+    with open(input_path, "r", encoding="utf-8") as f:
+        batch, nbytes = [], 0
+        for line in f:
+            if not line.strip():
+                continue
+            batch.append(line)
+            nbytes += len(line.encode("utf-8"))
+            if len(batch) >= batch_docs:
+                yield batch, nbytes
+                batch, nbytes = [], 0
+        if batch:
+            yield batch, nbytes
+
+
+def build_index(input_path: str | Path, out_dir: str | Path, workers: int = BUILD_WORKERS,
+                batch_docs: int = BUILD_BATCH_DOCS, fanin: int = BUILD_MERGE_FANIN,
+                spill_dir: str | Path | None = None) -> dict:
+    """
+    JSON Lines（1 行 1 文書。text か、星座データと同じ myth_summary / keywords / best_months、
+    任意で id と title / jp_name）から index_registry 用の成果物を out_dir に書き出す。
+
+    workers <= 1 ならプールを使わずにこのプロセスで順にトークナイズする。
+    ワーカーに渡したまま結果を受け取っていないバッチは workers * 2 個までにして、
+    読み込みが先走ってメモリを使い切らないようにする。構築の統計を返す。
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    spill = tempfile.mkdtemp(prefix=".build-", dir=spill_dir or out_dir)
+    stats = {"workers": workers, "docs": 0, "postings": 0, "input_bytes": 0, "runs": 0}
+    doc_lens = array("I")
+    keys, titles, snippets = [], [], []
+
+    def collect(result):
+        doc_lens.extend(result["doc_lens"])
+        keys.extend(result["keys"])
+        titles.extend(result["titles"])
+        snippets.extend(result["snippets"])
+        stats["postings"] += result["postings"]
+        run_paths.append(result["run"])
+
+    start = time.perf_counter()
+    run_paths = []
+    try:
+        pool = ProcessPoolExecutor(workers, initializer=_init_worker) if workers > 1 else None
+        try:
+            pending = []
+            for batch, nbytes in _read_batches(input_path, batch_docs):
+                run_path = os.path.join(spill, f"map-{stats['runs']:06d}.run")
+                stats["runs"] += 1
+                stats["input_bytes"] += nbytes
+                base, stats["docs"] = stats["docs"], stats["docs"] + len(batch)
+                if pool is None:
+                    collect(_map_batch(base, batch, run_path))
+                    continue
+                pending.append(pool.submit(_map_batch, base, batch, run_path))
+                # 投げた順に受け取る（doc_id 順に doc_lens などを並べるため）
+                while len(pending) >= workers * 2:
+                    collect(pending.pop(0).result())
+            for future in pending:
+                collect(future.result())
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+        stats["map_sec"] = time.perf_counter() - start
+
+        mid = time.perf_counter()
+        run_paths, stats["merge_passes"] = _reduce_fanin(run_paths, spill, fanin)
+        writer = CompressedIndexWriter(spill_dir=spill)
+        n_terms = 0
+        for term, ids, tfs in _merged_terms(run_paths):
+            writer.add(term, np.frombuffer(ids, dtype=np.uint32).astype(np.int64),
+                       np.frombuffer(tfs, dtype=np.uint32).astype(np.int64))
+            n_terms += 1
+        index = writer.finish(np.frombuffer(doc_lens, dtype=np.uint32))
+        stats["terms"] = n_terms
+        stats["merge_sec"] = time.perf_counter() - mid
+
+        joblib.dump(index, out_dir / "bm25_compressed.joblib")
+        joblib.dump(snippets, out_dir / "docs.joblib")
+        joblib.dump(keys, out_dir / "keys.joblib")
+        joblib.dump(dict(zip(keys, titles)), out_dir / "titles.joblib")
+    finally:
+        shutil.rmtree(spill, ignore_errors=True)
+
+    stats["total_sec"] = time.perf_counter() - start
+    stats["docs_per_sec"] = stats["docs"] / stats["total_sec"] if stats["total_sec"] else 0.0
+    stats["mb_per_sec"] = stats["input_bytes"] / 1e6 / stats["total_sec"] if stats["total_sec"] else 0.0
+    return stats
+
+
+def export_jsonl(json_path: str | Path = CONSTELLATION_DATA_PATH, out_path: str | Path = "constellations.jsonl"):
+    """星座データの JSON 配列を 1 行 1 星座の JSON Lines にする（build_index の入力用）"""
+    with open(json_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    with open(out_path, "w", encoding="utf-8") as f:
+        for entry in data:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    return len(data)
+
+
+# ================================================================
+# ベンチマーク（ワーカー数ごとの構築スループット）
+# ================================================================
+
+def make_synthetic_jsonl(path: str | Path, n_docs: int, seed: int = 0):
+    """星座の神話の文をランダムに組み合わせた日本語の文書を n_docs 件書く"""
+    with open(CONSTELLATION_DATA_PATH, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    sentences = [s for e in data for s in e.get("myth_summary", "").split("。") if s]
+    keywords = [k for e in data for k in e.get("keywords", [])]
+    rng = random.Random(seed)
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(n_docs):
+            text = "。".join(rng.sample(sentences, rng.randint(3, 6))) + "。" + " ".join(rng.sample(keywords, 5))
+            f.write(json.dumps({"id": f"doc{i}", "title": f"文書{i}", "text": text}, ensure_ascii=False) + "\n")
+
+
+def benchmark(n_docs: int = 20000, worker_counts=(1, 2, 4), batch_docs: int = BUILD_BATCH_DOCS):
+    work = Path(tempfile.mkdtemp(prefix="skylore-build-bench-"))
+    try:
+        input_path = work / "corpus.jsonl"
+        make_synthetic_jsonl(input_path, n_docs)
+        queries = ["冬の明るい星", "英雄の神話", "夏の夜空に輝く星座", "女神に変えられた動物"]
+
+        # 比較用: いまの build_constellation_index と同じ、メモリ上で 1 本のインデックスを作るやり方
+        with open(input_path, "r", encoding="utf-8") as f:
+            texts = [json.loads(line)["text"] for line in f]
+        start = time.perf_counter()
+        serial = InvertedIndexArray()
+        serial.build(texts)
+        serial_sec = time.perf_counter() - start
+        expected = [serial.bm25_search(q, topk=10) for q in queries]
+        print(f"docs={n_docs} ({input_path.stat().st_size / 1e6:.1f} MB), CPU={os.cpu_count()}")
+        print(f"  in-memory serial : {serial_sec:6.2f} s ({n_docs / serial_sec:8.0f} docs/s)")
+
+        for workers in worker_counts:
+            out_dir = work / f"index_w{workers}"
+            stats = build_index(input_path, out_dir, workers=workers, batch_docs=batch_docs)
+            index = joblib.load(out_dir / "bm25_compressed.joblib", mmap_mode="r")
+            got = [index.bm25_search(q, topk=10) for q in queries]
+            same = all([d for d, _ in g] == [d for d, _ in e] and np.allclose([s for _, s in g], [s for _, s in e])
+                       for g, e in zip(got, expected))
+            print(f"  workers={workers:<2d}       : {stats['total_sec']:6.2f} s ({stats['docs_per_sec']:8.0f} docs/s, "
+                  f"{stats['mb_per_sec']:5.2f} MB/s) map {stats['map_sec']:.2f} s / merge {stats['merge_sec']:.2f} s, "
+                  f"runs={stats['runs']} passes={stats['merge_passes']} {'OK' if same else 'MISMATCH'}")
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="JSON Lines から BM25 インデックスを並列・外部メモリで作る")
+    parser.add_argument("--input", type=str, help="JSON Lines（1 行 1 文書）")
+    parser.add_argument("--out", type=str, help="成果物を書き出すディレクトリ")
+    parser.add_argument("--workers", type=int, nargs="+", default=[BUILD_WORKERS])
+    parser.add_argument("--batch-docs", type=int, default=BUILD_BATCH_DOCS)
+    parser.add_argument("--fanin", type=int, default=BUILD_MERGE_FANIN)
+    parser.add_argument("--spill-dir", type=str, default=None, help="ランを書く場所（既定は --out の下）")
+    parser.add_argument("--publish", action="store_true",
+                        help="--out をインデックスの置き場として、新しい版に書いて CURRENT を切り替える")
+    parser.add_argument("--export-constellations", type=str, metavar="JSONL",
+                        help="星座データを JSON Lines に書き出す")
+    parser.add_argument("--bench", action="store_true", help="合成コーパスでワーカー数ごとのスループットを測る")
+    parser.add_argument("--docs", type=int, default=20000, help="--bench の文書数")
+    args = parser.parse_args()
+
+    if args.export_constellations:
+        print(f"{export_jsonl(out_path=args.export_constellations)} 件を {args.export_constellations} に書き出しました")
+    if args.bench:
+        benchmark(args.docs, args.workers, args.batch_docs)
+    elif args.input and args.out:
+        def build(out_dir):
+            return build_index(args.input, out_dir, workers=args.workers[0], batch_docs=args.batch_docs,
+                               fanin=args.fanin, spill_dir=args.spill_dir)
+
+        if args.publish:
+            result = {}
+            version = publish_version(lambda out_dir: result.update(build(out_dir)), args.out,
+                                      meta={"builder": "index_builder"})
+            result["version"] = version
+        else:
+            result = build(args.out)
+        print(json.dumps(result, ensure_ascii=False, indent=2))
@@ -0,0 +1,466 @@
+"""
+SkyLore - コーパスのレジストリとクエリルーター
+星座以外のコーパス（星ごとの神話、季節の天文現象、観察ガイドなど）を、
+コーパスごとにモジュールを増やさずに足せるようにする。
+
+- CorpusSpec: コーパスが持つ成果物（BM25・docs・keys・titles、任意でベクトルストア）の宣言
+- Corpus: 初めて検索されたときに成果物を読み込む。圧縮版の BM25
+  （bm25_compressed.joblib）があれば mmap で開き、postings はページキャッシュから読む。
+  新しい版が公開されたら VersionedIndex で検索を止めずに差し替える
+- ConstellationCorpus: 星座のコーパス（config.CORPORA の backend="constellations"）。
+  星座向けのハイブリッド検索とクエリプランナーをそのまま使う
+- IndexRegistry: 名前 -> Corpus
+- QueryRouter: 選んだコーパスに並列に投げ、順位で RRF して 1 本の結果にする。
+  ConstellationSearcher.search はこれを通すので、コーパスを足すのは config.CORPORA の変更だけで済む
+
+    python -m src.index_registry --compact constellations   # 圧縮版を書き出す
+    python -m src.index_registry --query "冬の明るい星" --no-vector
+"""
+import argparse
+import contextvars
+import sys
+import threading
+import time
+import tracemalloc
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import joblib
+import numpy as np
+
+from config import CORPORA, ROUTER_MAX_WORKERS, SNIPPET_WIDTH
+from .constellation_bm25_build import InvertedIndexArray
+from .bm25_compressed import CompressedInvertedIndex
+from .openai_client import get_openai_client
+from .llm_usage import get_usage_tracker
+from .llm_scheduler import get_scheduler
+from .singleflight import coalesce
+from .index_versions import VersionedIndex, resolve_dir
+
+# bm25_index.joblib は __main__.InvertedIndexArray として保存されている
+if not hasattr(sys.modules["__main__"], "InvertedIndexArray"):
+    sys.modules["__main__"].InvertedIndexArray = InvertedIndexArray
+
+# 成果物の名前 -> ファイル名（constellation_bm25_build が書き出すものと同じ）
+ARTIFACTS = {
+    "bm25": "bm25_index.joblib",
+    "bm25_compressed": "bm25_compressed.joblib",
+    "docs": "docs.joblib",
+    "keys": "keys.joblib",
+    "titles": "titles.joblib",
+}
+
+RRF_K = 60
+
+# tracemalloc はプロセスで 1 つなので、読み込み（とそのヒープ計測）は 1 コーパスずつ行う
+_load_lock = threading.Lock()
+
+
+class CorpusSpec:
+    """コーパス 1 つ分の宣言（読み込みはしない）"""
+
+    def __init__(self, name: str, index_dir: str | Path, label: str | None = None,
+                 vector_store_id: str | None = None, backend: str = "bm25"):
+        self.name = name
+        self.label = label or name
+        self.index_dir = Path(index_dir)
+        self.vector_store_id = vector_store_id
+        self.backend = backend
+
+    def path(self, artifact: str, base: str | Path | None = None) -> Path:
+        # base（読み込む版のディレクトリ）を省くと CURRENT が指す版から読む（index_versions）
+        return Path(base or resolve_dir(self.index_dir)) / ARTIFACTS[artifact]
+
+    def missing(self, base: str | Path | None = None) -> list:
+        """読み込みに必要なのに無い成果物（圧縮版はどちらか片方あればよい）"""
+        base = base or resolve_dir(self.index_dir)
+        required = ["docs", "keys", "titles"]
+        missing = [a for a in required if not self.path(a, base).exists()]
+        if not self.path("bm25", base).exists() and not self.path("bm25_compressed", base).exists():
+            missing.append("bm25")
+        return missing
+
+
+class CorpusIndex:
+    """
+    1 つの版のディレクトリから読み込んだコーパスの成果物一式（VersionedIndex の loader）。
+    成果物はすべて同じディレクトリから読むので、読み込み中に CURRENT が切り替わっても版が混ざらない。
+    """
+
+    def __init__(self, spec: CorpusSpec, index_dir: Path):
+        missing = spec.missing(index_dir)
+        if missing:
+            raise FileNotFoundError(f"{spec.name}: {index_dir} に {missing} がありません")
+
+        with _load_lock:
+            start = time.perf_counter()
+            # 読み込みで増えたヒープを測る（mmap した分は含まれない）
+            tracing = tracemalloc.is_tracing()
+            if not tracing:
+                tracemalloc.start()
+            before, _ = tracemalloc.get_traced_memory()
+
+            self.mapped_bytes = 0
+            compressed = spec.path("bm25_compressed", index_dir)
+            if compressed.exists():
+                self.bm25 = joblib.load(compressed, mmap_mode="r")
+                self.mapped_bytes = sum(a.nbytes for a in vars(self.bm25).values()
+                                        if isinstance(a, np.memmap))
+            else:
+                self.bm25 = joblib.load(spec.path("bm25", index_dir))
+            self.docs = joblib.load(spec.path("docs", index_dir))
+            self.keys = joblib.load(spec.path("keys", index_dir))
+            self.titles = joblib.load(spec.path("titles", index_dir))
+            self.id2doc_id = {cid: i for i, cid in enumerate(self.keys)}
+
+            after, _ = tracemalloc.get_traced_memory()
+            if not tracing:
+                tracemalloc.stop()
+            self.heap_bytes = max(0, after - before)
+            self.load_ms = (time.perf_counter() - start) * 1000
+
+
+class Corpus:
+    """
+    1 つのコーパスの検索器。成果物は最初の search() で読み込む（スレッドセーフ）。
+    読み込んだ成果物は VersionedIndex で持つので、新しい版が公開されると星座の検索と同じく
+    検索を止めずに差し替わる（1 回の検索は 1 つの版だけを使う）。
+
+    検索結果は [{"corpus", "id", "jp_name", "snippet", "score"}, ...]。
+    ベクトルストアがあれば BM25 と RRF でまとめる。
+    """
+
+    def __init__(self, spec: CorpusSpec):
+        self.spec = spec
+        self._lock = threading.Lock()
+        self._versioned = None
+        # 検索回数・エラー・レイテンシはルーターの複数スレッドから更新されるので _stats_lock で守る
+        self._stats_lock = threading.Lock()
+        self.queries = 0
+        self.errors = 0
+        self._latencies_ms = deque(maxlen=1000)
+
+    @property
+    def loaded(self) -> bool:
+        return self._versioned is not None
+
+    @property
+    def version(self) -> str:
+        """いま検索に使っている版（CURRENT が変わっていれば差し替えを始める）"""
+        versioned = self.load()
+        versioned.maybe_refresh()
+        return versioned.version
+
+    def load(self) -> VersionedIndex:
+        """成果物を読み込む（2 回目以降は読み込み済みの VersionedIndex を返す）"""
+        if self._versioned is None:
+            with self._lock:
+                if self._versioned is None:
+                    self._versioned = VersionedIndex(lambda path: CorpusIndex(self.spec, path),
+                                                     self.spec.index_dir)
+        return self._versioned
+
+    def _result(self, index: CorpusIndex, cid: str, score: float) -> dict:
+        doc_id = index.id2doc_id.get(cid)
+        snippet = index.docs[doc_id][:SNIPPET_WIDTH].replace("\n", "") if doc_id is not None else ""
+        return {"corpus": self.spec.name, "id": cid, "jp_name": index.titles.get(cid, cid),
+                "snippet": snippet, "score": float(score)}
+
+    def search_bm25(self, query: str, k: int = 10, index: CorpusIndex = None) -> list:
+        if index is None:
+            with self.load().acquire() as index:
+                return self.search_bm25(query, k=k, index=index)
+        return [self._result(index, index.keys[doc_id], score)
+                for doc_id, score in index.bm25.bm25_search(query, topk=k) if score > 0]
+
+    def search_vec(self, query: str, k: int = 10, index: CorpusIndex = None) -> list:
+        """ベクトルストアがあればそれで検索する（同じ呼び出しは相乗りし、スケジューラを通す）"""
+        vsid = self.spec.vector_store_id
+        if not vsid:
+            return []
+        if index is None:
+            with self.load().acquire() as index:
+                return self.search_vec(query, k=k, index=index)
+
+        def call():
+            start = time.perf_counter()
+            res = get_openai_client().vector_stores.search(vector_store_id=vsid, query=query,
+                                                           max_num_results=k)
+            get_usage_tracker().record("vector_search", None, time.perf_counter() - start)
+            return res
+
+        res = coalesce("vector_search", (vsid, query, k),
+                       lambda: get_scheduler().run("vector_search", call, est_tokens=len(query)))
+        out = []
+        for item in res.data[:k]:
+            attrs = getattr(item, "attributes", None) or {}
+            cid = attrs.get("filename") or getattr(item, "filename", None)
+            if cid:
+                out.append(self._result(index, cid, getattr(item, "score", 0.0)))
+        return out
+
+    def search(self, query: str, k: int = 10, use_vector: bool = True, plan=None) -> list:
+        """plan（query_planner.QueryPlan）は星座のコーパスだけが使う（ほかのコーパスでは無視する）"""
+        start = time.perf_counter()
+        try:
+            # 初回の読み込み時間は load_ms に分けて、レイテンシには入れない
+            versioned = self.load()
+            start = time.perf_counter()
+            return self._search(versioned, query, k, use_vector, plan)
+        except Exception:
+            with self._stats_lock:
+                self.errors += 1
+            raise
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            with self._stats_lock:
+                self.queries += 1
+                self._latencies_ms.append(elapsed_ms)
+
+    def _search(self, versioned: VersionedIndex, query: str, k: int, use_vector: bool, plan) -> list:
+        with versioned.acquire() as index:
+            bm25 = self.search_bm25(query, k=k * 2, index=index)
+            vec = self.search_vec(query, k=k * 2, index=index) if use_vector else []
+        return rrf_merge([bm25, vec])[:k] if vec else bm25[:k]
+
+    def _index_stats(self, index) -> dict:
+        return {
+            "docs": len(index.docs),
+            "postings_format": type(index.bm25).__name__,
+            "load_ms": round(index.load_ms, 1),
+            "heap_bytes": index.heap_bytes,
+            "mapped_bytes": index.mapped_bytes,
+        }
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            latencies = sorted(self._latencies_ms)
+            queries, errors = self.queries, self.errors
+        index = self._versioned.index if self._versioned is not None else None
+        return {
+            "label": self.spec.label,
+            "loaded": index is not None,
+            "version": self._versioned.version if index is not None else None,
+            **(self._index_stats(index) if index is not None else
+               {"docs": None, "postings_format": None, "load_ms": 0.0, "heap_bytes": 0, "mapped_bytes": 0}),
+            "queries": queries,
+            "errors": errors,
+            "latency_ms_p50": round(latencies[len(latencies) // 2], 3) if latencies else 0.0,
+            "latency_ms_p95": round(latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))], 3)
+            if latencies else 0.0,
+        }
+
+
+class ConstellationCorpus(Corpus):
+    """
+    星座のコーパス（backend="constellations"）。成果物の読み込みと差し替えは
+    constellation_bm25_vec_rrf_search の VersionedIndex をそのまま使い、検索は
+    hybrid_search_constellations（plan があれば QueryPlan.search）に任せる。
+    近接スコア・フレーズ・n-gram などの星座向けの検索をルーター経由でもそのまま使うため。
+    """
+
+    def load(self) -> VersionedIndex:
+        if self._versioned is None:
+            from .constellation_bm25_vec_rrf_search import get_versioned_index
+            self._versioned = get_versioned_index()
+        return self._versioned
+
+    def _search(self, versioned: VersionedIndex, query: str, k: int, use_vector: bool, plan) -> list:
+        from .constellation_bm25_vec_rrf_search import hybrid_search_constellations, search_constellations_bm25
+        if plan is not None:
+            results = plan.search(query, k)
+        elif use_vector:
+            results = hybrid_search_constellations(query=query, topk=k)
+        else:
+            results = search_constellations_bm25(query, k=k)
+        return [{**r, "corpus": self.spec.name} for r in results]
+
+    def _index_stats(self, index) -> dict:
+        return {"docs": len(index.docs_list), "postings_format": type(index.bm25_index).__name__,
+                "load_ms": 0.0, "heap_bytes": 0, "mapped_bytes": 0}
+
+
+# CorpusSpec.backend -> 検索器のクラス（config.CORPORA の "backend"）
+BACKENDS = {"bm25": Corpus, "constellations": ConstellationCorpus}
+
+
+def rrf_merge(ranked_lists: list, rrf_k: int = RRF_K) -> list:
+    """
+    複数の順位付きリストを (corpus, id) ごとに RRF でまとめる。
+    コーパスが違うと BM25 のスコアは比べられないので、順位だけを使う。
+    """
+    merged = {}
+    for results in ranked_lists:
+        for rank, r in enumerate(results, start=1):
+            key = (r["corpus"], r["id"])
+            if key not in merged:
+                merged[key] = {**r, "rrf_score": 0.0}
+            merged[key]["rrf_score"] += 1.0 / (rrf_k + rank)
+    out = list(merged.values())
+    out.sort(key=lambda x: x["rrf_score"], reverse=True)
+    return out
+
+
+class IndexRegistry:
+    """名前 -> Corpus（宣言だけ先に登録し、読み込みは使われたときに行う）"""
+
+    def __init__(self):
+        self._corpora = {}
+
+    def register(self, spec: CorpusSpec) -> Corpus:
+        if spec.backend not in BACKENDS:
+            raise ValueError(f"{spec.name}: 未知の backend です: {spec.backend}（{list(BACKENDS)}）")
+        corpus = BACKENDS[spec.backend](spec)
+        self._corpora[spec.name] = corpus
+        return corpus
+
+    def get(self, name: str) -> Corpus:
+        if name not in self._corpora:
+            raise KeyError(f"未登録のコーパスです: {name}（登録済み: {self.names()}）")
+        return self._corpora[name]
+
+    def names(self) -> list:
+        return list(self._corpora)
+
+    def labels(self) -> dict:
+        return {name: corpus.spec.label for name, corpus in self._corpora.items()}
+
+    def versions(self, names: list) -> tuple:
+        """コーパスごとのいまの版（検索キャッシュのキー用）"""
+        return tuple(self.get(name).version for name in names)
+
+    def stats(self) -> dict:
+        return {name: corpus.stats() for name, corpus in self._corpora.items()}
+
+
+class QueryRouter:
+    """クエリを選んだコーパスに並列に投げ、RRF でまとめる"""
+
+    def __init__(self, registry: IndexRegistry, max_workers: int = ROUTER_MAX_WORKERS):
+        self.registry = registry
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="router")
+        self._stats_lock = threading.Lock()
+        self.searches = 0
+        self.failed = 0
+
+    def search(self, query: str, corpora: list | None = None, k: int = 10,
+               use_vector: bool = True, plan=None, raise_errors: bool = False) -> dict:
+        """
+        Returns:
+            {"results": [...], "errors": {コーパス名: エラー文字列}}
+            1 つのコーパスが失敗しても、残りのコーパスの結果は返す
+            （raise_errors=True なら、すべてのコーパスが失敗したときに最初の例外を投げ直す）
+        """
+        names = corpora or self.registry.names()
+        with self._stats_lock:
+            self.searches += 1
+        if len(names) == 1:
+            # 1 つだけならスレッドに渡さない
+            outcomes = {names[0]: self._run(names[0], query, k, use_vector, plan)}
+        else:
+            # 呼び出し元の contextvars（use_priority の優先度、trace_request の記録先）をスレッドに引き継ぐ
+            # （Context は同時に 1 スレッドでしか使えないので、コーパスごとにコピーする）
+            futures = {name: self._executor.submit(contextvars.copy_context().run,
+                                                   self._run, name, query, k, use_vector, plan)
+                       for name in names}
+            outcomes = {name: f.result() for name, f in futures.items()}
+
+        ranked, errors = [], {}
+        for name in names:
+            results, error = outcomes[name]
+            if error is not None:
+                errors[name] = f"{type(error).__name__}: {error}"
+            else:
+                ranked.append(results)
+        if not ranked:
+            with self._stats_lock:
+                self.failed += 1
+            if raise_errors:
+                raise outcomes[names[0]][1]
+            return {"results": [], "errors": errors}
+        merged = ranked[0] if len(ranked) == 1 else rrf_merge(ranked)
+        return {"results": merged[:k], "errors": errors}
+
+    def _run(self, name: str, query: str, k: int, use_vector: bool, plan=None):
+        try:
+            return self.registry.get(name).search(query, k=k, use_vector=use_vector, plan=plan), None
+        except Exception as e:
+            return None, e
+
+    def stats(self) -> dict:
+        """ルーター経由の検索回数と、コーパスごとの統計"""
+        with self._stats_lock:
+            searches, failed = self.searches, self.failed
+        return {"searches": searches, "all_failed": failed, "corpora": self.registry.stats()}
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def default_registry() -> IndexRegistry:
+    """config.CORPORA の宣言を登録したレジストリ"""
+    registry = IndexRegistry()
+    for name, entry in CORPORA.items():
+        registry.register(CorpusSpec(name, entry["index_dir"], label=entry.get("label"),
+                                     vector_store_id=entry.get("vector_store_id"),
+                                     backend=entry.get("backend", "bm25")))
+    return registry
+
+
+_registry = None
+_router = None
+_init_lock = threading.Lock()
+
+
+def get_registry() -> IndexRegistry:
+    global _registry
+    with _init_lock:
+        if _registry is None:
+            _registry = default_registry()
+    return _registry
+
+
+def get_router() -> QueryRouter:
+    global _router
+    registry = get_registry()
+    with _init_lock:
+        if _router is None:
+            _router = QueryRouter(registry)
+    return _router
+
+
+def compact(spec: CorpusSpec):
+    """bm25_index.joblib から mmap で開ける圧縮版（bm25_compressed.joblib）を書き出す"""
+    base = resolve_dir(spec.index_dir)
+    index = joblib.load(spec.path("bm25", base))
+    joblib.dump(CompressedInvertedIndex.from_index(index), spec.path("bm25_compressed", base))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="コーパスのレジストリとクエリルーター")
+    parser.add_argument("--compact", nargs="*", metavar="CORPUS",
+                        help="圧縮版の BM25 を書き出す（名前を省略すると全コーパス）")
+    parser.add_argument("--query", type=str, default=None)
+    parser.add_argument("--corpora", nargs="*", default=None)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--no-vector", action="store_true", help="ベクトルストアは使わない")
+    args = parser.parse_args()
+
+    registry = get_registry()
+    if args.compact is not None:
+        for name in args.compact or registry.names():
+            spec = registry.get(name).spec
+            compact(spec)
+            print(f"{name}: {spec.path('bm25_compressed')} を書き出しました")
+
+    if args.query:
+        router = get_router()
+        for attempt in ("cold", "warm"):
+            start = time.perf_counter()
+            out = router.search(args.query, corpora=args.corpora, k=args.k, use_vector=not args.no_vector)
+            print(f"[{attempt}] {(time.perf_counter() - start) * 1000:.1f} ms errors={out['errors']}")
+        for r in out["results"]:
+            print(f"  {r['corpus']:>14s} {r['jp_name']} ({r['id']}) rrf={r.get('rrf_score', r['score']):.4f}")
+        for name, s in registry.stats().items():
+            print(f"  {name}: {s}")
@@ -0,0 +1,370 @@
+"""
+SkyLore - インデックスの版管理と、止めずに差し替える読み込み（RCU）
+これまで build_constellation_index は INDEX_DIR の成果物をその場で上書きし、検索モジュールは
+import 時に一度だけ読み込んでいた。作り直したら再起動が要り、書き込み中に再起動すると
+書きかけのファイルを読むことがあった。ここでは
+
+    INDEX_DIR/
+      CURRENT                   いま使う版の名前（1 行）
+      versions/<版>/            成果物 + manifest.json（ファイルごとのバイト数と sha256）
+      versions/.staging-<版>/   書き込み中（読み手からは見えない）
+
+という置き方にして、
+
+- publish_version: .staging に書かせ、manifest を書いて versions/<版> に rename し、
+  CURRENT を一時ファイルからの os.replace で切り替える（どの時点で落ちても CURRENT は完全な版を指す）
+- VersionedIndex: 読み込んだ版を 1 つ持ち、acquire() のたびに（INDEX_POLL_SECONDS ごとに）CURRENT を見る。
+  新しい版は裏のスレッドで読み込んで manifest と照合してから参照を差し替えるので、検索は止まらない。
+  古い版は使っている検索（参照カウント）が無くなった時点で手放す。差し替えると on_swap の関数を呼ぶ
+
+を行う。CURRENT が無い（版を作る前の）置き方なら INDEX_DIR 直下の成果物を "legacy" 版として読む。
+
+    python -m src.index_versions --list            # 版の一覧
+    python -m src.index_versions --rollback <版>   # CURRENT を前の版に戻す
+"""
+import argparse
+import hashlib
+import json
+import os
+import secrets
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+from config import INDEX_DIR, INDEX_POLL_SECONDS, INDEX_KEEP_VERSIONS
+
+CURRENT = "CURRENT"
+VERSIONS = "versions"
+MANIFEST = "manifest.json"
+LEGACY = "legacy"
+_STAGING = ".staging-"
+
+
+def _fsync(path: Path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _write_atomic(path: Path, text: str):
+    """一時ファイルに書いて fsync してから os.replace で置き換える"""
+    tmp = path.with_name(f".{path.name}.tmp-{os.getpid()}-{secrets.token_hex(3)}")
+    with tmp.open("w", encoding="utf-8") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    _fsync(path.parent)
+
+
+def new_version_name() -> str:
+    """時刻順に並ぶ版の名前（同じ秒に作っても重ならないように乱数を付ける）"""
+    return f"{datetime.now():%Y%m%d-%H%M%S}-{secrets.token_hex(3)}"
+
+
+def current_version(index_root: str | Path = INDEX_DIR) -> str | None:
+    """CURRENT が指す版の名前（まだ版が無ければ None）"""
+    try:
+        return (Path(index_root) / CURRENT).read_text(encoding="utf-8").strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def resolve(index_root: str | Path = INDEX_DIR) -> tuple:
+    """いま読むべき (版の名前, 成果物のディレクトリ)。版が無ければ INDEX_DIR 直下を legacy として返す"""
+    root = Path(index_root)
+    version = current_version(root)
+    if version is not None:
+        path = root / VERSIONS / version
+        if (path / MANIFEST).exists():
+            return version, path
+    return LEGACY, root
+
+
+def resolve_dir(index_root: str | Path = INDEX_DIR) -> Path:
+    return resolve(index_root)[1]
+
+
+def read_manifest(path: str | Path) -> dict:
+    with (Path(path) / MANIFEST).open("r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def verify(path: str | Path, checksum: bool = True) -> list:
+    """manifest と照合して、合わないファイルの説明のリストを返す（legacy は照合しない）"""
+    path = Path(path)
+    if not (path / MANIFEST).exists():
+        return []
+    problems = []
+    for name, info in read_manifest(path)["files"].items():
+        f = path / name
+        if not f.exists():
+            problems.append(f"{name}: ありません")
+        elif f.stat().st_size != info["bytes"]:
+            problems.append(f"{name}: {f.stat().st_size} バイト（manifest は {info['bytes']}）")
+        elif checksum and _sha256(f) != info["sha256"]:
+            problems.append(f"{name}: sha256 が合いません")
+    return problems
+
+
+def switch_current(index_root: str | Path, version: str):
+    """CURRENT をアトミックに version に切り替える（版の manifest と照合してから）"""
+    root = Path(index_root)
+    path = root / VERSIONS / version
+    if not (path / MANIFEST).exists():
+        raise FileNotFoundError(f"{path} に {MANIFEST} がありません")
+    problems = verify(path)
+    if problems:
+        raise ValueError(f"{version} は壊れています: {problems}")
+    _write_atomic(root / CURRENT, version + "\n")
+
+
+def publish_version(write, index_root: str | Path = INDEX_DIR, meta: dict | None = None,
+                    keep: int = INDEX_KEEP_VERSIONS) -> str:
+    """
+    write(ディレクトリ) に成果物を書かせて新しい版として公開し、その名前を返す。
+    write が例外を出したら書きかけの版は消して、CURRENT はそのままにする。
+    """
+    root = Path(index_root)
+    versions = root / VERSIONS
+    versions.mkdir(parents=True, exist_ok=True)
+    version = new_version_name()
+    staging = versions / f"{_STAGING}{version}"
+    staging.mkdir()
+    try:
+        write(staging)
+        files = {}
+        for f in sorted(staging.iterdir()):
+            if f.is_file():
+                _fsync(f)
+                files[f.name] = {"bytes": f.stat().st_size, "sha256": _sha256(f)}
+        manifest = {"version": version, "created_at": datetime.now().isoformat(timespec="seconds"),
+                    "files": files, **(meta or {})}
+        _write_atomic(staging / MANIFEST, json.dumps(manifest, ensure_ascii=False, indent=2))
+        os.replace(staging, versions / version)
+        _fsync(versions)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    switch_current(root, version)
+    prune(root, keep=keep)
+    return version
+
+
+def list_versions(index_root: str | Path = INDEX_DIR) -> list:
+    """公開済みの版の名前（古い順）"""
+    versions = Path(index_root) / VERSIONS
+    if not versions.exists():
+        return []
+    return sorted(p.name for p in versions.iterdir()
+                  if p.is_dir() and not p.name.startswith(".") and (p / MANIFEST).exists())
+
+
+def prune(index_root: str | Path = INDEX_DIR, keep: int = INDEX_KEEP_VERSIONS) -> list:
+    """
+    CURRENT 以外の古い版を新しい方から keep 個だけ残して消し、消した版を返す。
+    読み込み済みの版はメモリ上（mmap なら unlink 後もマップは有効）にあるので、
+    動いているプロセスの検索には影響しない。1 時間より古い書きかけの版も消す。
+    """
+    root = Path(index_root)
+    current = current_version(root)
+    old = [v for v in list_versions(root) if v != current]
+    removed = old[:max(0, len(old) - keep)]
+    for v in removed:
+        shutil.rmtree(root / VERSIONS / v, ignore_errors=True)
+    versions = root / VERSIONS
+    if versions.exists():
+        for p in versions.glob(f"{_STAGING}*"):
+            if time.time() - p.stat().st_mtime > 3600:
+                shutil.rmtree(p, ignore_errors=True)
+    return removed
+
+
+# ================================================================
+# 止めずに差し替える読み込み（参照カウント付きの RCU）
+# ================================================================
+
+class _Snapshot:
+    """読み込んだ 1 つの版と、それを使っている検索の数"""
+
+    __slots__ = ("version", "path", "index", "refs", "retired")
+
+    def __init__(self, version: str, path: Path, index):
+        self.version = version
+        self.path = path
+        self.index = index
+        self.refs = 0
+        self.retired = False
+
+
+class VersionedIndex:
+    """
+    loader(ディレクトリ) で読み込んだインデックスを版ごとに持つ。
+
+        with versioned.acquire() as index:   # この with の間は版が変わらない
+            ...
+
+    差し替えは参照 1 つの付け替えなので、検索を止めない。古い版は最後の acquire が
+    抜けた時点で手放す（in_use_versions() で確認できる）。
+    """
+
+    def __init__(self, loader, index_root: str | Path = INDEX_DIR, poll_seconds: float = INDEX_POLL_SECONDS):
+        self.loader = loader
+        self.index_root = Path(index_root)
+        self.poll_seconds = poll_seconds
+        self._lock = threading.Lock()
+        self._listeners = []
+        self._retired = []
+        self._loading = None
+        self._failed = None
+        self._next_poll = 0.0
+        self.swaps = 0
+        self.last_swap_ms = 0.0
+
+        version, path = resolve(self.index_root)
+        self._current = _Snapshot(version, path, loader(path))
+        self._next_poll = time.monotonic() + poll_seconds
+
+    @property
+    def version(self) -> str:
+        return self._current.version
+
+    @property
+    def index(self):
+        """いまの版（参照カウントを取らない。短い読み取りや import 時の互換用）"""
+        return self._current.index
+
+    def on_swap(self, fn):
+        """差し替えたあとに fn(古い版, 新しい版) を呼ぶ（版ごとのキャッシュを捨てる用）"""
+        self._listeners.append(fn)
+        return fn
+
+    @contextmanager
+    def acquire(self):
+        self.maybe_refresh()
+        with self._lock:
+            snapshot = self._current
+            snapshot.refs += 1
+        try:
+            yield snapshot.index
+        finally:
+            with self._lock:
+                snapshot.refs -= 1
+                free = snapshot.retired and snapshot.refs == 0
+                if free and snapshot in self._retired:
+                    self._retired.remove(snapshot)
+            if free:
+                self._free(snapshot)
+
+    def maybe_refresh(self, wait: bool = False) -> bool:
+        """
+        CURRENT が変わっていたら新しい版を裏で読み込む（wait=True なら読み込みと差し替えを待つ）。
+        見に行くのは poll_seconds に 1 回だけ。差し替えを始めたら True を返す。
+        """
+        now = time.monotonic()
+        if not wait and now < self._next_poll:
+            return False
+        self._next_poll = now + self.poll_seconds
+        version, path = resolve(self.index_root)
+        with self._lock:
+            if version in (self._current.version, self._loading, self._failed):
+                return False
+            self._loading = version
+        if wait:
+            self._reload(version, path)
+        else:
+            threading.Thread(target=self._reload, args=(version, path), daemon=True,
+                             name=f"index-reload-{version}").start()
+        return True
+
+    def _reload(self, version: str, path: Path):
+        start = time.perf_counter()
+        try:
+            problems = verify(path)
+            if problems:
+                raise ValueError(f"manifest と合いません: {problems}")
+            index = self.loader(path)
+        except Exception as e:
+            print(f"インデックス {version} の読み込みに失敗しました（{self._current.version} のまま）: {e}")
+            with self._lock:
+                self._failed, self._loading = version, None
+            return
+
+        with self._lock:
+            old = self._current
+            self._current = _Snapshot(version, path, index)
+            self._loading = None
+            self.swaps += 1
+            self.last_swap_ms = (time.perf_counter() - start) * 1000
+            old.retired = True
+            free = old.refs == 0
+            if not free:
+                self._retired.append(old)
+        if free:
+            self._free(old)
+        for fn in self._listeners:
+            fn(old.version, version)
+
+    def _free(self, snapshot: _Snapshot):
+        """古い版を手放す（close() があれば呼ぶ。シャードのプールなど）"""
+        index, snapshot.index = snapshot.index, None
+        close = getattr(index, "close", None)
+        if close is not None:
+            close()
+
+    def in_use_versions(self) -> dict:
+        """版 -> いま使っている検索の数（差し替え待ちの古い版を含む）"""
+        with self._lock:
+            return {s.version: s.refs for s in [self._current, *self._retired]}
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"version": self._current.version, "swaps": self.swaps,
+                    "last_swap_ms": round(self.last_swap_ms, 1),
+                    "retired_in_use": len(self._retired), "failed": self._failed}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="インデックスの版の一覧・照合・切り替え")
+    parser.add_argument("--root", type=str, default=str(INDEX_DIR))
+    parser.add_argument("--list", action="store_true", help="版の一覧（* が CURRENT）")
+    parser.add_argument("--verify", type=str, nargs="?", const="", metavar="VERSION",
+                        help="manifest と照合する（省略時は CURRENT）")
+    parser.add_argument("--rollback", type=str, metavar="VERSION", help="CURRENT をこの版に切り替える")
+    parser.add_argument("--prune", action="store_true", help=f"古い版を {INDEX_KEEP_VERSIONS} 個だけ残して消す")
+    args = parser.parse_args()
+
+    if args.rollback:
+        switch_current(args.root, args.rollback)
+        print(f"CURRENT -> {args.rollback}")
+    if args.verify is not None:
+        version = args.verify or current_version(args.root)
+        if version is None:
+            print("版がありません（legacy）")
+        else:
+            problems = verify(Path(args.root) / VERSIONS / version)
+            print(f"{version}: {'OK' if not problems else problems}")
+    if args.prune:
+        print(f"削除: {prune(args.root)}")
+    if args.list or not (args.rollback or args.verify is not None or args.prune):
+        current = current_version(args.root)
+        for v in list_versions(args.root):
+            manifest = read_manifest(Path(args.root) / VERSIONS / v)
+            size = sum(f["bytes"] for f in manifest["files"].values())
+            print(f"{'*' if v == current else ' '} {v}  {manifest['created_at']}  {size / 1e6:.2f} MB  "
+                  f"{manifest.get('docs', '-')} docs")
+        if current is None:
+            print(f"  (CURRENT なし: {args.root} 直下を legacy として読みます)")
@@ -0,0 +1,274 @@
+"""
+SkyLore - 外向きの API 呼び出しのスケジューラ
+クエリ拡張・ストーリー生成・関連星座の整形・先読みが同じレート制限を取り合うので、
+すべての呼び出しをここを通して
+
+- 優先度クラス（interactive > story > decorative > prefetch）の順に実行し
+- RPM / TPM のトークンバケットで上限を守り
+- クラスごとに同時実行数を抑え
+- 待ち行列で待った時間をクラスごとに記録する
+
+優先度は段階名から決まる（LLM_STAGE_PRIORITY）。先読みやキャッシュ温めのように
+裏で動く処理は with use_priority("prefetch"): の中で呼ぶ。
+待っている呼び出しは tag で promote() できる（singleflight で上位の呼び出し元が相乗りしたときなど）。
+"""
+import contextvars
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+
+from config import (
+    OPENAI_MAX_CONCURRENCY,
+    OPENAI_RPM_LIMIT,
+    OPENAI_TPM_LIMIT,
+    LLM_PRIORITY_CLASSES,
+    LLM_CLASS_CONCURRENCY,
+    LLM_QUEUE_TIMEOUT_SEC,
+    LLM_STAGE_PRIORITY,
+)
+
+
+class SchedulerTimeout(TimeoutError):
+    """待ち行列で LLM_QUEUE_TIMEOUT_SEC を超えて待った（呼び出し側はフォールバックする）"""
+
+
+class TokenBucket:
+    """per_minute 個/分で貯まり、最大 per_minute 個まで持てるバケツ（ロックは呼び出し側で取る）"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, n: float) -> float:
+        """n 個取れるまでの秒数（今取れるなら 0）"""
+        self._refill()
+        n = min(n, self.capacity)
+        return 0.0 if self.tokens >= n else (n - self.tokens) / self.rate
+
+    def take(self, n: float):
+        self._refill()
+        self.tokens -= min(n, self.capacity)
+
+    def adjust(self, n: float):
+        """見積もりと実際の差を後から精算する（負にもなる）"""
+        self.tokens = min(self.capacity, self.tokens - n)
+
+
+# (上書きする優先度クラス または None, tag のタプル)
+_current_priority = contextvars.ContextVar("skylore_llm_priority", default=None)
+
+
+@contextmanager
+def use_priority(priority: str, tag=None):
+    """
+    この中で行う API 呼び出しの優先度クラスを上書きする。
+    tag を付けておくと、後から promote(tag, ...) で待ち行列の中の呼び出しの優先度を上げられる。
+    """
+    current = _current_priority.get()
+    tags = current[1] if current else ()
+    token = _current_priority.set((priority, tags + ((tag,) if tag is not None else ())))
+    try:
+        yield
+    finally:
+        _current_priority.reset(token)
+
+
+@contextmanager
+def use_tag(tag):
+    """
+    優先度クラスは変えずに、この中で行う API 呼び出しに tag を付ける。
+    tag に priority 属性があれば、並ぶときにその優先度まで上げる（並ぶ前に promote された分）。
+    """
+    current = _current_priority.get()
+    priority, tags = current if current else (None, ())
+    token = _current_priority.set((priority, tags + (tag,)))
+    try:
+        yield
+    finally:
+        _current_priority.reset(token)
+
+
+class _Ticket:
+    __slots__ = ("rank", "seq", "priority", "tags", "start", "deadline")
+
+    def __init__(self, priority: str, seq: int, tags: tuple, start: float, deadline: float):
+        self.priority = priority
+        self.rank = LLM_PRIORITY_CLASSES.index(priority)
+        self.seq = seq
+        self.tags = tags
+        self.start = start
+        self.deadline = deadline
+
+    def order(self):
+        return self.rank, self.seq
+
+
+class LLMScheduler:
+    """
+    run(stage, fn, ...) は順番と枠が回ってくるまで呼び出し元のスレッドで待ち、fn を呼んで結果を返す。
+
+    待っている呼び出しのうち、クラスの同時実行数に空きがあるものを優先度順・到着順に並べ、
+    先頭だけがレート制限の枠を取りに行く（下位のクラスが枠を先に使ってしまわないように）。
+    """
+
+    def __init__(self, rpm: int = OPENAI_RPM_LIMIT, tpm: int = OPENAI_TPM_LIMIT,
+                 max_concurrency: int = OPENAI_MAX_CONCURRENCY,
+                 class_concurrency: dict = LLM_CLASS_CONCURRENCY,
+                 queue_timeout: dict = LLM_QUEUE_TIMEOUT_SEC):
+        self.max_concurrency = max_concurrency
+        self.class_concurrency = dict(class_concurrency)
+        self.queue_timeout = dict(queue_timeout)
+        self._rpm = TokenBucket(rpm)
+        self._tpm = TokenBucket(tpm)
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._running = Counter()
+        self._seq = 0
+        self._metrics = {p: Counter() for p in LLM_PRIORITY_CLASSES}
+        self._waits_ms = {p: deque(maxlen=1000) for p in LLM_PRIORITY_CLASSES}
+
+    def resolve_priority(self, stage: str):
+        """(優先度クラス, tag のタプル) を返す（use_priority() の指定があればそちらを使う）"""
+        priority, tags = _current_priority.get() or (None, ())
+        return priority or LLM_STAGE_PRIORITY.get(stage, "decorative"), tags
+
+    def _head(self):
+        # 呼び出し側でロックを取っていること
+        free = [t for t in self._waiting if self._running[t.priority] < self.class_concurrency[t.priority]]
+        return min(free, key=_Ticket.order) if free else None
+
+    def _boost(self, ticket: _Ticket, priority: str) -> bool:
+        """
+        ticket の並び順を priority まで上げ、待ち時間の上限もそのクラスに合わせる
+        （クラスの数え方は元のまま。同時実行数の枠は元のクラスで取る）。呼び出し側でロックを取っていること
+        """
+        rank = LLM_PRIORITY_CLASSES.index(priority)
+        if ticket.rank <= rank:
+            return False
+        ticket.rank = rank
+        ticket.deadline = min(ticket.deadline, ticket.start + self.queue_timeout[priority])
+        self._metrics[ticket.priority]["promoted"] += 1
+        return True
+
+    def _acquire(self, priority: str, tags: tuple, est_tokens: int) -> tuple:
+        """枠が取れるまで待ち、(優先度クラス, 待った秒数) を返す"""
+        start = time.monotonic()
+        with self._cond:
+            self._seq += 1
+            ticket = _Ticket(priority, self._seq, tags, start, start + self.queue_timeout[priority])
+            self._waiting.append(ticket)
+            self._metrics[priority]["submitted"] += 1
+            # 並ぶ前に相乗りした上位の呼び出し元がいれば、その優先度で並ぶ
+            for tag in tags:
+                boost = getattr(tag, "priority", None)
+                if boost is not None:
+                    self._boost(ticket, boost)
+            try:
+                while True:
+                    now = time.monotonic()
+                    if now >= ticket.deadline:
+                        self._metrics[ticket.priority]["timed_out"] += 1
+                        raise SchedulerTimeout(f"{ticket.priority} の待ち行列で {now - start:.1f} 秒待ちました")
+                    wait = ticket.deadline - now
+                    if sum(self._running.values()) < self.max_concurrency and self._head() is ticket:
+                        delay = max(self._rpm.delay(1), self._tpm.delay(est_tokens))
+                        if delay <= 0:
+                            self._rpm.take(1)
+                            self._tpm.take(est_tokens)
+                            break
+                        wait = min(wait, delay)
+                    self._cond.wait(wait)
+            finally:
+                self._waiting.remove(ticket)
+                # 先頭が抜けたので、次の呼び出しに判定し直させる
+                self._cond.notify_all()
+            self._running[ticket.priority] += 1
+            waited = time.monotonic() - start
+            self._metrics[ticket.priority]["started"] += 1
+            self._metrics[ticket.priority]["queue_ms_total"] += waited * 1000
+            self._waits_ms[ticket.priority].append(waited * 1000)
+            return ticket.priority, waited
+
+    def _release(self, priority: str, ok: bool, token_diff: int):
+        with self._cond:
+            self._running[priority] -= 1
+            self._tpm.adjust(token_diff)
+            self._metrics[priority]["completed" if ok else "failed"] += 1
+            self._cond.notify_all()
+
+    def run(self, stage: str, fn, *args, est_tokens: int = 0, **kwargs):
+        """
+        stage の優先度で fn(*args, **kwargs) を呼ぶ。
+
+        est_tokens は TPM のために先に引いておく見積もり。戻り値に usage.total_tokens が
+        あれば、終わったあとで実際の値との差を精算する。
+        """
+        priority, tags = self.resolve_priority(stage)
+        priority, _ = self._acquire(priority, tags, est_tokens)
+        ok, actual = False, est_tokens
+        try:
+            result = fn(*args, **kwargs)
+            ok = True
+            usage = getattr(result, "usage", None)
+            actual = getattr(usage, "total_tokens", None) or est_tokens
+            return result
+        finally:
+            self._release(priority, ok, actual - est_tokens)
+
+    def promote(self, tag, priority: str):
+        """
+        tag の付いた、まだ待っている呼び出しの優先度を priority まで上げる（クリックされた先読みなど）。
+        待ち時間の上限も priority のものに縮める。
+        """
+        with self._cond:
+            for t in self._waiting:
+                if tag in t.tags:
+                    self._boost(t, priority)
+            self._cond.notify_all()
+
+    def stats(self) -> dict:
+        """クラスごとの件数・待ち時間（平均・p95・最大）・実行中と待ち中の数"""
+        with self._cond:
+            out = {}
+            for p in LLM_PRIORITY_CLASSES:
+                m = dict(self._metrics[p])
+                waits = sorted(self._waits_ms[p])
+                started = m.get("started", 0)
+                m["queue_ms_avg"] = m.pop("queue_ms_total", 0.0) / started if started else 0.0
+                m["queue_ms_p95"] = waits[min(len(waits) - 1, int(0.95 * len(waits)))] if waits else 0.0
+                m["queue_ms_max"] = waits[-1] if waits else 0.0
+                m["running"] = self._running[p]
+                m["queued"] = sum(1 for t in self._waiting if t.priority == p)
+                out[p] = m
+            out["rate"] = {"rpm_available": round(self._rpm.tokens, 1),
+                           "tpm_available": round(self._tpm.tokens)}
+        return out
+
+
+def estimate_tokens(messages: list, max_tokens: int | None = None) -> int:
+    """
+    TPM 用の大まかな見積もり（日本語は 1 文字 ≒ 1 トークンとして多めに見る）。
+    max_tokens の指定が無ければ出力は 500 トークンと見る。
+    """
+    prompt = sum(len(str(m.get("content", ""))) for m in messages)
+    return prompt + (max_tokens or 500)
+
+
+# プロセス全体で共有するスケジューラ
+_scheduler = LLMScheduler()
+
+
+def get_scheduler() -> LLMScheduler:
+    return _scheduler
+
+
+def get_scheduler_stats() -> dict:
+    return _scheduler.stats()
@@ -0,0 +1,91 @@
+"""
+SkyLore - LLM 利用量の記録モジュール
+API レスポンスの usage（prompt / cached / completion トークン）とレイテンシを
+パイプラインの段階（クエリ拡張・ストーリー生成など）ごとに集計する
+"""
+import threading
+import time
+
+from .query_log import note_api_call
+from .llm_scheduler import get_scheduler, estimate_tokens
+
+
+class UsageTracker:
+    """段階ごとのトークン数とレイテンシを集計するクラス"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+
+    def record(self, stage: str, usage=None, latency: float = 0.0):
+        """
+        1回分の呼び出しを記録する
+
+        Args:
+            stage: 段階名（例: "query_expansion"）
+            usage: レスポンスの usage（無い API なら None）
+            latency: 呼び出しにかかった秒数
+        """
+        prompt = getattr(usage, "prompt_tokens", 0) or 0
+        completion = getattr(usage, "completion_tokens", 0) or 0
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached = getattr(details, "cached_tokens", 0) or 0
+
+        with self._lock:
+            s = self._stages.setdefault(stage, {
+                "calls": 0,
+                "prompt_tokens": 0,
+                "cached_tokens": 0,
+                "completion_tokens": 0,
+                "latency_sec": 0.0,
+            })
+            s["calls"] += 1
+            s["prompt_tokens"] += prompt
+            s["cached_tokens"] += cached
+            s["completion_tokens"] += completion
+            s["latency_sec"] += latency
+        note_api_call(stage)
+
+    def summary(self) -> dict:
+        """段階ごとの合計と、キャッシュ率・平均レイテンシを返す"""
+        with self._lock:
+            stages = {name: dict(s) for name, s in self._stages.items()}
+        for s in stages.values():
+            s["cache_rate"] = s["cached_tokens"] / s["prompt_tokens"] if s["prompt_tokens"] else 0.0
+            s["avg_latency_sec"] = s["latency_sec"] / s["calls"] if s["calls"] else 0.0
+        return stages
+
+    def reset(self):
+        with self._lock:
+            self._stages = {}
+
+
+# プロセス全体で共有するトラッカー
+_tracker = UsageTracker()
+
+
+def get_usage_tracker() -> UsageTracker:
+    return _tracker
+
+
+def create_chat_completion(client, stage: str, **kwargs):
+    """
+    chat.completions.create をスケジューラ経由で（stage の優先度で）呼び、
+    usage とレイテンシ（待ち行列の時間は含めない）を stage 名で記録する
+
+    Args:
+        client: OpenAI クライアント
+        stage: 段階名
+        **kwargs: chat.completions.create にそのまま渡す引数
+
+    Returns:
+        API のレスポンス
+    """
+    def call():
+        start = time.perf_counter()
+        response = client.chat.completions.create(**kwargs)
+        _tracker.record(stage, getattr(response, "usage", None), time.perf_counter() - start)
+        return response
+
+    est_tokens = estimate_tokens(kwargs.get("messages", []), kwargs.get("max_tokens"))
+    return get_scheduler().run(stage, call, est_tokens=est_tokens)
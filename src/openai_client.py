@@ -0,0 +1,183 @@
+"""
+SkyLore - OpenAI クライアント共有モジュール
+プロセス全体で同期・非同期それぞれ1つの OpenAI クライアントを共有し、
+keep-alive 付きの HTTP コネクションプールを使い回す
+"""
+import os
+import threading
+
+import httpx
+from dotenv import load_dotenv
+from openai import AsyncOpenAI, OpenAI
+
+from config import (
+    OPENAI_MAX_CONCURRENCY,
+    OPENAI_KEEPALIVE_EXPIRY,
+    OPENAI_TIMEOUT,
+    OPENAI_MAX_RETRIES,
+)
+
+# .envファイルを読み込み
+load_dotenv()
+
+
+class ConnectionStats:
+    """コネクションの新規作成数と再利用数を数えるカウンタ"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+
+    def record_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def record_new_connection(self):
+        with self._lock:
+            self.new_connections += 1
+
+    def snapshot(self) -> dict:
+        """現在の値を辞書で返す（reused = 既存コネクションで送れたリクエスト数）"""
+        with self._lock:
+            reused = max(0, self.requests - self.new_connections)
+            return {
+                "requests": self.requests,
+                "new_connections": self.new_connections,
+                "reused_connections": reused,
+                "reuse_rate": reused / self.requests if self.requests else 0.0,
+            }
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.new_connections = 0
+
+    # httpcore の trace 拡張から呼ばれる
+    def trace(self, event_name: str, info: dict):
+        if event_name == "connection.connect_tcp.complete":
+            self.record_new_connection()
+
+    async def atrace(self, event_name: str, info: dict):
+        self.trace(event_name, info)
+
+
+class OpenAIClientProvider:
+    """
+    OpenAI クライアントを遅延生成して共有するプロバイダ
+
+    APIキーはサイドバーから後で設定されることもあるので、生成時に環境変数を読む。
+    キーが変わった場合だけクライアントを作り直す。古いクライアントは閉じずに参照を外すだけにする
+    （ほかのスレッドがまだ古いクライアントでリクエスト中のことがあるので、使い終わって
+    参照が無くなったときに GC でコネクションごと片付けさせる）。
+    """
+
+    def __init__(self, max_connections: int = OPENAI_MAX_CONCURRENCY,
+                 keepalive_expiry: float = OPENAI_KEEPALIVE_EXPIRY,
+                 timeout: float = OPENAI_TIMEOUT,
+                 max_retries: int = OPENAI_MAX_RETRIES):
+        self.max_connections = max_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.stats = ConnectionStats()
+        self._lock = threading.Lock()
+        self._client = None
+        self._async_client = None
+        self._api_key = None
+        self._async_api_key = None
+
+    def _get_api_key(self) -> str:
+        # OPENAI_API_KEY または OPENAI_KEY のどちらでも対応
+        api_key = os.getenv("OPENAI_API_KEY") or os.getenv("OPENAI_KEY")
+        if not api_key:
+            raise ValueError("APIキーが設定されていません。.envファイルにOPENAI_API_KEYを設定してください。")
+        return api_key
+
+    def _limits(self) -> httpx.Limits:
+        # 同時実行数の上限とプールサイズを揃えて、待ち行列は上位のスケジューラ側で持つ
+        return httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_connections,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+
+    def _on_request(self, request: httpx.Request):
+        self.stats.record_request()
+        request.extensions["trace"] = self.stats.trace
+
+    async def _on_async_request(self, request: httpx.Request):
+        self.stats.record_request()
+        request.extensions["trace"] = self.stats.atrace
+
+    def get_client(self) -> OpenAI:
+        """同期クライアントを返す（なければ作る）"""
+        api_key = self._get_api_key()
+        with self._lock:
+            if self._client is None or self._api_key != api_key:
+                # 古いクライアントは閉じない（使っているリクエストが終われば GC される）
+                http_client = httpx.Client(
+                    limits=self._limits(),
+                    timeout=self.timeout,
+                    event_hooks={"request": [self._on_request]},
+                )
+                self._client = OpenAI(
+                    api_key=api_key,
+                    http_client=http_client,
+                    max_retries=self.max_retries,
+                )
+                self._api_key = api_key
+            return self._client
+
+    def get_async_client(self) -> AsyncOpenAI:
+        """非同期クライアントを返す（なければ作る）"""
+        api_key = self._get_api_key()
+        with self._lock:
+            if self._async_client is None or self._async_api_key != api_key:
+                # 同期と同じく、古いクライアントは閉じずに差し替えるだけにする
+                http_client = httpx.AsyncClient(
+                    limits=self._limits(),
+                    timeout=self.timeout,
+                    event_hooks={"request": [self._on_async_request]},
+                )
+                self._async_client = AsyncOpenAI(
+                    api_key=api_key,
+                    http_client=http_client,
+                    max_retries=self.max_retries,
+                )
+                self._async_api_key = api_key
+            return self._async_client
+
+    def close(self):
+        """同期クライアントのコネクションプールを閉じる"""
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+            self._client = None
+            self._api_key = None
+
+
+# プロセス全体で共有するプロバイダ
+_provider = OpenAIClientProvider()
+
+
+def get_provider() -> OpenAIClientProvider:
+    return _provider
+
+
+def set_provider(provider: OpenAIClientProvider):
+    """プロバイダを差し替える（設定変更やテスト用のスタブ注入に使う）"""
+    global _provider
+    _provider = provider
+
+
+def get_openai_client() -> OpenAI:
+    return _provider.get_client()
+
+
+def get_async_openai_client() -> AsyncOpenAI:
+    return _provider.get_async_client()
+
+
+def get_connection_stats() -> dict:
+    return _provider.stats.snapshot()
@@ -0,0 +1,189 @@
+"""
+SkyLore - リクエスト単位のプロファイリングモジュール
+--debug（config.get_args）か SKYLORE_PROFILE=1 のときだけ、検索 1 回ごとに
+cProfile の pstats と、flamegraph.pl / speedscope で読める collapsed stack を
+PROFILE_DIR に保存する（古いものから PROFILE_KEEP 件を残して消す）。
+無効なときは nullcontext を返すだけなので、ほぼオーバーヘッドはない。
+"""
+import argparse
+import cProfile
+import pstats
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+
+from config import PROFILE_DIR, PROFILE_ENABLED, PROFILE_KEEP, PROFILE_SAMPLE_INTERVAL_SEC, get_args
+
+_enabled = None
+
+
+def is_profiling_enabled() -> bool:
+    """環境変数か --debug でプロファイリングが有効になっているか（初回だけ判定）"""
+    global _enabled
+    if _enabled is None:
+        _enabled = PROFILE_ENABLED or get_args().debug
+    return _enabled
+
+
+def set_profiling_enabled(enabled: bool):
+    """プロファイリングの有効・無効を切り替える（ベンチマークやスクリプトから使う）"""
+    global _enabled
+    _enabled = enabled
+
+
+class _StackSampler(threading.Thread):
+    """対象スレッドのスタックを一定間隔で覗き、collapsed stack の行ごとに数える"""
+
+    def __init__(self, thread_id: int, interval: float):
+        super().__init__(name="profile-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})"
+                             .replace(";", ":"))
+                frame = frame.f_back
+            if stack:
+                self.counts[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def _rotate(profile_dir: Path, keep: int):
+    """新しい順に keep リクエスト分だけ残す（.prof と .collapsed は同じ名前で 1 組）"""
+    stems = sorted({p.stem for p in profile_dir.glob("*.prof")} | {p.stem for p in profile_dir.glob("*.collapsed")})
+    for stem in stems[:max(0, len(stems) - keep)]:
+        for suffix in (".prof", ".collapsed"):
+            (profile_dir / f"{stem}{suffix}").unlink(missing_ok=True)
+
+
+@contextmanager
+def _profile(label: str, profile_dir: Path, keep: int):
+    profile_dir.mkdir(parents=True, exist_ok=True)
+    # ファイル名は時刻順に並ぶようにする（ローテーションは名前順で古いものから消す）
+    now = time.time_ns()
+    stem = (f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(now // 10**9))}-{now % 10**9:09d}"
+            f"-{label}-{uuid.uuid4().hex[:6]}")
+
+    sampler = _StackSampler(threading.get_ident(), PROFILE_SAMPLE_INTERVAL_SEC)
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # 別スレッドで既にプロファイル中（Python 3.12 以降は同時に 1 つまで）ならサンプリングだけ
+        profiler = None
+    sampler.start()
+    try:
+        yield profile_dir / stem
+    finally:
+        sampler.stop()
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_dir / f"{stem}.prof")
+        with (profile_dir / f"{stem}.collapsed").open("w", encoding="utf-8") as f:
+            for stack, count in sampler.counts.most_common():
+                f.write(f"{stack} {count}\n")
+        _rotate(profile_dir, keep)
+
+
+def profile_request(label: str = "request", profile_dir: str | Path = None, keep: int = PROFILE_KEEP):
+    """
+    with profile_request("search"): ... で囲んだ処理をプロファイルする
+
+    無効なときは nullcontext()（as で受けた値は None）。
+    有効なときは保存先のパス（拡張子なし）を返す。
+    """
+    if not is_profiling_enabled():
+        return nullcontext()
+    return _profile(label, Path(profile_dir or PROFILE_DIR), keep)
+
+
+# ================================================================
+# 複数リクエストをまとめた「重い関数」のレポート
+# ================================================================
+
+def top_hot_functions(n: int = 20, sort: str = "tottime", profile_dir: str | Path = None) -> list:
+    """
+    保存済みの .prof をすべて合算し、sort（"tottime" / "cumtime" / "ncalls"）の上位 n 関数を返す
+
+    Returns:
+        [{"function", "file", "line", "ncalls", "tottime", "cumtime"}, ...]
+    """
+    files = sorted(Path(profile_dir or PROFILE_DIR).glob("*.prof"))
+    if not files:
+        return []
+    stats = pstats.Stats(*map(str, files))
+    rows = []
+    for (filename, line, name), (_, ncalls, tottime, cumtime, _) in stats.stats.items():
+        rows.append({"function": name, "file": filename, "line": line,
+                     "ncalls": ncalls, "tottime": tottime, "cumtime": cumtime})
+    rows.sort(key=lambda r: r[sort], reverse=True)
+    return rows[:n]
+
+
+def format_hot_functions(rows: list) -> str:
+    lines = [f"{'tottime':>9} {'cumtime':>9} {'ncalls':>9}  function"]
+    for r in rows:
+        lines.append(f"{r['tottime']:9.4f} {r['cumtime']:9.4f} {r['ncalls']:9d}  "
+                     f"{r['function']} ({Path(r['file']).name}:{r['line']})")
+    return "\n".join(lines)
+
+
+def merge_collapsed(out_path: str | Path, profile_dir: str | Path = None) -> int:
+    """保存済みの collapsed stack を 1 ファイルに合算する（全リクエスト分の flamegraph 用）"""
+    counts = Counter()
+    for path in Path(profile_dir or PROFILE_DIR).glob("*.collapsed"):
+        with path.open("r", encoding="utf-8") as f:
+            for line in f:
+                stack, _, count = line.rstrip("\n").rpartition(" ")
+                if stack:
+                    counts[stack] += int(count)
+    with Path(out_path).open("w", encoding="utf-8") as f:
+        for stack, count in counts.most_common():
+            f.write(f"{stack} {count}\n")
+    return len(counts)
+
+
+def _measure_disabled_overhead(n: int = 1000000) -> float:
+    """無効時の profile_request の 1 回あたりのコスト（ナノ秒）"""
+    saved = _enabled
+    set_profiling_enabled(False)
+    start = time.perf_counter()
+    for _ in range(n):
+        with profile_request("noop"):
+            pass
+    set_profiling_enabled(saved)
+    return (time.perf_counter() - start) / n * 1e9
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="保存済みプロファイルの集計")
+    parser.add_argument("--dir", type=str, default=str(PROFILE_DIR))
+    parser.add_argument("--top", type=int, default=20)
+    parser.add_argument("--sort", choices=["tottime", "cumtime", "ncalls"], default="tottime")
+    parser.add_argument("--collapsed-out", type=str, default=None,
+                        help="全リクエスト分の collapsed stack を書き出すファイル")
+    args = parser.parse_args()
+
+    rows = top_hot_functions(args.top, args.sort, args.dir)
+    if rows:
+        print(format_hot_functions(rows))
+    else:
+        print(f"{args.dir} にプロファイルがありません（--debug か SKYLORE_PROFILE=1 で検索してください）")
+    if args.collapsed_out:
+        n = merge_collapsed(args.collapsed_out, args.dir)
+        print(f"📦 {n} stacks -> {args.collapsed_out}")
+    print(f"無効時のオーバーヘッド: {_measure_disabled_overhead():.0f} ns/request")
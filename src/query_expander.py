@@ -2,15 +2,27 @@
 SkyLore - クエリ拡張モジュール
 Gen-QERの仕組みを参考に、LLMを使ってあいまいなクエリを拡張する
 """
-import os
+import copy
+
 from dotenv import load_dotenv
 from openai import OpenAI
 
+from config import EXPANSION_CACHE_SIZE, LOCAL_NORMALIZE_ENABLED
+from .openai_client import get_openai_client
+from .llm_usage import create_chat_completion
+from .query_log import normalize_query
+from .query_normalizer import get_query_normalizer
+from .shared_cache import SharedLRUCache
+from .singleflight import coalesce
+
 # .envファイルを読み込み
 load_dotenv()
 
 # プロンプトテンプレート
-QUERY_EXPANSION_PROMPT = """あなたは星座検索システムのクエリ拡張アシスタントです。
+# 静的な指示はすべて system メッセージに置き、毎回同じ先頭部分（プレフィックス）にする。
+# 可変部分（ユーザー入力・星座情報）は user メッセージだけに入れることで、
+# API 側のプロンプトキャッシュがプレフィックスを再利用できるようにする。
+QUERY_EXPANSION_PROMPT = """あなたは星座検索システムのクエリ拡張アシスタントです。JSONのみを出力してください。
 ユーザーの入力から、星座検索に役立つキーワードを抽出・拡張してください。
 
 ## タスク
@@ -36,13 +48,11 @@ QUERY_EXPANSION_PROMPT = """あなたは星座検索システムのクエリ拡
 }
 
 ## ユーザー入力
+次のユーザーメッセージがユーザー入力です。
 """
 
-STORY_GENERATION_PROMPT = """あなたは星座の語り部です。
-以下の星座について、神話や見どころを魅力的に紹介してください。
-
-## 星座情報
-{constellation_data}
+STORY_GENERATION_PROMPT = """あなたは星座の魅力を伝える語り部です。
+ユーザーメッセージで与えられる星座について、神話や見どころを魅力的に紹介してください。
 
 ## ルール
 - 200文字程度で簡潔に
@@ -51,19 +61,25 @@ STORY_GENERATION_PROMPT = """あなたは星座の語り部です。
 - 親しみやすい語り口で
 
 ## 出力
+紹介文のみを出力してください。
 """
 
 
+# LLM で拡張できた結果だけを (モデル, 正規化クエリ) ごとに全セッションで共有する
+_expansion_cache = SharedLRUCache("expansion", EXPANSION_CACHE_SIZE)
+
+
+def get_expansion_cache() -> SharedLRUCache:
+    return _expansion_cache
+
+
 class QueryExpander:
     """LLMを使ったクエリ拡張クラス"""
     
-    def __init__(self, model: str = "gpt-4o-mini"):
+    def __init__(self, model: str = "gpt-4o-mini", client: OpenAI = None):
         self.model = model
-        # OPENAI_API_KEY または OPENAI_KEY のどちらでも対応
-        api_key = os.getenv("OPENAI_API_KEY") or os.getenv("OPENAI_KEY")
-        if not api_key:
-            raise ValueError("APIキーが設定されていません。.envファイルにOPENAI_API_KEYを設定してください。")
-        self.client = OpenAI(api_key=api_key)
+        # 共有クライアント（APIキー未設定なら ValueError）
+        self.client = client or get_openai_client()
     
     def expand(self, query: str) -> dict:
         """
@@ -75,26 +91,64 @@ class QueryExpander:
         Returns:
             拡張された検索情報を含む辞書
         """
+        key = (self.model, normalize_query(query))
+        cached = _expansion_cache.get(key)
+        if cached is not None:
+            return copy.deepcopy(cached)
+
+        # 英語・ローマ字のクエリを日本語の語に置き換えきれたら LLM は呼ばない
+        local = self.expand_romanized(query)
+        if local is not None:
+            return local
+
         try:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {"role": "system", "content": "あなたは星座検索のクエリ拡張アシスタントです。JSONのみを出力してください。"},
-                    {"role": "user", "content": QUERY_EXPANSION_PROMPT + query}
-                ],
-                temperature=0.3,
-                response_format={"type": "json_object"}
-            )
-            
-            import json
-            result = json.loads(response.choices[0].message.content)
-            return result
+            # 同じクエリの拡張が実行中なら、その結果を待って使う
+            result = coalesce("query_expansion", key, self._expand_with_llm, query, key)
+            return copy.deepcopy(result)
             
         except Exception as e:
             print(f"クエリ拡張エラー: {e}")
             # フォールバック: 基本的なキーワード抽出
             return self._fallback_expand(query)
     
+    def expand_locally(self, query: str) -> dict:
+        """
+        LLM を呼ばない拡張（query_planner がクエリ拡張を省くとき用）。
+        季節・月はフォールバックと同じ規則で推測し、検索には元のクエリをそのまま使う。
+        """
+        result = self._fallback_expand(query)
+        result["query"] = query
+        return result
+
+    def expand_romanized(self, query: str) -> dict | None:
+        """
+        英語・ローマ字のクエリを query_normalizer で置き換えた拡張結果（LLM を使わない）。
+        英字が無いか、置き換えられない語が残るか、日本語の部分に気温の数値などが
+        あれば（LLM に読み替えてもらう）None。
+        """
+        if not LOCAL_NORMALIZE_ENABLED:
+            return None
+        return get_query_normalizer().expand(query)
+
+    def _expand_with_llm(self, query: str, key: tuple) -> dict:
+        """LLM でクエリを拡張し、成功した結果を共有キャッシュに入れる"""
+        response = create_chat_completion(
+            self.client,
+            "query_expansion",
+            model=self.model,
+            messages=[
+                {"role": "system", "content": QUERY_EXPANSION_PROMPT},
+                {"role": "user", "content": query}
+            ],
+            temperature=0.3,
+            response_format={"type": "json_object"}
+        )
+        
+        import json
+        result = json.loads(response.choices[0].message.content)
+        _expansion_cache.put(key, copy.deepcopy(result))
+        return result
+    
     def _fallback_expand(self, query: str) -> dict:
         """APIエラー時のフォールバック処理"""
         keywords = []
@@ -145,47 +199,53 @@ class QueryExpander:
 class StoryGenerator:
     """星座のストーリーを生成するクラス"""
     
-    def __init__(self, model: str = "gpt-4o-mini"):
+    def __init__(self, model: str = "gpt-4o-mini", client: OpenAI = None):
         self.model = model
-        # OPENAI_API_KEY または OPENAI_KEY のどちらでも対応
-        api_key = os.getenv("OPENAI_API_KEY") or os.getenv("OPENAI_KEY")
-        if not api_key:
-            raise ValueError("APIキーが設定されていません。.envファイルにOPENAI_API_KEYを設定してください。")
-        self.client = OpenAI(api_key=api_key)
+        # 共有クライアント（APIキー未設定なら ValueError）
+        self.client = client or get_openai_client()
     
-    def generate(self, constellation_data: dict, related_constellations: list = None) -> str:
+    @staticmethod
+    def fallback(constellation_data: dict) -> str:
+        """生成できなかったときに代わりに返す文章（既存の神話、無ければ星座名だけ）"""
+        if constellation_data.get("myth_summary"):
+            return constellation_data["myth_summary"]
+        return f"{constellation_data['jp_name']}の星座です。"
+
+    def generate(self, constellation_data: dict, related_constellations: list = None,
+                 raise_errors: bool = False) -> str:
         """
         星座のストーリーを生成する
         
         Args:
             constellation_data: 星座の情報
             related_constellations: 関連する星座のリスト
+            raise_errors: True なら API エラーをそのまま投げる（キャッシュする側で使う）。
+                False なら fallback() の文章を返す
         
         Returns:
             生成されたストーリー文字列
         """
         # 既存の神話がある場合はそれをベースに
-        if constellation_data.get("myth_summary"):
-            base_story = constellation_data["myth_summary"]
-        else:
-            base_story = f"{constellation_data['jp_name']}の星座です。"
+        base_story = self.fallback(constellation_data)
         
         # 関連星座の情報を追加
         context = f"""
 星座名: {constellation_data['jp_name']}
 英語名: {constellation_data['id']}
 神話: {base_story}
-見頃の月: {constellation_data.get('best_months', [])}
+見頃の月: {list(constellation_data.get('best_months', []))}
 """
         if related_constellations:
             context += f"関連星座: {', '.join(related_constellations)}\n"
         
         try:
-            response = self.client.chat.completions.create(
+            response = create_chat_completion(
+                self.client,
+                "story",
                 model=self.model,
                 messages=[
-                    {"role": "system", "content": "あなたは星座の魅力を伝える語り部です。"},
-                    {"role": "user", "content": STORY_GENERATION_PROMPT.format(constellation_data=context)}
+                    {"role": "system", "content": STORY_GENERATION_PROMPT},
+                    {"role": "user", "content": f"## 星座情報\n{context}"}
                 ],
                 temperature=0.7,
                 max_tokens=300
@@ -194,6 +254,8 @@ class StoryGenerator:
             
         except Exception as e:
             print(f"ストーリー生成エラー: {e}")
+            if raise_errors:
+                raise
             return base_story
 
 
@@ -0,0 +1,281 @@
+"""
+SkyLore - 検索クエリの構造化ログモジュール
+検索 1 回ごとに（正規化クエリ・拡張クエリ・結果の id・段階ごとの時間・
+キャッシュのヒット・API 呼び出し回数）を 1 行の JSON にして、
+バックグラウンドのスレッドがローテーション付きの JSONL ファイルに書き出す。
+ストーリーの表示も "event": "story" の記録として同じファイルに残す（検索の記録には event が無い）。
+query_replay.py でこのログを読み直して負荷試験やキャッシュサイズの見積もりに使う。
+"""
+import contextvars
+import json
+import queue
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+
+from config import (
+    QUERY_LOG_ENABLED,
+    QUERY_LOG_PATH,
+    QUERY_LOG_MAX_BYTES,
+    QUERY_LOG_BACKUPS,
+    QUERY_LOG_QUEUE_SIZE,
+)
+
+
+def normalize_query(query: str) -> str:
+    """ログ・キャッシュのキー用の正規化（NFKC、小文字化、空白の整理）"""
+    text = unicodedata.normalize("NFKC", query or "").lower()
+    return re.sub(r"\s+", " ", text).strip()
+
+
+# ================================================================
+# リクエスト単位の計測（段階ごとの時間・キャッシュ・API 呼び出し）
+# ================================================================
+
+class RequestTrace:
+    """
+    1 回の検索リクエストの中で起きたことを集める
+    （QueryRouter のスレッドからも contextvars ごと引き継いで書き込むので、更新は _lock の中で行う）
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self.timings_ms = {}
+        self.cache_hits = {}        # キャッシュ名 -> {"hit": n, "miss": n}
+        self.api_calls = Counter()  # 段階名 -> 呼び出し回数
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            with self._lock:
+                self.timings_ms[name] = self.timings_ms.get(name, 0.0) + elapsed_ms
+
+    def total_ms(self) -> float:
+        return (time.perf_counter() - self._start) * 1000
+
+
+_current_trace = contextvars.ContextVar("skylore_request_trace", default=None)
+
+
+@contextmanager
+def trace_request():
+    """with trace_request() as trace: の中で起きた API 呼び出しやキャッシュ参照を trace に集める"""
+    trace = RequestTrace()
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+
+def note_api_call(stage: str):
+    """API を 1 回呼んだことを、いまのリクエストがあれば記録する（llm_usage から呼ばれる）"""
+    trace = _current_trace.get()
+    if trace is not None:
+        with trace._lock:
+            trace.api_calls[stage] += 1
+
+
+def note_cache(name: str, hit: bool):
+    """キャッシュを引いた結果を、いまのリクエストがあれば記録する"""
+    trace = _current_trace.get()
+    if trace is not None:
+        with trace._lock:
+            counts = trace.cache_hits.setdefault(name, {"hit": 0, "miss": 0})
+            counts["hit" if hit else "miss"] += 1
+
+
+# ================================================================
+# バックグラウンドで JSONL に書き出すロガー
+# ================================================================
+
+class QueryLogWriter:
+    """
+    log() はキューに積むだけで戻り、書き込み・ローテーションは専用スレッドが行う。
+    キューがあふれたら記録を捨てて dropped を数える（検索は待たせない）。
+    ファイルに書けなかったとき（OSError）はその分を dropped に数え、error に理由を残す。
+    次に積まれた分で開き直す。
+    """
+
+    def __init__(self, path: str | Path = QUERY_LOG_PATH, max_bytes: int = QUERY_LOG_MAX_BYTES,
+                 backups: int = QUERY_LOG_BACKUPS, queue_size: int = QUERY_LOG_QUEUE_SIZE):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.written = 0
+        self.dropped = 0
+        self.error = None   # 直近の書き込みエラー（書けたら None に戻る）
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._run, name="query-log-writer", daemon=True)
+        self._thread.start()
+
+    def log(self, record: dict):
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def log_search(self, trace: RequestTrace, query: str, expanded_query, results: list,
+                   session_id: str = None, **extra):
+        """検索 1 回分の記録を作って積む（results は [(星座, score), ...]）"""
+        record = {
+            "ts": trace.started,
+            "session": session_id,
+            "query": query,
+            "normalized_query": normalize_query(query),
+            "expanded_query": expanded_query,
+            "result_ids": [c.get("id") for c, _ in results],
+            "scores": [round(float(s), 6) for _, s in results],
+            "timings_ms": {**{k: round(v, 3) for k, v in trace.timings_ms.items()},
+                           "total": round(trace.total_ms(), 3)},
+            "cache_hits": trace.cache_hits,
+            "api_calls": dict(trace.api_calls),
+        }
+        record.update(extra)
+        self.log(record)
+
+    def log_story(self, trace: RequestTrace, constellation_id: str, session_id: str = None, **extra):
+        """ストーリー表示 1 回分の記録を作って積む（先読みキャッシュのヒットは trace.cache_hits["story"]）"""
+        record = {
+            "ts": trace.started,
+            "session": session_id,
+            "event": "story",
+            "constellation_id": constellation_id,
+            "timings_ms": {**{k: round(v, 3) for k, v in trace.timings_ms.items()},
+                           "total": round(trace.total_ms(), 3)},
+            "cache_hits": trace.cache_hits,
+            "api_calls": dict(trace.api_calls),
+        }
+        record.update(extra)
+        self.log(record)
+
+    def stats(self) -> dict:
+        return {"path": str(self.path), "written": self.written, "dropped": self.dropped,
+                "queued": self._queue.qsize(), "error": self.error}
+
+    def flush(self, timeout: float = 5.0):
+        """キューに積まれた分が書き終わるまで待つ（テストやリプレイの終了時用）"""
+        done = threading.Event()
+        self.log(done)
+        done.wait(timeout)
+
+    def _rotate(self):
+        # query_log.jsonl -> .1 -> .2 ... と RotatingFileHandler と同じ順で送る
+        for i in range(self.backups - 1, 0, -1):
+            src = self.path.with_name(f"{self.path.name}.{i}")
+            if src.exists():
+                src.replace(self.path.with_name(f"{self.path.name}.{i + 1}"))
+        if self.backups > 0:
+            self.path.replace(self.path.with_name(f"{self.path.name}.1"))
+        else:
+            self.path.unlink()
+
+    def _open(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        f = self.path.open("a", encoding="utf-8")
+        return f, f.tell()
+
+    def _fail(self, e: OSError, lost: int):
+        """書き込みエラーを残す（同じエラーは 1 回だけ表示する）"""
+        error = f"{type(e).__name__}: {e}"
+        if error != self.error:
+            print(f"クエリログを書き込めません: {error}")
+        self.error = error
+        self.dropped += lost
+
+    def _run(self):
+        f, size = None, 0
+        while True:
+            item = self._queue.get()
+            # 溜まっている分はまとめて書いてから flush する
+            batch = [item]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            events = [r for r in batch if isinstance(r, threading.Event)]
+            records = [r for r in batch if not isinstance(r, threading.Event)]
+            written = 0
+            try:
+                if f is None:
+                    f, size = self._open()
+                for record in records:
+                    try:
+                        line = json.dumps(record, ensure_ascii=False, default=str) + "\n"
+                    except Exception as e:
+                        print(f"クエリログのエラー: {e}")
+                        written += 1
+                        continue
+                    if size and size + len(line.encode("utf-8")) > self.max_bytes:
+                        f.close()
+                        self._rotate()
+                        f, size = self._open()
+                    f.write(line)
+                    size += len(line.encode("utf-8"))
+                    written += 1
+                    self.written += 1
+                f.flush()
+                self.error = None
+            except OSError as e:
+                # 書けなかった分は捨て、次の分で開き直す（スレッドは止めない）
+                self._fail(e, len(records) - written)
+                if f is not None:
+                    try:
+                        f.close()
+                    except OSError:
+                        pass
+                f = None
+            for event in events:
+                event.set()
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_query_log() -> QueryLogWriter | None:
+    """共有のログライターを返す（QUERY_LOG_ENABLED が偽なら None）"""
+    global _writer
+    if not QUERY_LOG_ENABLED:
+        return None
+    with _writer_lock:
+        if _writer is None:
+            _writer = QueryLogWriter()
+    return _writer
+
+
+def read_query_log(path: str | Path = QUERY_LOG_PATH, event: str | None = "search") -> list:
+    """
+    ローテーション済みのファイルも含めて、古い順に記録を読み込む
+    event の種類の記録だけを返す（既定は検索。None なら全部）
+    """
+    path = Path(path)
+    files = sorted(path.parent.glob(f"{path.name}.*"),
+                   key=lambda p: int(p.suffix[1:]) if p.suffix[1:].isdigit() else 0, reverse=True)
+    records = []
+    for p in [*files, path]:
+        if not p.exists():
+            continue
+        with p.open("r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue   # 書きかけの行などは読み飛ばす
+                    if event is None or record.get("event", "search") == event:
+                        records.append(record)
+    records.sort(key=lambda r: r.get("ts", 0))
+    return records
@@ -0,0 +1,522 @@
+"""
+SkyLore - 英語・ローマ字のクエリを、その場で索引にある日本語の語に置き換える
+「orion in winter」「orion-za」「stars visible in january」のようなクエリは、いまは LLM の
+クエリ拡張がなければ何も引けない（tokenize_ja は英数字だけのトークンを落とすので、BM25 に届かない）。
+ここでは次の表を起動時に一度だけ作り、クエリの英単語を先頭から最長一致で置き換える。
+
+- 星座の id（"Orion" / "Canis Major"）と inverted_index.json の英字の見出し語（"ursamajor"）-> 和名
+- 英語の通称（"swan" / "great bear"）-> 和名、輝星・星雲星団の英名とメシエ番号 -> 和名と星座
+- 月（january / jan）と季節（winter / fall）、星や神話に関する少しの英単語 -> 日本語の語
+- どれにも当たらない語は、ローマ字をひらがなにして fuzzy_names で星座名を引く（"sasori-za"）。
+  英字の id の打ち間違い（"orian"）も fuzzy_names で引く
+
+英単語が（前置詞などを除いて）すべて置き換えられ、日本語の部分に気温の数値のような LLM に読み替えて
+ほしい表現（NEEDS_EXPANSION）が無ければ、QueryExpander は LLM を呼ばずにこの結果を使う。
+
+    python -m src.query_normalizer --query "orion in winter" "hakuchou-za no shinwa"
+    python -m src.query_normalizer --bench      # 手で書いた英語クエリと検索ログの英語クエリで評価
+"""
+import argparse
+import csv
+import json
+import re
+import time
+import unicodedata
+from pathlib import Path
+
+from config import (
+    CONSTELLATION_DATA_PATH,
+    INVERTED_INDEX_PATH,
+    STAR_CATALOGUE_PATH,
+    DEEP_SKY_CATALOGUE_PATH,
+    SEASON_TO_MONTHS,
+)
+from .fuzzy_names import get_fuzzy_index
+
+# ================================================================
+# ローマ字 -> ひらがな
+# ================================================================
+
+def _romaji_table() -> dict:
+    table = {"a": "あ", "i": "い", "u": "う", "e": "え", "o": "お",
+             "ya": "や", "yu": "ゆ", "yo": "よ", "wa": "わ", "wo": "を",
+             "shi": "し", "chi": "ち", "tsu": "つ", "fu": "ふ", "ji": "じ"}
+    rows = {"k": "かきくけこ", "s": "さしすせそ", "t": "たちつてと", "n": "なにぬねの", "h": "はひふへほ",
+            "m": "まみむめも", "r": "らりるれろ", "g": "がぎぐげご", "z": "ざじずぜぞ", "d": "だぢづでど",
+            "b": "ばびぶべぼ", "p": "ぱぴぷぺぽ"}
+    for c, kana in rows.items():
+        for v, k in zip("aiueo", kana):
+            table.setdefault(c + v, k)
+    # 拗音（kya / sha / cha / ja と訓令式の sya / tya / zya）
+    for head, i_kana in {"k": "き", "g": "ぎ", "n": "に", "h": "ひ", "m": "み", "r": "り", "b": "び",
+                         "p": "ぴ", "s": "し", "t": "ち", "z": "じ", "sh": "し", "ch": "ち", "j": "じ"}.items():
+        y = "" if head in ("sh", "ch", "j") else "y"
+        for v, small in zip("auo", "ゃゅょ"):
+            table[head + y + v] = i_kana + small
+    for head, kana in {"sh": "し", "ch": "ち", "j": "じ"}.items():
+        table[head + "e"] = kana + "ぇ"
+    for v, small in zip("aieo", "ぁぃぇぉ"):
+        table["f" + v] = "ふ" + small
+    return table
+
+
+_ROMAJI = _romaji_table()
+_VOWELS = "aiueo"
+# 長音記号つきの母音（"hakuchō" など）
+_MACRONS = str.maketrans({"ā": "aa", "ī": "ii", "ū": "uu", "ē": "ee", "ō": "ou", "â": "aa", "î": "ii",
+                          "û": "uu", "ê": "ee", "ô": "ou"})
+
+
+def romaji_to_hiragana(word: str) -> str | None:
+    """ヘボン式・訓令式のローマ字をひらがなにする（ローマ字として読めなければ None）"""
+    word = word.lower().translate(_MACRONS).replace("-", "")
+    out, i = [], 0
+    while i < len(word):
+        ch = word[i]
+        nxt = word[i + 1] if i + 1 < len(word) else ""
+        if ch == "'":
+            i += 1
+            continue
+        if ch == "n" and nxt not in _VOWELS + "y":
+            out.append("ん")
+            i += 1
+            continue
+        # 促音（"kk" / "tch"）
+        if ch == nxt and ch not in _VOWELS or (ch, nxt) == ("t", "c"):
+            out.append("っ")
+            i += 1
+            continue
+        for size in (3, 2, 1):
+            kana = _ROMAJI.get(word[i:i + size])
+            if kana is not None:
+                out.append(kana)
+                i += size
+                break
+        else:
+            return None
+    return "".join(out)
+
+
+# ================================================================
+# 英語の語 -> 日本語の語
+# ================================================================
+
+_MONTHS = ["january", "february", "march", "april", "may", "june", "july", "august",
+           "september", "october", "november", "december"]
+_SEASONS = {"winter": "冬", "wintertime": "冬", "summer": "夏", "summertime": "夏", "spring": "春",
+            "springtime": "春", "autumn": "秋", "fall": "秋"}
+
+# 英語の通称 -> 星座の id
+_COMMON_NAMES = {
+    "swan": "Cygnus", "scorpion": "Scorpius", "lion": "Leo", "bull": "Taurus", "twins": "Gemini",
+    "crab": "Cancer", "ram": "Aries", "fish": "Pisces", "fishes": "Pisces", "water bearer": "Aquarius",
+    "archer": "Sagittarius", "scales": "Libra", "virgin": "Virgo", "maiden": "Virgo",
+    "sea goat": "Capricornus", "goat": "Capricornus", "great bear": "Ursa Major", "little bear": "Ursa Minor",
+    "eagle": "Aquila", "lyre": "Lyra", "harp": "Lyra", "dragon": "Draco", "big dog": "Canis Major",
+    "great dog": "Canis Major", "little dog": "Canis Minor", "lesser dog": "Canis Minor", "whale": "Cetus",
+    "dolphin": "Delphinus", "hare": "Lepus", "crow": "Corvus", "charioteer": "Auriga", "herdsman": "Bootes",
+    "northern crown": "Corona Borealis", "southern crown": "Corona Australis", "winged horse": "Pegasus",
+    "serpent bearer": "Ophiuchus", "serpent": "Serpens", "peacock": "Pavo", "wolf": "Lupus",
+    "centaur": "Centaurus", "water snake": "Hydra", "unicorn": "Monoceros", "giraffe": "Camelopardalis",
+    "little horse": "Equuleus", "fox": "Vulpecula", "little lion": "Leo Minor", "cup": "Crater",
+    "arrow": "Sagitta", "lizard": "Lacerta", "crane": "Grus", "dove": "Columba", "toucan": "Tucana",
+    "fly": "Musca", "triangle": "Triangulum", "river": "Eridanus", "shield": "Scutum", "keel": "Carina",
+    "sails": "Vela", "stern": "Puppis", "hunting dogs": "Canes Venatici", "southern cross": "Crux",
+    "berenice's hair": "Coma Berenices", "queen": "Cassiopeia", "king": "Cepheus", "princess": "Andromeda",
+}
+
+# 星・神話まわりの英単語 -> 日本語の語（索引の本文に出てくる言い方に寄せる）
+_GLOSSARY = {
+    "star": "星", "stars": "星", "constellation": "星座", "constellations": "星座",
+    "bright": "明るい", "brightest": "明るい", "myth": "神話", "myths": "神話", "mythology": "神話",
+    "legend": "伝説", "legends": "伝説", "story": "神話", "stories": "神話",
+    "nebula": "星雲", "nebulae": "星雲", "cluster": "星団", "clusters": "星団",
+    "galaxy": "銀河", "galaxies": "銀河", "milky way": "天の川",
+    "winter triangle": "冬の大三角", "summer triangle": "夏の大三角", "spring triangle": "春の大三角",
+    "great square": "秋の四辺形", "big dipper": "北斗七星", "plough": "北斗七星", "plow": "北斗七星",
+    "north star": "北極星", "pole star": "北極星", "zodiac": "黄道", "hero": "英雄", "heroes": "英雄",
+    "god": "神", "gods": "神", "goddess": "女神", "hunter": "狩人", "south": "南", "southern": "南",
+    "north": "北", "northern": "北", "meteor shower": "流星群", "first magnitude": "一等星",
+}
+
+# ローマ字で書かれた日本語の語（"sasori-za no shinwa"）
+_ROMAJI_WORDS = {
+    "hoshi": "星", "seiza": "星座", "shinwa": "神話", "densetsu": "伝説", "akarui": "明るい",
+    "fuyu": "冬", "natsu": "夏", "haru": "春", "aki": "秋", "minami": "南", "kita": "北",
+    "seiun": "星雲", "seidan": "星団", "ginga": "銀河", "amanogawa": "天の川",
+}
+
+# 置き換えなくても意味が落ちない語（これだけのクエリは「置き換えた」と数えない）
+# 後半はローマ字の助詞と言い回し（"no" / "ga mitai"）
+_STOPWORDS = set("""
+a an the in on at of to for from with and or is are was be can could do does i me my we you your it its
+this that these those what which where when how who why show tell find look looking want wanna see seen
+visible view watch please about some any there here best good nice like near around during sky skies
+night nights tonight evening today time up out get may
+no wa ga wo ni de mo ya ka kara made mitai miru mieru oshiete doko desu
+""".split())
+
+# "orion-za" / "orion za" の「座」
+_ZA = "za"
+_WORD = re.compile(r"[a-z][a-z0-9'’\-]*|\d+|[^\sa-z0-9]+")
+_ASCII_WORD = re.compile(r"^[a-z]")
+_PUNCT = re.compile(r"^[\W_]+$")
+# LLM に読み替えてほしい表現（気温の数値など。フォールバックの規則では粗すぎる）
+NEEDS_EXPANSION = re.compile(r"\d+\s*(度|℃)|気温")
+# 表を引くときの最長のフレーズ（語数）
+_MAX_PHRASE = 4
+# 末尾の s を落として引いてよい種類（月・季節の略称には使わない）
+_PLURAL_KINDS = ("glossary", "common_name")
+# "may" を 5 月と読むのは、この語の後か、クエリが "may" だけのとき（ほかは助動詞として _STOPWORDS に回す）
+_MAY = "may"
+_MONTH_PREPOSITIONS = {"in", "during", "of"}
+
+
+class QueryNormalizer:
+    """
+    add(phrase, terms, kind, ...) で英語のフレーズを足して normalize(query) で置き換える。
+    phrase は小文字・空白区切りで持つ。
+    """
+
+    def __init__(self):
+        self.phrases = {}   # フレーズ -> {"terms", "kind", "months", "season", "hints"}
+        self.jp_names = {}  # id -> 和名
+
+    def add(self, phrase: str, terms, kind: str, months=(), season=None, hints=()):
+        phrase = " ".join(unicodedata.normalize("NFKC", phrase).lower().split())
+        if phrase and phrase not in self.phrases:
+            self.phrases[phrase] = {"terms": [t for t in terms if t], "kind": kind, "months": list(months),
+                                    "season": season, "hints": list(hints)}
+
+    def _lookup(self, phrase: str):
+        entry = self.phrases.get(phrase)
+        if entry is None and phrase.endswith("s") and len(phrase) > 3:
+            # 複数形は通称と用語だけ（"mars" を月の略称 "mar" と読まない）
+            entry = self.phrases.get(phrase[:-1])
+            if entry is not None and entry["kind"] not in _PLURAL_KINDS:
+                entry = None
+        if entry is None and " " in phrase:
+            entry = self.phrases.get(phrase.replace(" ", ""))
+        return entry
+
+    def _from_fuzzy(self, text: str, kind: str):
+        match = get_fuzzy_index().best(text)
+        if match is None:
+            return None
+        names = [self.jp_names[i] for i in match["ids"] if i in self.jp_names]
+        if match["kind"] == "keyword":
+            return {"terms": [match["surface"]], "kind": kind, "months": [], "season": None, "hints": []}
+        return {"terms": names, "kind": kind, "months": [], "season": None, "hints": names}
+
+    def _match_word(self, word: str):
+        """1 語の置き換え（表、「座」付き、英字 id の打ち間違い、ローマ字の順に試す）"""
+        entry = self._lookup(word)
+        if entry is not None:
+            return entry
+        bare = word.replace("-", "")
+        if bare.endswith(_ZA) and len(bare) > len(_ZA) + 1:
+            stem = bare[:-len(_ZA)].rstrip("-")
+            entry = self._lookup(stem)
+            if entry is not None:
+                return entry
+            kana = romaji_to_hiragana(stem)
+            if kana:
+                entry = self._from_fuzzy(kana + "座", "romaji")
+                if entry is not None:
+                    return entry
+        if len(bare) >= 4:
+            entry = self._from_fuzzy(bare, "fuzzy")
+            if entry is not None:
+                return entry
+        if len(bare) >= 3:
+            kana = romaji_to_hiragana(bare)
+            if kana:
+                return self._from_fuzzy(kana, "romaji")
+        return None
+
+    def normalize(self, query: str) -> dict | None:
+        """
+        英字を含むクエリを置き換えた結果を返す（英字が無ければ None）。
+
+        {"query": 置き換えた日本語のクエリ, "terms", "months", "season", "constellation_hints",
+         "mapped": [(元の語, 置き換えた語, 種類)], "unmapped": [置き換えられなかった語],
+         "remainder": 英字以外で残した部分, "complete": bool}
+
+        complete は、英単語が（_STOPWORDS を除いて）すべて置き換えられ、1 つ以上あり、
+        残した日本語の部分に NEEDS_EXPANSION の表現が無いとき True
+        （"最高気温10度の日 stars" は stars が置き換えられても LLM に回す）。
+        """
+        text = unicodedata.normalize("NFKC", query or "").lower().replace("’", "'")
+        if not re.search(r"[a-z]", text):
+            return None
+        tokens = _WORD.findall(text)
+        # "orion za" の za は前の語に付ける
+        merged = []
+        for t in tokens:
+            if t == _ZA and merged and _ASCII_WORD.match(merged[-1]):
+                merged[-1] += "-" + _ZA
+            else:
+                merged.append(t)
+        tokens = merged
+
+        parts, terms, months, seasons, hints, mapped, unmapped, remainder = [], [], [], [], [], [], [], []
+        i = 0
+        while i < len(tokens):
+            token = tokens[i]
+            if not _ASCII_WORD.match(token):
+                # 日本語の部分と数字はそのまま残す
+                if not _PUNCT.match(token):
+                    parts.append(token)
+                    remainder.append(token)
+                i += 1
+                continue
+
+            # 表は最長一致（"great bear" を "great" + "bear" より先に）
+            entry, size = None, 1
+            for n in range(min(_MAX_PHRASE, len(tokens) - i), 1, -1):
+                words = tokens[i:i + n]
+                if all(_ASCII_WORD.match(w) for w in words):
+                    entry = self._lookup(" ".join(words))
+                    if entry is not None:
+                        size = n
+                        break
+            source = " ".join(tokens[i:i + size])
+            if entry is None:
+                may_month = token == _MAY and (len(tokens) == 1 or (i > 0 and tokens[i - 1] in _MONTH_PREPOSITIONS))
+                if token in _STOPWORDS and not may_month:
+                    i += 1
+                    continue
+                entry = self._match_word(token)
+            i += size
+            if entry is None:
+                unmapped.append(source)
+                continue
+            parts.extend(entry["terms"])
+            terms.extend(t for t in entry["terms"] if t not in terms)
+            months.extend(m for m in entry["months"] if m not in months)
+            if entry["season"] and entry["season"] not in seasons:
+                seasons.append(entry["season"])
+            hints.extend(h for h in entry["hints"] if h not in hints)
+            mapped.append((source, " ".join(entry["terms"]), entry["kind"]))
+
+        remainder = " ".join(remainder)
+        return {
+            "query": " ".join(parts),
+            "terms": terms,
+            "months": months,
+            "season": seasons[0] if len(seasons) == 1 else None,
+            "constellation_hints": hints,
+            "mapped": mapped,
+            "unmapped": unmapped,
+            "remainder": remainder,
+            "complete": bool(mapped) and not unmapped and not NEEDS_EXPANSION.search(remainder),
+        }
+
+    def expand(self, query: str) -> dict | None:
+        """
+        LLM のクエリ拡張と同じ形の結果（置き換えきれなければ None）。
+        検索には "query" の日本語のクエリを使う。
+        """
+        result = self.normalize(query)
+        if result is None or not result["complete"]:
+            return None
+        return {
+            "season": result["season"],
+            "months": result["months"],
+            "keywords": result["terms"],
+            "constellation_hints": result["constellation_hints"],
+            "query": result["query"],
+            "normalized_from": query,
+        }
+
+    def __len__(self):
+        return len(self.phrases)
+
+
+def _read_csv(path: Path) -> list:
+    if not path.exists():
+        return []
+    with path.open("r", encoding="utf-8", newline="") as f:
+        return list(csv.DictReader(f))
+
+
+def build_query_normalizer(data_path: str | Path = CONSTELLATION_DATA_PATH,
+                           inverted_index_path: str | Path = INVERTED_INDEX_PATH,
+                           star_path: str | Path = STAR_CATALOGUE_PATH,
+                           deep_sky_path: str | Path = DEEP_SKY_CATALOGUE_PATH) -> QueryNormalizer:
+    """星座データ・inverted_index.json・輝星と星雲星団のカタログと、上の表から作る"""
+    with Path(data_path).open("r", encoding="utf-8") as f:
+        constellations = json.load(f)
+    qn = QueryNormalizer()
+    names = qn.jp_names
+    for c in constellations:
+        names[c["id"]] = c.get("jp_name", c["id"])
+
+    for cid, jp_name in names.items():
+        qn.add(cid, [jp_name], "id", hints=[jp_name])
+    # inverted_index.json の英字の見出し語（"ursamajor" のように空白の無いものを含む）
+    path = Path(inverted_index_path)
+    if path.exists():
+        with path.open("r", encoding="utf-8") as f:
+            for term, ids in json.load(f).items():
+                ids = [i for i in ids if i in names]
+                if re.fullmatch(r"[A-Za-z][A-Za-z ]*", term) and len(ids) == 1:
+                    qn.add(term, [names[ids[0]]], "id", hints=[names[ids[0]]])
+    for phrase, cid in _COMMON_NAMES.items():
+        if cid in names:
+            qn.add(phrase, [names[cid]], "common_name", hints=[names[cid]])
+
+    for r in _read_csv(Path(star_path)):
+        const = names.get(r["constellation"])
+        qn.add(r["name"], [r["jp_name"], const], "star", hints=[const] if const else [])
+    for r in _read_csv(Path(deep_sky_path)):
+        const = names.get(r["constellation"])
+        jp = r["jp_name"] or None
+        for phrase in (r["id"], r["name"], r["ngc"]):
+            if phrase:
+                qn.add(phrase, [jp, const], "deep_sky", hints=[const] if const else [])
+
+    for m, month in enumerate(_MONTHS, start=1):
+        qn.add(month, [f"{m}月"], "month", months=[m])
+        qn.add(month[:3], [f"{m}月"], "month", months=[m])
+    qn.add("sept", ["9月"], "month", months=[9])
+    for word, season in _SEASONS.items():
+        qn.add(word, [season], "season", months=SEASON_TO_MONTHS[season], season=season)
+    for phrase, term in _GLOSSARY.items():
+        qn.add(phrase, [term], "glossary")
+    for word, term in _ROMAJI_WORDS.items():
+        qn.add(word, [term], "romaji")
+    return qn
+
+
+_normalizer = None
+
+
+def get_query_normalizer() -> QueryNormalizer:
+    global _normalizer
+    if _normalizer is None:
+        _normalizer = build_query_normalizer()
+    return _normalizer
+
+
+# ================================================================
+# ベンチマーク: 表から作ったのではないクエリでの置き換え率と hit@k
+# ================================================================
+
+# 手で書いた英語・ローマ字のクエリと、上位に来てほしい星座（どれか 1 つ入れば当たり。() は正解なし）
+# 表（_COMMON_NAMES / _GLOSSARY / 星のカタログ）の並びをなぞらない言い回しにしてある
+_HELD_OUT = [
+    ("which constellation is the hunter", ("Orion",)), ("where can i find betelgeuse", ("Orion",)),
+    ("vega and altair legend", ("Lyra", "Aquila")), ("the seven sisters", ("Taurus",)),
+    ("big dipper in spring", ("Ursa Major",)), ("polaris", ("Ursa Minor",)),
+    ("cassiopeia w shape", ("Cassiopeia",)), ("scorpion that stung orion", ("Scorpius", "Orion")),
+    ("perseus and medusa", ("Perseus",)), ("andromeda galaxy", ("Andromeda",)),
+    ("southern cross", ("Crux",)), ("antares", ("Scorpius",)), ("sirius the dog star", ("Canis Major",)),
+    ("summer triangle stars", ("Lyra", "Cygnus", "Aquila")), ("castor and pollux", ("Gemini",)),
+    ("m42", ("Orion",)), ("pleiades", ("Taurus",)), ("lion constellation in april", ("Leo",)),
+    ("hakucho za", ("Cygnus",)), ("kani-za no densetsu", ("Cancer",)), ("oushi za", ("Taurus",)),
+    ("ursa major myth", ("Ursa Major",)), ("pegasus autumn", ("Pegasus",)), ("the twins of zeus", ("Gemini",)),
+    ("arcturus", ("Bootes",)), ("spica", ("Virgo",)), ("deneb", ("Cygnus",)), ("aldebaran", ("Taurus",)),
+    ("オリオン座 myth", ("Orion",)), ("冬の星座 bright stars", ()), ("which stars may i see tonight", ()),
+]
+
+# 月の読み取り（"may" は前置詞の後かクエリが "may" だけのときだけ 5 月）
+_MONTH_CASES = [
+    ("which stars may i see tonight", []), ("stars visible in may", [5]), ("may", [5]),
+    ("the sky of may", [5]), ("stars in march", [3]), ("constellations in jan", [1]),
+]
+
+# 置き換えずに LLM に回すべきクエリ（置き換えたと言い張らないことの確認）
+_NEEDS_LLM = [
+    "最高気温10度の日 stars", "気温5度 constellation", "where is mars tonight", "something romantic for a date night",
+    "it is about 5 degrees outside", "what should i look at on my birthday",
+    "constellations for kids who love animals",
+]
+
+
+def _log_queries(path) -> list:
+    """
+    検索ログの英字を含むクエリのうち、LLM の拡張で引いたもの（同じクエリは 1 件）を
+    (クエリ, その結果の 1 位の id) で返す
+    """
+    from .query_log import read_query_log
+    seen, cases = set(), []
+    for r in read_query_log(path):
+        q, ids, e = r.get("query"), r.get("result_ids"), r.get("expanded_query")
+        if not q or not ids or not re.search(r"[a-z]", unicodedata.normalize("NFKC", q).lower()):
+            continue
+        if isinstance(e, dict) and "normalized_from" in e:
+            continue
+        key = r.get("normalized_query", q)
+        if key not in seen:
+            seen.add(key)
+            cases.append((q, ids[0]))
+    return cases
+
+
+def benchmark(qn: QueryNormalizer, k: int = 5, log_path=None):
+    """
+    _HELD_OUT と検索ログの英語クエリで、LLM を呼ばずに済む割合と normalize の時間、BM25 の hit@k
+    （そのまま引いたときと、置き換えて ConstellationSearcher.pin_hints をかけたとき）を表示する。
+    ログのクエリは、LLM の拡張で返した結果の 1 位が置き換え後の上位 k に入るか（LLM との一致）を見る
+    （ログの結果はベクトル検索と見え方の並べ替えも入っているので、目安として）。
+    """
+    from config import INDEX_DIR, QUERY_LOG_PATH
+    from .constellation_bm25_vec_rrf_search import search_constellations_bm25
+    from .searcher import ConstellationSearcher
+    searcher = ConstellationSearcher(CONSTELLATION_DATA_PATH, INDEX_DIR)
+
+    def top_ids(query: str, e: dict | None) -> list:
+        results = searcher.to_results(search_constellations_bm25(query, k=k))
+        if e is not None:
+            results = searcher.pin_hints(results, e)
+        return [view["id"] for view, _ in results[:k]]
+
+    start = time.perf_counter()
+    expanded = [qn.expand(q) for q, _ in _HELD_OUT]
+    us = (time.perf_counter() - start) * 1e6 / len(_HELD_OUT)
+    skipped = sum(1 for e in expanded if e is not None)
+    print(f"手書きの {len(_HELD_OUT)} クエリ: normalize {us:.1f} µs/回, LLM なしで済む {skipped / len(_HELD_OUT):.1%}")
+
+    targeted = [(q, gold, e) for (q, gold), e in zip(_HELD_OUT, expanded) if gold]
+    raw_hits = sum(1 for q, gold, _ in targeted if set(gold) & set(top_ids(q, None)))
+    norm_hits = sum(1 for q, gold, e in targeted if e is not None and set(gold) & set(top_ids(e["query"], e)))
+    print(f"正解のある {len(targeted)} クエリの hit@{k}: そのまま {raw_hits / len(targeted):.1%} "
+          f"-> 置き換え後 {norm_hits / len(targeted):.1%}（置き換えられなかったものは外れに数える）")
+    missed = [q for q, _, e in targeted if e is None]
+    print(f"置き換えられなかったもの: {missed}")
+    wrongly = [q for q in _NEEDS_LLM if qn.expand(q) is not None]
+    print(f"LLM に回すべきクエリ {len(_NEEDS_LLM)} 件のうち置き換えてしまったもの: {wrongly}")
+    misread = [(q, r["months"]) for q, months in _MONTH_CASES
+               if (r := qn.normalize(q)) is None or r["months"] != months]
+    print(f"月の読み取り {len(_MONTH_CASES)} 件のうち違ったもの: {misread}")
+
+    logged = _log_queries(log_path or QUERY_LOG_PATH)
+    if not logged:
+        print("検索ログに LLM で拡張した英語クエリがありません")
+        return
+    covered = [(q, cid, qn.expand(q)) for q, cid in logged]
+    covered = [(q, cid, e) for q, cid, e in covered if e is not None]
+    agree = sum(1 for q, cid, e in covered if cid in top_ids(e["query"], e))
+    print(f"検索ログの英語クエリ {len(logged)} 件: LLM なしで済む {len(covered) / len(logged):.1%}, "
+          f"そのうち LLM の 1 位が置き換え後の上位 {k} に入る {agree / max(len(covered), 1):.1%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="英語・ローマ字のクエリを日本語の語に置き換える")
+    parser.add_argument("--query", type=str, nargs="*",
+                        default=["orion in winter", "orion-za", "stars visible in january", "sasori za no shinwa",
+                                 "where is Sirius", "great bear myth", "orian", "something romantic"])
+    parser.add_argument("--bench", action="store_true")
+    parser.add_argument("--log", type=str, default=None, help="--bench で使う検索ログ（省略時は QUERY_LOG_PATH）")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    normalizer = get_query_normalizer()
+    get_fuzzy_index()
+    print(f"build: {(time.perf_counter() - start) * 1000:.1f} ms, フレーズ {len(normalizer)}")
+    for q in args.query:
+        r = normalizer.normalize(q)
+        print(f"{q!r}: {r['query']!r} mapped={r['mapped']} unmapped={r['unmapped']} complete={r['complete']}")
+    if args.bench:
+        benchmark(normalizer, log_path=args.log)
@@ -0,0 +1,292 @@
+"""
+SkyLore - 時間予算つきのクエリプランナー
+これまでの検索は、クエリの難しさや残り時間に関係なく
+LLM のクエリ拡張 -> BM25 (k=20) -> ベクトル検索 (k=20) -> RRF を毎回すべて行っていた。
+ここでは 1 リクエストの時間予算（PLANNER_BUDGET_MS）と安く取れる手がかりから、段階ごとに
+
+- クエリ拡張: クエリの内容語がすでにインデックスにあれば省く（気温の数値など、
+  LLM に読み替えてほしいものがあるときは省かない）。英語・ローマ字のクエリを
+  query_normalizer で置き換えきれたときと、見積もりが残り時間を超えたときも省く
+- ベクトル検索: BM25 の 1 位と k 位のスコア差が大きい（決着がついている）なら省く。
+  見積もりが残り時間を超えても省く
+- k_bm25 / k_vec: interactive の待ち行列が詰まっているときは半分にする
+
+を決める。決定は理由と手がかりの値ごとに QueryPlan.decisions に残り、検索ログの "plan" に入る。
+
+    python -m src.query_planner --log logs/query_log.jsonl   # 決定ごとの件数と応答時間
+"""
+import argparse
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+
+from config import (
+    QUERY_LOG_PATH,
+    PLANNER_ENABLED,
+    PLANNER_BUDGET_MS,
+    PLANNER_K_BM25,
+    PLANNER_K_VEC,
+    PLANNER_DECISIVE_MARGIN,
+    PLANNER_SKIP_EXPANSION_COVERAGE,
+    PLANNER_LOAD_QUEUED,
+    PLANNER_PRIOR_MS,
+)
+from .constellation_bm25_build import tokenize_ja
+from .llm_scheduler import get_scheduler_stats
+from .query_expander import get_expansion_cache
+from .query_log import normalize_query, read_query_log
+from .query_normalizer import NEEDS_EXPANSION
+
+# 内容語に数えないトークン（ひらがな 1〜2 文字の助詞・助動詞、記号）
+_FUNCTION_TOKEN = re.compile(r"^([ぁ-ん]{1,2}|[、。！？!?・\s]+)$")
+
+# 指数移動平均で見積もりを更新するときの新しい値の重み
+_EWMA_ALPHA = 0.2
+
+
+class QueryPlan:
+    """
+    1 リクエスト分の計画。expand() と search() が段階ごとに実行するか決め、
+    決定（段階・行動・理由・手がかり・その時点の残り時間）を decisions に積む。
+    """
+
+    def __init__(self, planner, query: str, budget_ms: float):
+        self.planner = planner
+        self.query = query
+        self.budget_ms = budget_ms
+        self.decisions = []
+        self.k_bm25 = planner.k_bm25
+        self.k_vec = planner.k_vec
+        self.vector_used = True
+        self._start = time.perf_counter()
+
+        loaded, signals = planner.under_load()
+        if loaded:
+            self.k_bm25 = max(1, self.k_bm25 // 2)
+            self.k_vec = max(1, self.k_vec // 2)
+            self.decide("k", "shrink", "load", k_bm25=self.k_bm25, k_vec=self.k_vec, **signals)
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self._start) * 1000
+
+    def remaining_ms(self) -> float:
+        return self.budget_ms - self.elapsed_ms()
+
+    def decide(self, stage: str, action: str, reason: str, **signals):
+        self.decisions.append({"stage": stage, "action": action, "reason": reason,
+                               "remaining_ms": round(self.remaining_ms(), 1), **signals})
+        self.planner.count(stage, action, reason)
+
+    def _timed(self, stage: str, fn, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self.planner.observe(stage, (time.perf_counter() - start) * 1000)
+
+    @property
+    def full_pipeline(self) -> bool:
+        """既定の（計画なしと同じ）段階で検索したか（検索キャッシュに共有してよいか）"""
+        return self.vector_used and (self.k_bm25, self.k_vec) == (PLANNER_K_BM25, PLANNER_K_VEC)
+
+    # ------------------------------------------------------------
+    # 段階
+    # ------------------------------------------------------------
+
+    def expand(self, expander, query: str) -> dict:
+        """クエリ拡張をするか決めて、拡張結果（省いたときは LLM を使わない拡張）を返す"""
+        if (expander.model, normalize_query(query)) in get_expansion_cache():
+            self.decide("expansion", "run", "cached")
+            return expander.expand(query)
+
+        local = expander.expand_romanized(query)
+        if local is not None:
+            self.decide("expansion", "skip", "romanized", keywords=len(local["keywords"]))
+            return local
+
+        coverage, n_terms = self.planner.index_coverage(query)
+        estimate = self.planner.estimate("expansion")
+        signals = {"coverage": round(coverage, 2), "terms": n_terms, "estimate_ms": round(estimate, 1)}
+        if not NEEDS_EXPANSION.search(query) and n_terms and coverage >= self.planner.skip_expansion_coverage:
+            self.decide("expansion", "skip", "indexed_terms", **signals)
+            return expander.expand_locally(query)
+        if estimate > self.remaining_ms():
+            self.decide("expansion", "skip", "budget", **signals)
+            return expander.expand_locally(query)
+
+        self.decide("expansion", "run", "default", **signals)
+        return self._timed("expansion", expander.expand, query)
+
+    def search(self, query_text: str, topk: int) -> list:
+        """
+        BM25 を先に引き、その結果を見てベクトル検索をするか決めてから RRF でまとめる
+        （hybrid_search_constellations と同じ形の結果を返す）。
+        BM25 とベクトル検索は同じ版（1 回の acquire）で引く。
+        """
+        from .constellation_bm25_vec_rrf_search import (
+            search_constellations_bm25, search_constellations_vec, reciprocal_rank_fusion, get_versioned_index,
+        )
+
+        with get_versioned_index().acquire() as index:
+            # hybrid_search_constellations と同じ k で引く（既定の段階なら結果が同じになり、検索キャッシュを共有できる）
+            bm25_results = self._timed("bm25", search_constellations_bm25, query_text, k=self.k_bm25, index=index)
+            scores = [r["score"] for r in bm25_results]
+            positive = sum(1 for s in scores if s > 0)
+            top = scores[0] if scores else 0.0
+            # 上位 topk 件がすべて語に当たっていて、1 位が k 位より十分高ければ決着がついている
+            # （k_bm25 が topk より小さければ判定できないので、ベクトル検索に回す）
+            margin = (top - scores[topk - 1]) / top if top > 0 and positive >= topk else 0.0
+            estimate = self.planner.estimate("vector")
+            signals = {"margin": round(margin, 3), "bm25_hits": positive, "estimate_ms": round(estimate, 1)}
+
+            vec_results = []
+            if margin >= self.planner.decisive_margin:
+                self.vector_used = False
+                self.decide("vector", "skip", "decisive_bm25", **signals)
+            elif estimate > self.remaining_ms():
+                self.vector_used = False
+                self.decide("vector", "skip", "budget", **signals)
+            else:
+                self.decide("vector", "run", "default", k_vec=self.k_vec, **signals)
+                try:
+                    vec_results = self._timed("vector", search_constellations_vec, query_text,
+                                              k=self.k_vec, index=index)
+                except Exception as e:
+                    # ベクトル検索が落ちても BM25 だけで返す
+                    self.vector_used = False
+                    self.decide("vector", "failed", type(e).__name__)
+
+        return reciprocal_rank_fusion(bm25_results, vec_results, rrf_k=60)[:topk]
+
+    def to_dict(self) -> dict:
+        """ログ用（検索ログの "plan" に入れる）"""
+        return {"budget_ms": self.budget_ms, "elapsed_ms": round(self.elapsed_ms(), 1),
+                "k_bm25": self.k_bm25, "k_vec": self.k_vec if self.vector_used else 0,
+                "decisions": self.decisions}
+
+
+class QueryPlanner:
+    """
+    plan(query) でリクエストごとの QueryPlan を作る。段階ごとの所要時間の見積もり
+    （実測の指数移動平均）と、決定ごとの回数はプロセス全体で共有する。
+    """
+
+    def __init__(self, budget_ms: float = PLANNER_BUDGET_MS, k_bm25: int = PLANNER_K_BM25,
+                 k_vec: int = PLANNER_K_VEC, decisive_margin: float = PLANNER_DECISIVE_MARGIN,
+                 skip_expansion_coverage: float = PLANNER_SKIP_EXPANSION_COVERAGE,
+                 load_queued: int = PLANNER_LOAD_QUEUED, prior_ms: dict = PLANNER_PRIOR_MS):
+        self.budget_ms = budget_ms
+        self.k_bm25 = k_bm25
+        self.k_vec = k_vec
+        self.decisive_margin = decisive_margin
+        self.skip_expansion_coverage = skip_expansion_coverage
+        self.load_queued = load_queued
+        self._lock = threading.Lock()
+        self._estimates = dict(prior_ms)
+        self._counts = Counter()
+        self._vocab = (None, None)   # (インデックスの版, 語彙)
+
+    def plan(self, query: str, budget_ms: float | None = None) -> QueryPlan:
+        return QueryPlan(self, query, self.budget_ms if budget_ms is None else budget_ms)
+
+    def observe(self, stage: str, ms: float):
+        with self._lock:
+            prev = self._estimates.get(stage)
+            self._estimates[stage] = ms if prev is None else (1 - _EWMA_ALPHA) * prev + _EWMA_ALPHA * ms
+
+    def estimate(self, stage: str) -> float:
+        with self._lock:
+            return self._estimates.get(stage, 0.0)
+
+    def count(self, stage: str, action: str, reason: str):
+        with self._lock:
+            self._counts[f"{stage}:{action}:{reason}"] += 1
+
+    def under_load(self) -> tuple:
+        """interactive の待ち行列を見て (高負荷か, 手がかり) を返す"""
+        interactive = get_scheduler_stats().get("interactive", {})
+        queued = interactive.get("queued", 0)
+        return queued >= self.load_queued, {"queued": queued, "running": interactive.get("running", 0)}
+
+    def index_coverage(self, query: str) -> tuple:
+        """クエリの内容語のうち BM25 の語彙にあるものの割合と、内容語の数"""
+        from .constellation_bm25_vec_rrf_search import get_versioned_index
+        versioned = get_versioned_index()
+        if self._vocab[0] != versioned.version:
+            with versioned.acquire() as index:
+                self._vocab = (versioned.version, index.positional_index.postings)
+        vocab = self._vocab[1]
+        terms = [t for t in tokenize_ja(query) if not _FUNCTION_TOKEN.match(t)]
+        if not terms:
+            return 0.0, 0
+        return sum(1 for t in terms if t in vocab) / len(terms), len(terms)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"decisions": dict(self._counts),
+                    "estimates_ms": {k: round(v, 1) for k, v in self._estimates.items()}}
+
+
+_planner = QueryPlanner()
+
+
+def get_query_planner() -> QueryPlanner:
+    return _planner
+
+
+def get_planner_stats() -> dict:
+    return _planner.stats()
+
+
+def plan_query(query: str) -> QueryPlan | None:
+    """リクエストの QueryPlan（PLANNER_ENABLED でなければ None。app.py と query_replay で共通）"""
+    return _planner.plan(query) if PLANNER_ENABLED else None
+
+
+# ================================================================
+# 監査: 検索ログの決定ごとに件数と応答時間をまとめる
+# ================================================================
+
+def audit(records: list) -> dict:
+    """
+    "plan" 付きの記録を (クエリ拡張の行動, ベクトル検索の行動) で分け、
+    件数・応答時間（平均・p95）・API 呼び出し回数の平均を返す
+    """
+    groups = defaultdict(list)
+    for r in records:
+        plan = r.get("plan")
+        if not plan or r.get("error"):
+            continue
+        actions = {d["stage"]: f"{d['action']}:{d['reason']}" for d in plan.get("decisions", [])}
+        # 名前の引き当てで打ち切ったものは、クエリ拡張の段にその決定を入れる
+        groups[(actions.get("expansion", actions.get("name_lookup", "-")), actions.get("vector", "-"))].append(r)
+
+    summary = {}
+    for key, rs in sorted(groups.items(), key=lambda x: -len(x[1])):
+        totals = sorted(r.get("timings_ms", {}).get("total", 0.0) for r in rs)
+        summary[" / ".join(key)] = {
+            "count": len(rs),
+            "total_ms_avg": round(sum(totals) / len(totals), 1),
+            "total_ms_p95": round(totals[min(len(totals) - 1, int(0.95 * len(totals)))], 1),
+            "api_calls_avg": round(sum(sum(r.get("api_calls", {}).values()) for r in rs) / len(rs), 2),
+        }
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="検索ログの計画の決定ごとに件数と応答時間をまとめる")
+    parser.add_argument("--log", type=str, default=str(QUERY_LOG_PATH))
+    parser.add_argument("--explain", type=str, default=None, help="このクエリの計画を（API を呼ばずに）表示する")
+    args = parser.parse_args()
+
+    if args.explain:
+        planner = get_query_planner()
+        coverage, n_terms = planner.index_coverage(args.explain)
+        print(f"coverage={coverage:.2f} terms={n_terms} needs_expansion={bool(NEEDS_EXPANSION.search(args.explain))}")
+        from .constellation_bm25_vec_rrf_search import search_constellations_bm25
+        scores = [r["score"] for r in search_constellations_bm25(args.explain, k=PLANNER_K_BM25)]
+        print(f"bm25 top scores={[round(s, 2) for s in scores[:10]]}")
+
+    for group, s in audit(read_query_log(args.log)).items():
+        print(f"{group:50s} {s}")
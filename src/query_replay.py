@@ -0,0 +1,177 @@
+# query_replay.py
+# query_log.py が書いたクエリログを、記録された間隔どおり（--speedup で早回し）に
+# 検索スタックへ流し直す負荷試験・キャパシティ見積もり用のスクリプト
+#
+#   --backend stub : 記録された時間だけ待って記録された結果を返す（API を呼ばない）
+#   --backend live : app.py と同じ ConstellationSearcher.search_query（星座名の短絡・クエリプランナー・
+#                    クエリ拡張・検索）を実際に呼ぶ（--reuse-expansion でクエリ拡張だけは記録を使う）
+#
+# 終了時にスループット・レイテンシの分位点・遅延（予定時刻からの遅れ）と、
+# 正規化クエリの繰り返し具合から見た LRU キャッシュのサイズ別ヒット率を表示する。
+
+import argparse
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from config import CONSTELLATION_DATA_PATH, INDEX_DIR, DEFAULT_LLM, DEFAULT_TOP_K, QUERY_LOG_PATH
+from .query_log import read_query_log, normalize_query
+
+
+class StubBackend:
+    """記録された各段階（星座名の引き当て・クエリ拡張・検索）の時間だけ sleep して、記録された結果を返す"""
+
+    STAGES = ("name_lookup", "expansion", "search")
+
+    def run(self, record: dict) -> list:
+        timings = record.get("timings_ms", {})
+        for stage in self.STAGES:
+            time.sleep(timings.get(stage, 0.0) / 1000)
+        return record.get("result_ids", [])
+
+
+class LiveBackend:
+    """
+    app.py と同じ入口（ConstellationSearcher.search_query）で検索する（searcher はスレッド間で共有）。
+    星座名で引き当てた記録は短絡し、クエリプランナーも app.py と同じく記録ごとに計画を作る。
+    """
+
+    def __init__(self, reuse_expansion: bool = False):
+        from .query_expander import QueryExpander
+        from .searcher import ConstellationSearcher
+
+        self.reuse_expansion = reuse_expansion
+        self.searcher = ConstellationSearcher(CONSTELLATION_DATA_PATH, INDEX_DIR)
+        self._expander = QueryExpander(model=DEFAULT_LLM) if not reuse_expansion else None
+
+    def run(self, record: dict) -> list:
+        from .query_planner import plan_query
+
+        query = record["query"]
+        expanded = record.get("expanded_query") if self.reuse_expansion else None
+        _, results = self.searcher.search_query(
+            query, top_k=record.get("top_k", DEFAULT_TOP_K), observer=record.get("observer"),
+            visibility_mode=record.get("visibility_mode", "boost"), plan=plan_query(query),
+            corpora=record.get("corpora"), expander=self._expander, expanded=expanded,
+        )
+        return [c.get("id") for c, _ in results]
+
+
+def _percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def lru_hit_rates(keys: list, sizes=(16, 64, 256, 1024)) -> dict:
+    """keys を順に引いたときの、LRU キャッシュのサイズ別ヒット率"""
+    rates = {}
+    for size in sizes:
+        cache = OrderedDict()
+        hits = 0
+        for key in keys:
+            if key in cache:
+                hits += 1
+                cache.move_to_end(key)
+            else:
+                cache[key] = True
+                if len(cache) > size:
+                    cache.popitem(last=False)
+        rates[size] = hits / len(keys) if keys else 0.0
+    return rates
+
+
+def replay(records: list, backend, speedup: float = 1.0, concurrency: int = 4) -> dict:
+    """
+    記録の ts の間隔を speedup 分の 1 に縮めて投入する（speedup <= 0 なら間隔なしで一気に流す）。
+    同時に走るのは concurrency 件まで。
+    """
+    latencies, lags, errors = [], [], Counter()
+    mismatches = 0
+    lock = threading.Lock()
+    t0_log = records[0].get("ts", 0.0) if records else 0.0
+    t0 = time.perf_counter()
+
+    def run_one(record, due):
+        nonlocal mismatches
+        start = time.perf_counter()
+        try:
+            ids = backend.run(record)
+            ok = True
+        except Exception as e:
+            ids, ok = None, False
+            with lock:
+                errors[type(e).__name__] += 1
+        elapsed = time.perf_counter() - start
+        with lock:
+            lags.append(max(0.0, start - due))
+            if ok:
+                latencies.append(elapsed)
+                if ids != record.get("result_ids"):
+                    mismatches += 1
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="replay") as pool:
+        for record in records:
+            offset = (record.get("ts", t0_log) - t0_log) / speedup if speedup > 0 else 0.0
+            due = t0 + offset
+            wait = due - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            pool.submit(run_one, record, due)
+
+    wall = time.perf_counter() - t0
+    return {
+        "requests": len(records),
+        "errors": dict(errors),
+        "wall_sec": wall,
+        "throughput_rps": len(latencies) / wall if wall else 0.0,
+        "latency_ms": {f"p{int(q * 100)}": _percentile(latencies, q) * 1000 for q in (0.5, 0.95, 0.99)},
+        "lag_ms": {f"p{int(q * 100)}": _percentile(lags, q) * 1000 for q in (0.5, 0.95, 0.99)},
+        "result_mismatches": mismatches,
+    }
+
+
+def traffic_shape(records: list) -> dict:
+    """どのクエリが繰り返されるか、API を何回呼んでいるか"""
+    keys = [r.get("normalized_query") or normalize_query(r.get("query", "")) for r in records]
+    counts = Counter(keys)
+    api_calls = Counter()
+    for r in records:
+        api_calls.update(r.get("api_calls", {}))
+    return {
+        "unique_queries": len(counts),
+        "repeat_rate": 1 - len(counts) / len(keys) if keys else 0.0,
+        "top_queries": counts.most_common(10),
+        "api_calls_per_request": {k: v / len(records) for k, v in api_calls.items()} if records else {},
+        "lru_hit_rate": lru_hit_rates(keys),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="クエリログのリプレイ（負荷試験・キャッシュサイズの見積もり）")
+    parser.add_argument("--log", type=str, default=str(QUERY_LOG_PATH))
+    parser.add_argument("--backend", choices=["stub", "live"], default="stub")
+    parser.add_argument("--reuse-expansion", action="store_true",
+                        help="live でもクエリ拡張は記録を使う（LLM を呼ばない）")
+    parser.add_argument("--speedup", type=float, default=10.0, help="0 以下なら間隔なしで流す")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--limit", type=int, default=None)
+    args = parser.parse_args()
+
+    records = read_query_log(args.log)[:args.limit]
+    if not records:
+        raise SystemExit(f"{args.log} に記録がありません")
+
+    shape = traffic_shape(records)
+    print(f"records={len(records)} unique={shape['unique_queries']} repeat_rate={shape['repeat_rate']:.2f}")
+    print("top queries:", shape["top_queries"])
+    print("API calls / request:", {k: round(v, 2) for k, v in shape["api_calls_per_request"].items()})
+    print("LRU hit rate by size:", {k: round(v, 3) for k, v in shape["lru_hit_rate"].items()})
+
+    backend = StubBackend() if args.backend == "stub" else LiveBackend(args.reuse_expansion)
+    report = replay(records, backend, speedup=args.speedup, concurrency=args.concurrency)
+    print(f"\n=== replay backend={args.backend} speedup={args.speedup} concurrency={args.concurrency} ===")
+    for key, value in report.items():
+        print(f"  {key}: {value}")
@@ -1,11 +1,89 @@
 # src/searcher.py みたいな場所に置いている想定
 
 from typing import List, Dict, Tuple, Any
+from collections.abc import Mapping
+from contextlib import nullcontext
+from functools import lru_cache
 from pathlib import Path
+from types import MappingProxyType
 import json
 
 # constellation_bm25_vec_rrf_search.py と同じフォルダにある前提
-from .constellation_bm25_vec_rrf_search import hybrid_search_constellations
+from .constellation_bm25_vec_rrf_search import get_versioned_index
+from .index_registry import get_router
+from .query_expander import QueryExpander
+from .fuzzy_names import get_fuzzy_index
+from .visibility import visible_tonight, observer_night
+from .visibility_table import get_visibility_table
+from .shared_cache import SharedLRUCache
+from config import (VISIBILITY_BOOST, DEFAULT_OBSERVER_LAT, DEFAULT_OBSERVER_LON, SEARCH_CACHE_SIZE, DEFAULT_CORPORA,
+                    DEFAULT_LLM)
+
+# ルーターの検索結果を (コーパスごとの版, コーパス, クエリ文字列, 件数) ごとに共有する（可視判定は毎回かける）
+_search_cache = SharedLRUCache("search", SEARCH_CACHE_SIZE)
+# 新しい版に差し替わったら古い版の結果は引かれなくなるので、まとめて捨てる
+get_versioned_index().on_swap(lambda old, new: _search_cache.clear())
+
+
+def get_search_cache() -> SharedLRUCache:
+    return _search_cache
+
+
+@lru_cache(maxsize=4)
+def load_catalogue(data_path: str) -> Mapping:
+    """
+    id -> 星座情報 の読み取り専用カタログ（同じファイルならプロセス内で 1 つを共有）
+
+    各星座は MappingProxyType、リストはタプルにしてあるので、
+    検索結果やセッションから参照しても書き換えられない。
+    """
+    with Path(data_path).open("r", encoding="utf-8") as f:
+        constellations: list[dict[str, Any]] = json.load(f)
+
+    catalogue = {}
+    for c in constellations:
+        cid = c.get("id")
+        if cid:
+            catalogue[cid] = MappingProxyType(
+                {k: tuple(v) if isinstance(v, list) else v for k, v in c.items()}
+            )
+    return MappingProxyType(catalogue)
+
+
+class ResultView(Mapping):
+    """
+    検索結果 1 件分のビュー
+
+    共有カタログの星座情報（base）への参照と、結果ごとの追加情報（snippet や
+    visible_fraction）だけを持つ。dict と同じように読めて、書き込みは追加情報側に入る。
+    """
+
+    __slots__ = ("base", "extra")
+
+    def __init__(self, base: Mapping, extra: dict | None = None):
+        self.base = base
+        self.extra = extra
+
+    def __getitem__(self, key):
+        if self.extra is not None and key in self.extra:
+            return self.extra[key]
+        return self.base[key]
+
+    def __setitem__(self, key, value):
+        if self.extra is None:
+            self.extra = {}
+        self.extra[key] = value
+
+    def __iter__(self):
+        yield from self.base
+        if self.extra:
+            yield from (k for k in self.extra if k not in self.base)
+
+    def __len__(self):
+        return len(self.base) + sum(1 for k in (self.extra or ()) if k not in self.base)
+
+    def __repr__(self):
+        return f"ResultView({self.base.get('id')!r}, extra={self.extra!r})"
 
 
 class ConstellationSearcher:
@@ -19,64 +97,226 @@ class ConstellationSearcher:
     """
 
     def __init__(self, data_path: str | Path, index_path: str | Path):
-        # data_path から星座データ(JSON)をロードしておく
+        # data_path の星座データは load_catalogue で読み込み、プロセス内で共有する
         data_path = Path(data_path)
-        with data_path.open("r", encoding="utf-8") as f:
-            constellations: list[dict[str, Any]] = json.load(f)
 
-        # id -> 星座情報 の辞書を作成
-        self.constellations_by_id: dict[str, dict[str, Any]] = {}
-        for c in constellations:
-            cid = c.get("id")
-            if cid:
-                self.constellations_by_id[cid] = c
+        # id -> 星座情報 の辞書（読み取り専用）
+        self.constellations_by_id: Mapping[str, Mapping[str, Any]] = load_catalogue(str(data_path.resolve()))
 
         # index_path は今のところ使っていないが、
         # 既存の __init__(data_path, index_path) の形は維持する
         self.data_path = data_path
         self.index_path = Path(index_path)
 
+        # 和名 -> id（pin_hints で初めて使うときに作る）
+        self._ids_by_jp_name = None
+
     # ここが app.py から呼ばれるメソッド
-    def search(self, expanded_query: Dict, top_k: int = 5) -> List[Tuple[Dict, float]]:
+    def search(self, expanded_query: Dict, top_k: int = 5,
+               observer: Dict | None = None, visibility_mode: str = "boost",
+               plan=None, corpora: list | None = None) -> List[Tuple[ResultView, float]]:
         """
         拡張クエリ(expanded_query)を受け取って、
-        ハイブリッド検索の結果を [(星座dict, score), ...] で返す。
+        ハイブリッド検索の結果を [(星座のビュー, score), ...] で返す。
+        ビューは dict と同じように読める（to_results を参照）。
+
+        observer = {"lat": 緯度, "lon": 経度, "datetime": 日時（タイムゾーン付き。なしは観測地の時刻）} を渡すと、
+        その夜の見え方で並べ替える（visibility_mode="boost"）か、
+        見えない星座を除く（visibility_mode="filter"）。
+
+        plan（query_planner.QueryPlan）を渡すと、ベクトル検索をするかどうかや k を計画に任せる。
+        既定と違う段階で作った結果は検索キャッシュには入れない。
+
+        検索は index_registry の QueryRouter で corpora（省略時は config.DEFAULT_CORPORA）に投げる。
+        星座以外のコーパスの結果は、カタログに無いので id と jp_name だけのビューになる。
         """
 
         # expanded_query から元のクエリ文字列をなるべく取り出す
         query_text = self._extract_query_text(expanded_query)
 
-        # BM25 + ベクトル + RRF で検索
-        # constellation_bm25_vec_rrf_search.hybrid_search_constellations は
-        # [{"id", "jp_name", "snippet", "rrf_score", "bm25_score", "vec_score"}, ...]
-        # を返す想定
-        raw_results = hybrid_search_constellations(
-            query=query_text,
-            topk=top_k,
-        )
+        # 見え方（観測地の今夜、または拡張クエリの月）で並べ替える場合は候補を多めに取っておく
+        fractions = self._visibility_fractions(expanded_query, observer)
+
+        # 選んだコーパスに QueryRouter で投げる（星座のコーパスは BM25 + ベクトル + RRF）
+        # 結果は [{"corpus", "id", "jp_name", "snippet", "rrf_score" か "score", ...}, ...]
+        topk = top_k * 3 if fractions else top_k
+        router = get_router()
+        corpora = list(corpora or DEFAULT_CORPORA)
+        cache_key = (router.registry.versions(corpora), tuple(corpora), query_text, topk)
+        raw_results = _search_cache.get(cache_key)
+        if raw_results is None:
+            # すべてのコーパスが失敗したときだけ例外にする（一部の失敗は残りの結果で返す）
+            out = router.search(query_text, corpora=corpora, k=topk, plan=plan, raise_errors=True)
+            raw_results = out["results"]
+            if out["errors"]:
+                print(f"一部のコーパスの検索に失敗しました: {out['errors']}")
+            elif plan is None or plan.full_pipeline:
+                _search_cache.put(cache_key, raw_results)
+        elif plan is not None:
+            plan.decide("search", "run", "cached")
+
+        results = self.pin_hints(self.to_results(raw_results), expanded_query)
 
-        results: list[tuple[dict[str, Any], float]] = []
+        if fractions:
+            mode = visibility_mode if observer else "boost"
+            results = self._apply_visibility(results, fractions, mode)
+
+        return results[:top_k]
+
+    def search_query(self, query: str, top_k: int = 5,
+                     observer: Dict | None = None, visibility_mode: str = "boost",
+                     plan=None, corpora: list | None = None, trace=None,
+                     expander: QueryExpander | None = None, expanded: Dict | None = None) -> tuple:
+        """
+        利用者のクエリ 1 つ分の検索（星座名の短絡 -> クエリ拡張 -> search）をして
+        (拡張クエリ, [(星座のビュー, score), ...]) を返す。app.py と query_replay の共通の入口。
+
+        plan は query_planner.plan_query(query) で作って渡す（ログに残すので呼び出し側が持つ）。
+        trace（query_log.RequestTrace）を渡すと name_lookup / expansion / search の時間を記録する。
+        expander を省くと、クエリ拡張が要るときだけ DEFAULT_LLM の QueryExpander を作る。
+        expanded を渡すとクエリ拡張はせずにそれを使う（記録した拡張を使う再生用）。
+        """
+        def stage(name):
+            return trace.stage(name) if trace is not None else nullcontext()
+
+        # 星座名そのもの（打ち間違いを含む）なら、クエリ拡張も検索もせずに返す
+        with stage("name_lookup"):
+            named = self.search_name(query, top_k=top_k, observer=observer, visibility_mode=visibility_mode)
+        if named is not None:
+            results, match = named
+            if plan is not None:
+                plan.vector_used = False
+                plan.decide("name_lookup", "short_circuit", "confident_match",
+                            distance=match["distance"], confidence=match["confidence"])
+            return {"query": query, "name_match": match}, results
+
+        if expanded is None:
+            expander = expander or QueryExpander(model=DEFAULT_LLM)
+            with stage("expansion"):
+                expanded = plan.expand(expander, query) if plan is not None else expander.expand(query)
+        with stage("search"):
+            results = self.search(expanded, top_k=top_k, observer=observer,
+                                  visibility_mode=visibility_mode, plan=plan, corpora=corpora)
+        return expanded, results
+
+    def search_name(self, query: str, top_k: int = 5,
+                    observer: Dict | None = None, visibility_mode: str = "boost"):
+        """
+        クエリが 1 つの星座の名前（和名・英名。表記ゆれ・打ち間違いを含む）なら、
+        クエリ拡張もハイブリッド検索もせずにその星座を返す。
+        keywords（「冬」「英雄」など複数の星座に付く語）は普通の検索に回す。
+        戻り値は ([(星座のビュー, 確信度), ...], 一致の情報)。確信できる一致が無ければ None。
+
+        observer を渡すと search() と同じく見えている割合を付け、visibility_mode="filter" で
+        今夜見えない星座なら None を返す（普通の検索で見える星座を探す）。
+        """
+        match = get_fuzzy_index().best(query, kinds=("name", "id"))
+        if match is None or len(match["ids"]) != 1:
+            return None
+        cid = match["ids"][0]
+        if cid not in self.constellations_by_id:
+            return None
+        view = ResultView(self.constellations_by_id[cid])
+        if observer:
+            fraction = self._visibility_fractions({}, observer).get(cid, 0.0)
+            if visibility_mode == "filter" and fraction <= 0.0:
+                return None
+            view["visible_fraction"] = fraction
+        return [(view, match["confidence"])][:top_k], match
+
+    def pin_hints(self, results: list, expanded_query: Dict) -> list:
+        """
+        query_normalizer で英語・ローマ字から置き換えた拡張クエリ（"normalized_from" がある）の
+        constellation_hints が和名そのもの（"オリオン座" / "オリオン"）なら、その星座を先頭に置く
+        （"orion in winter" の Orion は名指しなので、BM25 の本文に星座名がほとんど出てこなくても 1 位にする）。
+        LLM の拡張の constellation_hints は連想で挙げた候補なので、並びは検索に任せる。
+        """
+        if not isinstance(expanded_query, dict) or "normalized_from" not in expanded_query:
+            return results
+        hints = expanded_query.get("constellation_hints")
+        if not hints:
+            return results
+        if self._ids_by_jp_name is None:
+            self._ids_by_jp_name = {c.get("jp_name"): cid for cid, c in self.constellations_by_id.items()}
+        pinned_ids = []
+        for h in hints:
+            if not isinstance(h, str):
+                continue
+            cid = self._ids_by_jp_name.get(h) or self._ids_by_jp_name.get(f"{h}座")
+            if cid is not None and cid not in pinned_ids:
+                pinned_ids.append(cid)
+        if not pinned_ids:
+            return results
+
+        by_id = {view.get("id"): (view, score) for view, score in results}
+        top = max((score for _, score in results), default=0.0)
+        pinned = []
+        for rank, cid in enumerate(pinned_ids):
+            view = by_id[cid][0] if cid in by_id else ResultView(self.constellations_by_id[cid])
+            # 元の 1 位より少しだけ上のスコアにする（挙げられた順を保つ）
+            pinned.append((view, (top or 1.0) * (1.0 + 0.01 * (len(pinned_ids) - rank))))
+        return pinned + [(view, score) for view, score in results if view.get("id") not in pinned_ids]
+
+    def to_results(self, raw_results: list) -> List[Tuple[ResultView, float]]:
+        """
+        hybrid_search_constellations の結果を [(ResultView, score), ...] にする。
+        星座情報はコピーせず、共有カタログへの参照として持つ。
+        """
+        results: list[tuple[ResultView, float]] = []
         for r in raw_results:
             cid = r.get("id")
             score = float(r.get("rrf_score", r.get("score", 0.0)))
 
             # JSON 側にある詳細情報を優先して拾う
-            base = self.constellations_by_id.get(cid, {}).copy()
-            if not base:
+            base = self.constellations_by_id.get(cid)
+            if base is None:
                 # JSON に無い場合は最低限の情報を埋める
-                base = {
-                    "id": cid,
-                    "jp_name": r.get("jp_name"),
-                }
+                view = ResultView(MappingProxyType({"id": cid, "jp_name": r.get("jp_name")}))
+            else:
+                view = ResultView(base)
 
             # snippet が欲しければここで追加
-            if "snippet" not in base and "snippet" in r:
-                base["snippet"] = r["snippet"]
-
-            results.append((base, score))
+            if "snippet" not in view and "snippet" in r:
+                view["snippet"] = r["snippet"]
 
+            results.append((view, score))
         return results
 
+    def _visibility_fractions(self, expanded_query: Dict, observer: Dict | None) -> dict:
+        """
+        星座ごとの「見えている時間の割合」(0-1) を返す。
+        - observer があれば、その場所の今夜の割合
+        - なければ、拡張クエリの months の宵の割合（デフォルト観測地）
+        前計算済みの可視ビット表を使い、表が無ければ visibility エンジンで計算する。
+        """
+        table = get_visibility_table()
+        if observer:
+            when = observer.get("datetime")
+            if table is None:
+                tonight = visible_tonight(observer["lat"], observer["lon"], when)
+                return {cid: v["visible_fraction"] for cid, v in tonight.items()}
+            night = observer_night(observer["lon"], when)
+            return table.night_fraction(observer["lat"], observer["lon"], night)
+
+        months = expanded_query.get("months") if isinstance(expanded_query, dict) else None
+        if table is not None and isinstance(months, list) and months:
+            months = [m for m in months if isinstance(m, int)]
+            return table.month_fraction(DEFAULT_OBSERVER_LAT, DEFAULT_OBSERVER_LON, months)
+        return {}
+
+    def _apply_visibility(self, results: list, fractions: dict, mode: str) -> list:
+        """見えている割合に応じてスコアを上げる（boost）、または見えない星座を除く（filter）"""
+        adjusted = []
+        for base, score in results:
+            fraction = fractions.get(base.get("id"), 0.0)
+            if mode == "filter" and fraction <= 0.0:
+                continue
+            base["visible_fraction"] = fraction
+            adjusted.append((base, score * (1.0 + VISIBILITY_BOOST * fraction)))
+
+        adjusted.sort(key=lambda x: x[1], reverse=True)
+        return adjusted
+
     # expanded_query(dict) から文字列クエリを作るヘルパー
     def _extract_query_text(self, expanded_query: Dict) -> str:
         # もうすでに str の場合はそのまま
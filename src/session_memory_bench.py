@@ -0,0 +1,100 @@
+# session_memory_bench.py
+# Streamlit の 1 セッションが st.session_state に持つものを再現し、
+# tracemalloc で「1 セッションあたり何バイト増えるか」を測るスクリプト
+#
+#   legacy : セッションごとに ConstellationSearcher（星座 JSON 全体）を持ち、
+#            検索結果は星座 dict の .copy()、開いたストーリーは本文ごと持つ（以前の app.py）
+#   current: 共有カタログへの参照（ResultView）と id だけを持つ（今の app.py）
+#
+# 検索自体は行わず、hybrid_search_constellations の戻り値と同じ形の結果を作って使う。
+
+import argparse
+import gc
+import json
+import random
+import tracemalloc
+import uuid
+
+from config import CONSTELLATION_DATA_PATH, INDEX_DIR
+from .searcher import ConstellationSearcher
+
+_TOP_K = 5
+_OPENED_STORIES = 2
+_STORY = "むかしむかし、" * 60   # 共有キャッシュにあるストーリー本文の代わり
+
+
+def _fake_raw_results(ids: list, rng: random.Random) -> list:
+    """hybrid_search_constellations の戻り値と同じ形の結果"""
+    picked = rng.sample(ids, _TOP_K)
+    return [{"id": cid, "jp_name": cid, "rrf_score": 1.0 / (60 + rank),
+             "snippet": f"{cid} の神話の冒頭 120 文字ぶん" * 4}
+            for rank, cid in enumerate(picked)]
+
+
+def _expanded_query(rng: random.Random) -> dict:
+    return {"original": "冬の寒い日", "season": "冬", "months": [12, 1, 2],
+            "keywords": ["冬", "オリオン", f"キーワード{rng.randint(0, 999)}"]}
+
+
+def _legacy_session(raw_results: list, rng: random.Random) -> dict:
+    with open(CONSTELLATION_DATA_PATH, "r", encoding="utf-8") as f:
+        by_id = {c["id"]: c for c in json.load(f)}   # 以前の searcher.constellations_by_id
+    results = []
+    for r in raw_results:
+        base = by_id.get(r["id"], {}).copy()
+        base["snippet"] = r["snippet"]
+        results.append((base, r["rrf_score"]))
+    return {
+        "session_id": uuid.uuid4().hex,
+        "searcher": by_id,
+        "search_results": results,
+        "expanded_query": _expanded_query(rng),
+        "expanded_stories": {base["id"]: _STORY for base, _ in results[:_OPENED_STORIES]},
+    }
+
+
+def _current_session(searcher: ConstellationSearcher, raw_results: list, rng: random.Random) -> dict:
+    results = searcher.to_results(raw_results)
+    return {
+        "session_id": uuid.uuid4().hex,
+        "search_results": results,
+        "expanded_query": _expanded_query(rng),
+        "expanded_story_ids": {view["id"] for view, _ in results[:_OPENED_STORIES]},
+    }
+
+
+def measure(mode: str, n_sessions: int, seed: int = 0) -> int:
+    """n_sessions 個のセッション状態を作ったときに増えたバイト数（共有カタログの読み込みは含めない）"""
+    searcher = ConstellationSearcher(CONSTELLATION_DATA_PATH, INDEX_DIR)
+    ids = list(searcher.constellations_by_id)
+    rng = random.Random(seed)
+    raws = [_fake_raw_results(ids, rng) for _ in range(n_sessions)]
+
+    gc.collect()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    if mode == "legacy":
+        sessions = [_legacy_session(raw, rng) for raw in raws]
+    else:
+        sessions = [_current_session(searcher, raw, rng) for raw in raws]
+    gc.collect()
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del sessions
+    return after - before
+
+
+def benchmark(session_counts=(1, 100, 1000)):
+    print(f"{'sessions':>8} {'legacy':>14} {'current':>14} {'legacy/sess':>12} {'current/sess':>12}")
+    for n in session_counts:
+        legacy = measure("legacy", n)
+        current = measure("current", n)
+        print(f"{n:8d} {legacy / 1024:11.1f} KiB {current / 1024:11.1f} KiB "
+              f"{legacy / n:10.0f} B {current / n:10.0f} B  (x{legacy / max(current, 1):.0f})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="セッションあたりのメモリ使用量のベンチマーク")
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 100, 1000])
+    args = parser.parse_args()
+    benchmark(args.sessions)
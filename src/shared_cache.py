@@ -0,0 +1,60 @@
+"""
+SkyLore - プロセス内で共有する LRU キャッシュモジュール
+クエリ拡張や検索結果のように、セッションをまたいで使い回せる結果を
+件数上限付きで持つ。引くたびにヒット/ミスを数え、いまの検索リクエストにも記録する。
+"""
+import threading
+from collections import OrderedDict
+
+from .query_log import note_cache
+
+
+class SharedLRUCache:
+    """スレッドセーフな LRU キャッシュ（値は読み取り専用として扱うこと）"""
+
+    def __init__(self, name: str, maxsize: int):
+        self.name = name
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                value = self._data[key]
+                hit = True
+            else:
+                self.misses += 1
+                value = default
+                hit = False
+        note_cache(self.name, hit)
+        return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            requests = self.hits + self.misses
+            return {"size": len(self._data), "maxsize": self.maxsize, "hits": self.hits,
+                    "misses": self.misses, "hit_rate": self.hits / requests if requests else 0.0}
@@ -0,0 +1,230 @@
+"""
+SkyLore - 同じ API 呼び出しの相乗り（singleflight）モジュール
+何人かが同時に同じクイック検索を押すと、セッションごとに同じクエリ拡張・
+ベクトル検索・関連星座の整形を呼んでしまう。ここでは (呼び出しの種類, 正規化した引数) を
+キーにして、実行中の呼び出しがあればそれの完了を待って同じ結果を受け取る。
+
+- プロセス内: スレッド間で 1 つの呼び出しを共有する
+- プロセス間（SINGLEFLIGHT_DIR を設定したときだけ）: キーごとのロックファイルを
+  flock で取り合い、取れなかった側は持ち主が書いた結果ファイル（pickle）を読む
+
+結果は複数の呼び出し元で共有されるので、受け取った側は書き換えないこと。
+
+先に呼んだ側（先読みなど）より優先度の高い呼び出し元が相乗りしたら、実行中の呼び出しが
+スケジューラの待ち行列にいる間はその優先度まで上げる（上位の呼び出し元が下位の待ち時間で待たないように）。
+"""
+import hashlib
+import os
+import pickle
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+from config import SINGLEFLIGHT_DIR, SINGLEFLIGHT_WAIT_SEC, SINGLEFLIGHT_RESULT_TTL_SEC, LLM_PRIORITY_CLASSES
+from .query_log import note_cache
+from .llm_scheduler import get_scheduler, use_tag
+
+try:
+    import fcntl
+except ImportError:   # Windows ではプロセス間の相乗りは使えない
+    fcntl = None
+
+
+class _Call:
+    """
+    実行中の呼び出し 1 つ分（待っている側はこれの event を待つ）
+
+    スケジューラの tag にもなる。priority は相乗りした呼び出し元のうち一番上の優先度クラス
+    （まだ待ち行列に並んでいなければ、並ぶときにこの優先度になる）。
+    """
+
+    __slots__ = ("event", "result", "error", "priority")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.priority = None
+
+
+class SingleFlight:
+    """
+    do(kind, key, fn, ...) で fn を呼ぶ。同じ (kind, key) が実行中なら fn は呼ばずに
+    その結果（例外ならその例外）を受け取る。
+
+    stats の数え方（kind ごと）:
+        calls         : do() が呼ばれた回数
+        executed      : 実際に fn を呼んだ回数
+        coalesced     : 同じプロセスの実行中の呼び出しに相乗りした回数
+        cross_process : 別プロセスの結果ファイルを受け取った回数
+    """
+
+    def __init__(self, lock_dir: str | Path | None = None, wait_sec: float = SINGLEFLIGHT_WAIT_SEC,
+                 result_ttl_sec: float = SINGLEFLIGHT_RESULT_TTL_SEC):
+        self.lock_dir = Path(lock_dir) if lock_dir and fcntl is not None else None
+        if self.lock_dir is not None:
+            self.lock_dir.mkdir(parents=True, exist_ok=True)
+        self.wait_sec = wait_sec
+        self.result_ttl_sec = result_ttl_sec
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._stats = {}
+        self._last_sweep = 0.0
+
+    def _count(self, kind: str, field: str):
+        # 呼び出し側でロックを取っていること
+        self._stats.setdefault(kind, Counter())[field] += 1
+
+    def do(self, kind: str, key, fn, *args, **kwargs):
+        flight_key = (kind, key)
+        with self._lock:
+            self._count(kind, "calls")
+            call = self._calls.get(flight_key)
+            leader = call is None
+            if leader:
+                call = self._calls[flight_key] = _Call()
+            else:
+                self._count(kind, "coalesced")
+
+        if not leader:
+            note_cache(f"inflight_{kind}", True)
+            self._promote(kind, call)
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            with use_tag(call):
+                call.result = self._run(kind, key, fn, args, kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(flight_key, None)
+            call.event.set()
+
+    def _promote(self, kind: str, call: _Call):
+        """相乗りした自分の優先度（段階名 kind から決まる）まで、実行中の呼び出しを上げる"""
+        scheduler = get_scheduler()
+        priority, _ = scheduler.resolve_priority(kind)
+        rank = LLM_PRIORITY_CLASSES.index(priority)
+        with self._lock:
+            if call.priority is not None and LLM_PRIORITY_CLASSES.index(call.priority) <= rank:
+                return
+            call.priority = priority
+        scheduler.promote(call, priority)
+
+    def _execute(self, kind: str, fn, args, kwargs):
+        with self._lock:
+            self._count(kind, "executed")
+        note_cache(f"inflight_{kind}", False)
+        return fn(*args, **kwargs)
+
+    def _run(self, kind: str, key, fn, args, kwargs):
+        if self.lock_dir is None:
+            return self._execute(kind, fn, args, kwargs)
+
+        digest = hashlib.sha1(repr((kind, key)).encode("utf-8")).hexdigest()
+        lock_path = self.lock_dir / f"{digest}.lock"
+        result_path = self.lock_dir / f"{digest}.pkl"
+        waited_since = time.time_ns()
+
+        with lock_path.open("a+b") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                locked = True
+            except BlockingIOError:
+                # 別プロセスが実行中: 終わるのを待ってから結果ファイルを読む
+                locked = self._wait_lock(lock_file)
+                result = self._read_result(result_path, waited_since)
+                if result is not None:
+                    if locked:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+                    with self._lock:
+                        self._count(kind, "cross_process")
+                    note_cache(f"inflight_{kind}", True)
+                    return result[0]
+            # 持ち主が失敗した・待ちきれなかった場合は自分で呼ぶ
+            try:
+                result = self._execute(kind, fn, args, kwargs)
+                if locked:
+                    self._write_result(result_path, result)
+                return result
+            finally:
+                if locked:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _wait_lock(self, lock_file) -> bool:
+        deadline = time.perf_counter() + self.wait_sec
+        while time.perf_counter() < deadline:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except BlockingIOError:
+                time.sleep(0.01)
+        return False
+
+    @staticmethod
+    def _read_result(result_path: Path, since_ns: int):
+        """待ち始めてから書かれた結果なら (結果,) を返す"""
+        try:
+            if result_path.stat().st_mtime_ns < since_ns:
+                return None
+            with result_path.open("rb") as f:
+                return (pickle.load(f),)
+        except (OSError, pickle.PickleError, EOFError):
+            return None
+
+    def _write_result(self, result_path: Path, result):
+        tmp_path = result_path.with_name(f"{result_path.name}.{os.getpid()}.tmp")
+        try:
+            with tmp_path.open("wb") as f:
+                pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+            tmp_path.replace(result_path)
+        except (OSError, pickle.PickleError, TypeError, AttributeError):
+            tmp_path.unlink(missing_ok=True)   # pickle できない結果は共有しない
+            return
+        self._sweep()
+
+    def _sweep(self):
+        """古い結果ファイルを消す（result_ttl_sec ごとに 1 回）"""
+        now = time.time()
+        if now - self._last_sweep < self.result_ttl_sec:
+            return
+        self._last_sweep = now
+        for path in self.lock_dir.glob("*.pkl"):
+            try:
+                if now - path.stat().st_mtime > self.result_ttl_sec:
+                    path.unlink()
+            except OSError:
+                continue
+
+    def stats(self) -> dict:
+        """kind ごとの回数と、API を呼ばずに済んだ割合"""
+        with self._lock:
+            stats = {kind: dict(c) for kind, c in self._stats.items()}
+        for s in stats.values():
+            saved = s.get("coalesced", 0) + s.get("cross_process", 0)
+            s["saved_rate"] = saved / s["calls"] if s.get("calls") else 0.0
+        return stats
+
+
+# プロセス全体で共有する singleflight
+_singleflight = SingleFlight(SINGLEFLIGHT_DIR)
+
+
+def get_singleflight() -> SingleFlight:
+    return _singleflight
+
+
+def coalesce(kind: str, key, fn, *args, **kwargs):
+    """共有の singleflight で fn(*args, **kwargs) を呼ぶ"""
+    return _singleflight.do(kind, key, fn, *args, **kwargs)
+
+
+def get_singleflight_stats() -> dict:
+    return _singleflight.stats()
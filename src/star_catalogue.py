@@ -0,0 +1,319 @@
+"""
+SkyLore - 輝星カタログモジュール
+同梱の輝星カタログ（data/bright_stars.csv）を列ごとの NumPy 配列で持ち、
+単位ベクトルの k-d 木で「ある方向の近くの星」「何等より明るい星」
+「ある星座に属する星」をネットワークなしでサブミリ秒で引く
+"""
+import argparse
+import csv
+import json
+import math
+import time
+from pathlib import Path
+
+import numpy as np
+
+from config import CONSTELLATION_COORDS_PATH, STAR_CATALOGUE_PATH, STAR_NEAR_RADIUS_DEG
+
+# k-d 木の葉に入れる星の数（葉の中は NumPy でまとめて判定する）
+_LEAF_SIZE = 32
+
+
+def radec_to_xyz(ra_deg, dec_deg) -> np.ndarray:
+    """赤経・赤緯（度）を天球上の単位ベクトル（形状 (..., 3)）にする"""
+    ra = np.radians(np.asarray(ra_deg, dtype=np.float64))
+    dec = np.radians(np.asarray(dec_deg, dtype=np.float64))
+    cos_dec = np.cos(dec)
+    return np.stack([cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)], axis=-1)
+
+
+def _chord2(radius_deg: float) -> float:
+    """角距離 radius_deg に対応する単位球上の弦の長さの 2 乗"""
+    return (2.0 * math.sin(math.radians(min(radius_deg, 180.0)) / 2.0)) ** 2
+
+
+class _KDTree:
+    """
+    単位ベクトルの静的 k-d 木
+
+    星は葉ごとに連続するよう並べ替えてあり（order）、各ノードは
+    バウンディングボックスと部分木内の最も明るい等級を持つ。
+    等級での枝刈りができるので、等級制限つきの検索も木をたどるだけで済む。
+    """
+
+    def __init__(self, xyz: np.ndarray, mag: np.ndarray, leaf_size: int = _LEAF_SIZE):
+        self.leaf_size = leaf_size
+        self.order = np.arange(len(xyz))
+        self.lo, self.hi, self.min_mag = [], [], []
+        self.left, self.right, self.start, self.end = [], [], [], []
+        if len(xyz):
+            self._build(xyz, mag, 0, len(xyz))
+        self.xyz = xyz[self.order]
+        self.mag = mag[self.order]
+
+    def _build(self, xyz, mag, start, end) -> int:
+        idx = self.order[start:end]
+        pts = xyz[idx]
+        node = len(self.lo)
+        self.lo.append(tuple(pts.min(axis=0).tolist()))
+        self.hi.append(tuple(pts.max(axis=0).tolist()))
+        self.min_mag.append(float(mag[idx].min()))
+        self.start.append(start)
+        self.end.append(end)
+        self.left.append(-1)
+        self.right.append(-1)
+
+        if end - start > self.leaf_size:
+            dim = int(np.argmax(pts.max(axis=0) - pts.min(axis=0)))
+            mid = (end - start) // 2
+            self.order[start:end] = idx[np.argpartition(pts[:, dim], mid)]
+            self.left[node] = self._build(xyz, mag, start, start + mid)
+            self.right[node] = self._build(xyz, mag, start + mid, end)
+        return node
+
+    def query(self, p: tuple, chord2: float, mag_limit: float) -> np.ndarray:
+        """p から弦の長さ² が chord2 以内かつ mag_limit 等以下の星（order 上の位置）"""
+        if not self.lo:
+            return np.empty(0, dtype=np.int64)
+        px, py, pz = p
+        p_arr = np.asarray(p)
+        hits = []
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            if self.min_mag[node] > mag_limit:
+                continue
+            lx, ly, lz = self.lo[node]
+            hx, hy, hz = self.hi[node]
+            # ボックスまでの最短距離² が半径を超えたら枝刈り
+            dx = lx - px if px < lx else (px - hx if px > hx else 0.0)
+            dy = ly - py if py < ly else (py - hy if py > hy else 0.0)
+            dz = lz - pz if pz < lz else (pz - hz if pz > hz else 0.0)
+            if dx * dx + dy * dy + dz * dz > chord2:
+                continue
+
+            if self.left[node] < 0:
+                s, e = self.start[node], self.end[node]
+                d = self.xyz[s:e] - p_arr
+                mask = np.einsum("ij,ij->i", d, d) <= chord2
+                if mag_limit < math.inf:
+                    mask &= self.mag[s:e] <= mag_limit
+                hits.append(np.flatnonzero(mask) + s)
+            else:
+                stack.append(self.right[node])
+                stack.append(self.left[node])
+
+        return np.concatenate(hits) if hits else np.empty(0, dtype=np.int64)
+
+
+class StarCatalogue:
+    """
+    輝星カタログ（列ごとの NumPy 配列 + 空間インデックス）
+
+    星の番号（index）はカタログ内で明るい順に振り直してあるので、
+    番号の昇順に並べればそのまま明るい順になる。
+    """
+
+    def __init__(self, names: list, jp_names: list, ra_deg, dec_deg, vmag, constellations: list):
+        order = np.argsort(np.asarray(vmag, dtype=np.float64), kind="stable")
+        self.names = [names[i] for i in order]
+        self.jp_names = [jp_names[i] for i in order]
+        self.ra_deg = np.asarray(ra_deg, dtype=np.float64)[order]
+        self.dec_deg = np.asarray(dec_deg, dtype=np.float64)[order]
+        self.vmag = np.asarray(vmag, dtype=np.float32)[order]
+
+        self.constellation_ids = sorted(set(constellations))
+        con_index = {cid: i for i, cid in enumerate(self.constellation_ids)}
+        self.constellation = np.asarray([con_index[constellations[i]] for i in order], dtype=np.int16)
+
+        self.xyz = radec_to_xyz(self.ra_deg, self.dec_deg)
+        self._tree = _KDTree(self.xyz, self.vmag.astype(np.float64))
+
+        # 星座ごとの星の番号（明るい順）を CSR 形式で持つ
+        by_con = np.argsort(self.constellation, kind="stable")
+        counts = np.bincount(self.constellation, minlength=len(self.constellation_ids))
+        self._con_members = by_con
+        self._con_offsets = np.concatenate([[0], np.cumsum(counts)])
+        self._con_index = con_index
+
+    @classmethod
+    def load(cls, path: str | Path = STAR_CATALOGUE_PATH):
+        """CSV（name, jp_name, ra_deg, dec_deg, vmag, constellation）から読み込む"""
+        with Path(path).open("r", encoding="utf-8", newline="") as f:
+            rows = list(csv.DictReader(f))
+        return cls(
+            names=[r["name"] for r in rows],
+            jp_names=[r["jp_name"] for r in rows],
+            ra_deg=[float(r["ra_deg"]) for r in rows],
+            dec_deg=[float(r["dec_deg"]) for r in rows],
+            vmag=[float(r["vmag"]) for r in rows],
+            constellations=[r["constellation"] for r in rows],
+        )
+
+    def __len__(self):
+        return len(self.names)
+
+    def star(self, i: int) -> dict:
+        """1 星分の情報を dict で返す"""
+        return {
+            "name": self.names[i],
+            "jp_name": self.jp_names[i],
+            "ra_deg": float(self.ra_deg[i]),
+            "dec_deg": float(self.dec_deg[i]),
+            "vmag": float(self.vmag[i]),
+            "constellation": self.constellation_ids[self.constellation[i]],
+        }
+
+    def separation_deg(self, indices, ra_deg: float, dec_deg: float) -> np.ndarray:
+        """星（indices）と (ra_deg, dec_deg) の角距離（度）"""
+        p = radec_to_xyz(ra_deg, dec_deg)
+        dot = np.clip(self.xyz[np.asarray(indices, dtype=np.int64)] @ p, -1.0, 1.0)
+        return np.degrees(np.arccos(dot))
+
+    # ------------------------------------------------------------
+    # 検索
+    # ------------------------------------------------------------
+
+    def cone_search_idx(self, ra_deg: float, dec_deg: float, radius_deg: float,
+                        mag_limit: float = None) -> np.ndarray:
+        """中心から radius_deg 度以内（かつ mag_limit 等以下）の星の番号を明るい順に返す"""
+        p = tuple(radec_to_xyz(ra_deg, dec_deg).tolist())
+        limit = math.inf if mag_limit is None else mag_limit
+        pos = self._tree.query(p, _chord2(radius_deg), limit)
+        return np.sort(self._tree.order[pos])
+
+    def cone_search(self, ra_deg: float, dec_deg: float, radius_deg: float,
+                    mag_limit: float = None) -> list:
+        """cone_search_idx の結果を、中心からの角距離付きの dict で返す"""
+        idx = self.cone_search_idx(ra_deg, dec_deg, radius_deg, mag_limit)
+        seps = self.separation_deg(idx, ra_deg, dec_deg)
+        return [dict(self.star(i), separation_deg=float(sep)) for i, sep in zip(idx.tolist(), seps)]
+
+    def brightest_idx(self, n: int = 10, mag_limit: float = None) -> np.ndarray:
+        """全天で明るい順に n 個（番号は明るい順なので先頭から取るだけ）"""
+        end = len(self) if mag_limit is None else int(np.searchsorted(self.vmag, mag_limit, side="right"))
+        return np.arange(min(n, end))
+
+    def constellation_stars_idx(self, constellation_id: str, mag_limit: float = None) -> np.ndarray:
+        """その星座に属する星の番号（明るい順）。カタログに無い星座なら空"""
+        c = self._con_index.get(constellation_id)
+        if c is None:
+            return np.empty(0, dtype=np.int64)
+        members = self._con_members[self._con_offsets[c]:self._con_offsets[c + 1]]
+        if mag_limit is not None:
+            members = members[self.vmag[members] <= mag_limit]
+        return members
+
+    def constellation_stars(self, constellation_id: str, mag_limit: float = None, limit: int = None) -> list:
+        idx = self.constellation_stars_idx(constellation_id, mag_limit)[:limit]
+        return [self.star(i) for i in idx.tolist()]
+
+    def keywords_for(self, constellation_id: str, mag_limit: float = None) -> list:
+        """検索キーワード用に、星座に属する星の和名（明るい順）を返す"""
+        return [self.jp_names[i] for i in self.constellation_stars_idx(constellation_id, mag_limit).tolist()]
+
+
+# ================================================================
+# 共有カタログ + 星座の中心まわりの検索
+# ================================================================
+
+_catalogue = None
+_centers = None
+
+
+def get_star_catalogue() -> StarCatalogue | None:
+    """共有カタログを返す（カタログファイルが無ければ None）"""
+    global _catalogue
+    if _catalogue is None and Path(STAR_CATALOGUE_PATH).exists():
+        _catalogue = StarCatalogue.load()
+    return _catalogue
+
+
+def _constellation_centers() -> dict:
+    global _centers
+    if _centers is None:
+        with Path(CONSTELLATION_COORDS_PATH).open("r", encoding="utf-8") as f:
+            _centers = {c["id"]: (c["ra_hours"] * 15.0, c["dec_deg"]) for c in json.load(f)}
+    return _centers
+
+
+def stars_near_constellation(constellation_id: str, radius_deg: float = STAR_NEAR_RADIUS_DEG,
+                             mag_limit: float = None) -> list:
+    """星座の中心から radius_deg 度以内の星（その星座に属さない星も含む）"""
+    catalogue = get_star_catalogue()
+    center = _constellation_centers().get(constellation_id)
+    if catalogue is None or center is None:
+        return []
+    return catalogue.cone_search(center[0], center[1], radius_deg, mag_limit)
+
+
+# ================================================================
+# ベンチマーク（合成カタログ）
+# ================================================================
+
+def make_synthetic_catalogue(n_stars: int, seed: int = 0) -> StarCatalogue:
+    """全天に一様に散らばり、暗い星ほど多い（等級の分布が指数的な）合成カタログ"""
+    rng = np.random.default_rng(seed)
+    ra = rng.uniform(0.0, 360.0, n_stars)
+    dec = np.degrees(np.arcsin(rng.uniform(-1.0, 1.0, n_stars)))
+    vmag = np.clip(-1.5 + rng.exponential(2.0, n_stars), -1.5, 12.0)
+    constellations = [f"C{i % 88:02d}" for i in range(n_stars)]
+    names = [f"S{i}" for i in range(n_stars)]
+    return StarCatalogue(names, names, ra, dec, vmag, constellations)
+
+
+def _brute_force(catalogue, ra, dec, radius, mag_limit):
+    d = catalogue.xyz - radec_to_xyz(ra, dec)
+    mask = np.einsum("ij,ij->i", d, d) <= _chord2(radius)
+    if mag_limit is not None:
+        mask &= catalogue.vmag <= mag_limit
+    return np.flatnonzero(mask)
+
+
+def benchmark(sizes=(10000, 100000), radius_deg: float = 5.0, mag_limit: float = 3.0,
+              n_queries: int = 200):
+    rng = np.random.default_rng(1)
+    for n_stars in sizes:
+        start = time.perf_counter()
+        catalogue = make_synthetic_catalogue(n_stars)
+        build_ms = (time.perf_counter() - start) * 1000
+        queries = list(zip(rng.uniform(0, 360, n_queries),
+                           np.degrees(np.arcsin(rng.uniform(-1, 1, n_queries)))))
+        print(f"\n=== stars={n_stars} (build {build_ms:.0f} ms) ===")
+
+        for label, limit in (("cone", None), (f"cone mag<={mag_limit}", mag_limit)):
+            ok = all(np.array_equal(catalogue.cone_search_idx(ra, dec, radius_deg, limit),
+                                    _brute_force(catalogue, ra, dec, radius_deg, limit))
+                     for ra, dec in queries[:20])
+            for name, fn in (("kd-tree", catalogue.cone_search_idx), ("brute", None)):
+                start = time.perf_counter()
+                n_hits = 0
+                for ra, dec in queries:
+                    hits = (fn(ra, dec, radius_deg, limit) if fn
+                            else _brute_force(catalogue, ra, dec, radius_deg, limit))
+                    n_hits += len(hits)
+                ms = (time.perf_counter() - start) * 1000 / n_queries
+                print(f"  {label:16s} {name:8s}: {ms:8.3f} ms/query "
+                      f"({n_hits / n_queries:.1f} hits) {'OK' if ok else 'MISMATCH'}")
+
+        start = time.perf_counter()
+        for i in range(n_queries):
+            catalogue.constellation_stars_idx(f"C{i % 88:02d}", mag_limit)
+        ms = (time.perf_counter() - start) * 1000 / n_queries
+        print(f"  per-constellation mag<={mag_limit}: {ms:8.3f} ms/query")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="輝星カタログの検索とベンチマーク")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--radius", type=float, default=5.0)
+    args = parser.parse_args()
+
+    catalogue = get_star_catalogue()
+    print(f"カタログ: {len(catalogue)} 星")
+    print("オリオン座の星:", ", ".join(
+        f"{s['jp_name']}({s['vmag']:.1f}等)" for s in catalogue.constellation_stars("Orion")))
+    print("オリオン座の近くの2等より明るい星:", ", ".join(
+        f"{s['jp_name']}[{s['constellation']}] {s['separation_deg']:.1f}°"
+        for s in stars_near_constellation("Orion", mag_limit=2.0)))
+    benchmark(args.sizes, args.radius)
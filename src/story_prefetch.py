@@ -0,0 +1,223 @@
+"""
+SkyLore - ストーリー先読みモジュール
+検索結果の上位N件のストーリーをバックグラウンドで先に生成しておき、
+「ストーリーをもっと聞く」ボタンが押されたときにすぐ返せるようにする
+"""
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future, CancelledError
+
+from config import DEFAULT_LLM, STORY_PREFETCH_WORKERS, STORY_CACHE_SIZE, STORY_PREFETCH_SESSIONS
+from .query_expander import StoryGenerator
+from .query_log import note_cache
+from .llm_scheduler import get_scheduler, use_priority
+from .constellation_bm25_vec_rrf_search import get_index_version
+
+
+class StoryPrefetcher:
+    """
+    ストーリーの先読みとキャッシュを担当するクラス（プロセス内で共有）
+
+    - prefetch(): 検索直後に呼ぶ。同じセッションの前回分で未着手のものはキャンセル
+    - get_story(): ボタン押下時に呼ぶ。完成済みならキャッシュから、
+      生成中ならその完了を待ち、どちらでもなければその場で生成する
+
+    API エラーで生成できなかったときの代わりの文章（既存の神話）はキャッシュしない。
+    次にボタンが押されたときにもう一度生成を試す。
+
+    キャッシュのキーは (cid, version_fn()) 。myth_summary の編集やインデックスの
+    公開で版が変わると、前の版のストーリーは返さずに作り直す（古い分は LRU で消える）。
+    """
+
+    def __init__(self, model: str = DEFAULT_LLM, max_workers: int = STORY_PREFETCH_WORKERS,
+                 cache_size: int = STORY_CACHE_SIZE, max_sessions: int = STORY_PREFETCH_SESSIONS,
+                 version_fn=get_index_version):
+        self.model = model
+        self.version_fn = version_fn
+        self.cache_size = cache_size
+        self.max_sessions = max_sessions
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix="story-prefetch")
+        # Future.cancel() はロック内で完了コールバックを呼ぶので再入可能にしておく
+        self._lock = threading.RLock()
+        self._generator = None
+        self._cache = OrderedDict()   # (cid, version) -> story
+        self._inflight = {}           # (cid, version) -> Future
+        self._batches = OrderedDict() # session_id -> [(cid, version), ...]（最近先読みしたセッションが後ろ）
+        self._prefetched = set()      # 先読みで作られ、まだ誰にも使われていない (cid, version)
+        self.metrics = {
+            "submitted": 0,     # 先読みを投入した数
+            "cancelled": 0,     # 着手前にキャンセルできた数
+            "completed": 0,     # 先読みで生成し終えた数
+            "hits": 0,          # クリック時にキャッシュにあった数
+            "inflight_hits": 0, # クリック時に生成中で、完了を待った数
+            "misses": 0,        # クリック時にその場で生成した数
+            "wasted": 0,        # 生成したが使われないまま置き換えられた数
+            "failed": 0,        # API エラーで生成できなかった数（キャッシュしない）
+        }
+
+    def _get_generator(self) -> StoryGenerator:
+        with self._lock:
+            if self._generator is None:
+                self._generator = StoryGenerator(model=self.model)
+            return self._generator
+
+    def _key(self, cid: str, version: str | None = None) -> tuple:
+        return (cid, self.version_fn() if version is None else version)
+
+    def _put(self, key: tuple, story: str):
+        # 呼び出し側でロックを取っていること
+        self._cache[key] = story
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            old_key, _ = self._cache.popitem(last=False)
+            if old_key in self._prefetched:
+                self._prefetched.discard(old_key)
+                self.metrics["wasted"] += 1
+
+    def _generate(self, constellation: dict, key: tuple) -> str:
+        cid = constellation["id"]
+        # 先読みは一番低い優先度で。クリックされたら get_story() が story まで上げる
+        with use_priority("prefetch", tag=("story", cid)):
+            try:
+                story = self._get_generator().generate(constellation, raise_errors=True)
+            except Exception:
+                # 失敗はキャッシュせず、クリックされたら get_story() がもう一度試す
+                with self._lock:
+                    self.metrics["failed"] += 1
+                raise
+        with self._lock:
+            self._put(key, story)
+            self.metrics["completed"] += 1
+            self._inflight.pop(key, None)
+            if any(key in batch for batch in self._batches.values()):
+                self._prefetched.add(key)
+            else:
+                # キャンセルが間に合わず、置き換え後に生成し終えた分
+                self.metrics["wasted"] += 1
+        return story
+
+    def _forget(self, key: tuple, future: Future):
+        with self._lock:
+            if self._inflight.get(key) is future and future.done():
+                self._inflight.pop(key, None)
+
+    def _release(self, old_keys: list, keep=()):
+        """
+        前回の先読み分のうち keep に無いものを片付ける（未着手ならキャンセル）
+        呼び出し側でロックを取っていること
+        """
+        for old_key in old_keys:
+            if old_key in keep:
+                continue
+            future = self._inflight.get(old_key)
+            if future is not None and future.cancel():
+                self._inflight.pop(old_key, None)
+                self.metrics["cancelled"] += 1
+            elif old_key in self._prefetched and not any(
+                    old_key in batch for batch in self._batches.values()):
+                self._prefetched.discard(old_key)
+                self.metrics["wasted"] += 1
+
+    def prefetch(self, session_id: str, constellations: list):
+        """
+        検索結果の星座リストのストーリー生成をバックグラウンドで開始する
+
+        Args:
+            session_id: セッションを識別するID（前回の先読みを置き換えるのに使う）
+            constellations: 先読みする星座の情報（上位N件）
+        """
+        version = self.version_fn()
+        keys = [self._key(c["id"], version) for c in constellations if c.get("myth_summary")]
+        with self._lock:
+            # 同じセッションの前回分のうち、今回の結果に無いものを片付ける
+            self._release(self._batches.pop(session_id, []), keep=keys)
+            if keys:
+                self._batches[session_id] = keys
+            # セッションの終わりは分からないので、古いセッションの分から捨てる
+            while len(self._batches) > self.max_sessions:
+                _, old_keys = self._batches.popitem(last=False)
+                self._release(old_keys)
+
+            for c in constellations:
+                key = self._key(c["id"], version)
+                if key not in keys or key in self._cache or key in self._inflight:
+                    continue
+                future = self._executor.submit(self._generate, c, key)
+                future.add_done_callback(lambda f, key=key: self._forget(key, f))
+                self._inflight[key] = future
+                self.metrics["submitted"] += 1
+
+    def get_story(self, constellation: dict) -> str:
+        """
+        ストーリーを返す（先読み済みならすぐ返る）
+
+        Args:
+            constellation: 星座の情報
+
+        Returns:
+            ストーリー文字列
+        """
+        cid = constellation["id"]
+        key = self._key(cid)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self._prefetched.discard(key)
+                self.metrics["hits"] += 1
+                note_cache("story", True)
+                return self._cache[key]
+            future = self._inflight.get(key)
+
+        if future is not None and future.cancel():
+            # まだ先読みのスレッドにも乗っていない: 待たずにこの場で生成する
+            with self._lock:
+                self._inflight.pop(key, None)
+                self.metrics["cancelled"] += 1
+            future = None
+        if future is not None:
+            # 待ち行列にいる先読みの API 呼び出しを、クリックされたストーリーの優先度に上げる
+            get_scheduler().promote(("story", cid), "story")
+            try:
+                story = future.result()
+                with self._lock:
+                    self._prefetched.discard(key)
+                    self.metrics["inflight_hits"] += 1
+                note_cache("story", True)
+                return story
+            except (CancelledError, Exception):
+                # 先読みが失敗・キャンセルされた場合はその場で生成する
+                pass
+
+        generator = self._get_generator()
+        try:
+            story = generator.generate(constellation, raise_errors=True)
+        except Exception:
+            # 代わりの文章は返すだけでキャッシュしない（次のクリックで作り直す）
+            with self._lock:
+                self.metrics["failed"] += 1
+                self.metrics["misses"] += 1
+            note_cache("story", False)
+            return generator.fallback(constellation)
+        with self._lock:
+            self._put(key, story)
+            self.metrics["misses"] += 1
+        note_cache("story", False)
+        return story
+
+    def peek(self, cid: str) -> str | None:
+        """今の版でキャッシュ済みのストーリーを返す（無ければ None。生成もメトリクスの更新もしない）"""
+        key = self._key(cid)
+        with self._lock:
+            return self._cache.get(key)
+
+    def get_metrics(self) -> dict:
+        """先読みのヒット率などを返す"""
+        with self._lock:
+            m = dict(self.metrics)
+        requests = m["hits"] + m["inflight_hits"] + m["misses"]
+        m["hit_rate"] = (m["hits"] + m["inflight_hits"]) / requests if requests else 0.0
+        return m
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
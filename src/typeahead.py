@@ -0,0 +1,245 @@
+"""
+SkyLore - 入力中の候補（typeahead）モジュール
+星座の和名・英名（id）・かなの読み・keywords と inverted_index.json の見出し語から
+前方一致の候補を返す。LLM もベクトル検索も使わない。
+
+トライは配列に詰めたもので、ノードに幅優先で番号を振って子を連続した番号に置き、ノードごとに
+  - 子の文字を並べた文字列と、最初の子のノード番号
+  - そのノード以下の候補の上位 TYPEAHEAD_MAX_RESULTS 件（作るときに計算しておく）
+を持つ。引くときは入力の文字数だけ子をたどって、上位のリストをそのまま返す。
+
+    python -m src.typeahead --prefix おり     # 候補の表示と、1 回あたりの時間
+"""
+import argparse
+import json
+import random
+import re
+import time
+import unicodedata
+from array import array
+from pathlib import Path
+
+from config import CONSTELLATION_DATA_PATH, INVERTED_INDEX_PATH, TYPEAHEAD_MAX_RESULTS
+
+# カタカナ -> ひらがな（「おりおん」でも「オリオン座」に当たるように）
+_KATA_TO_HIRA = {c: c - 0x60 for c in range(ord("ァ"), ord("ヶ") + 1)}
+
+# 見出し語の種類ごとの重み（同じ候補に複数の語から当たるときは一番高いものを使う）
+KIND_WEIGHTS = {
+    "name": 1.0,      # 和名（「オリオン座」「オリオン」）
+    "reading": 0.9,   # かなの読み（ひらがなにしたもの）
+    "id": 0.8,        # 英名（"Orion"）
+    "keyword": 0.5,   # keywords と inverted_index.json の見出し語（当たる星座が少ないほど高い）
+}
+
+
+def normalize_prefix(text: str) -> str:
+    """引くときと作るときに共通の正規化（NFKC、小文字、カタカナはひらがな、空白は除く）"""
+    text = unicodedata.normalize("NFKC", text or "").lower().translate(_KATA_TO_HIRA)
+    return re.sub(r"\s+", "", text)
+
+
+class Typeahead:
+    """
+    add(key, label, ids, weight) で見出し語を足して build() したあと、suggest(prefix) で引く。
+    候補は {"label", "ids", "score"}。同じ ids を指す候補は 1 つにまとめ、入力に当たった
+    見出し語のうち一番重いもののラベルを使う（「かぺ」なら「カペラ → ぎょしゃ座」）。
+    """
+
+    def __init__(self, max_results: int = TYPEAHEAD_MAX_RESULTS):
+        self.max_results = max_results
+        self._entries = {}   # 正規化した見出し語 -> {ids: (重み, ラベル)}
+        self.labels = []     # 候補番号 -> ラベル
+        self.ids = []        # 候補番号 -> ids のタプル
+        self.scores = []     # 候補番号 -> 重み
+        # 配列に詰めたトライ
+        self.child_chars = []              # ノード -> 子の文字を並べた文字列
+        self.child_start = array("I")      # ノード -> 最初の子のノード番号（子は文字順に連続）
+        self.top = []                      # ノード -> 上位の候補番号のタプル
+        self.exact = []                    # ノード -> そこで終わる見出し語の候補番号のタプル
+
+    def add(self, key: str, label: str, ids, weight: float):
+        key = normalize_prefix(key)
+        if not key:
+            return
+        ids = tuple(ids)
+        # 短い見出し語ほど少しだけ上に（「かに座」を「かみのけ座」より先に）
+        weight -= 0.001 * len(key)
+        slot = self._entries.setdefault(key, {})
+        if ids not in slot or slot[ids][0] < weight:
+            slot[ids] = (weight, label)
+
+    def build(self):
+        # 候補（ids とラベルの組）に重い順の番号を振る
+        best = {}
+        for slot in self._entries.values():
+            for ids, (weight, label) in slot.items():
+                if best.get((ids, label), -1.0) < weight:
+                    best[(ids, label)] = weight
+        order = sorted(best, key=lambda c: (-best[c], c[1]))
+        number = {c: i for i, c in enumerate(order)}
+        self.labels = [label for _, label in order]
+        self.ids = [ids for ids, _ in order]
+        self.scores = [round(best[c], 3) for c in order]
+
+        # dict のトライを作ってから配列に詰める（候補番号が小さいほど重い）
+        root = {}
+        for key, slot in self._entries.items():
+            node = root
+            for ch in key:
+                node = node.setdefault(ch, {})
+            node.setdefault("", set()).update(number[(ids, label)] for ids, (_, label) in slot.items())
+
+        self.child_chars, self.top, self.exact = [], [], []
+        self.child_start = array("I")
+        self._pack(root)
+        self._entries = {}
+
+    def _pack(self, root: dict):
+        """幅優先でノードに番号を振る（子は親より後ろなので、上位リストは後ろから計算できる）"""
+        nodes = [root]
+        i = 0
+        while i < len(nodes):
+            node = nodes[i]
+            chars = "".join(sorted(ch for ch in node if ch))
+            self.child_chars.append(chars)
+            self.child_start.append(len(nodes))
+            nodes.extend(node[ch] for ch in chars)
+            i += 1
+
+        tops = [None] * len(nodes)
+        for n in range(len(nodes) - 1, -1, -1):
+            own = nodes[n].get("", set())
+            merged = set(own)
+            start = self.child_start[n]
+            for k in range(len(self.child_chars[n])):
+                merged.update(tops[start + k])
+            tops[n] = self._dedupe(sorted(merged))
+        self.top = tops
+        self.exact = [self._dedupe(sorted(node.get("", ()))) for node in nodes]
+
+    def _dedupe(self, numbers: list) -> tuple:
+        """重い順の候補番号から、ids ごとに最初のものだけを max_results 件まで残す"""
+        seen, out = set(), []
+        for c in numbers:
+            if self.ids[c] not in seen:
+                seen.add(self.ids[c])
+                out.append(c)
+                if len(out) >= self.max_results:
+                    break
+        return tuple(out)
+
+    def _node(self, key: str):
+        n = 0
+        for ch in key:
+            k = self.child_chars[n].find(ch)
+            if k < 0:
+                return None
+            n = self.child_start[n] + k
+        return n
+
+    def suggest(self, prefix: str, limit: int | None = None) -> list:
+        """prefix で始まる見出し語の候補を重い順に返す（完全一致した候補を先頭に）"""
+        limit = limit or self.max_results
+        key = normalize_prefix(prefix)
+        if not key:
+            return []
+        n = self._node(key)
+        if n is None:
+            return []
+        picked = list(self.exact[n][:limit])
+        seen = {self.ids[c] for c in picked}
+        for c in self.top[n]:
+            if len(picked) >= limit:
+                break
+            if self.ids[c] not in seen:
+                seen.add(self.ids[c])
+                picked.append(c)
+        return [{"label": self.labels[c], "ids": list(self.ids[c]), "score": self.scores[c]} for c in picked]
+
+    def __len__(self):
+        return len(self.labels)
+
+    def node_count(self) -> int:
+        return len(self.child_chars)
+
+
+def build_typeahead(data_path: str | Path = CONSTELLATION_DATA_PATH,
+                    inverted_index_path: str | Path = INVERTED_INDEX_PATH) -> Typeahead:
+    """星座データと inverted_index.json から候補を作る"""
+    with Path(data_path).open("r", encoding="utf-8") as f:
+        constellations = json.load(f)
+    names = {c["id"]: c.get("jp_name", c["id"]) for c in constellations}
+
+    ta = Typeahead()
+    for c in constellations:
+        cid, jp_name = c["id"], names[c["id"]]
+        label = f"{jp_name}（{cid}）"
+        ta.add(jp_name, label, [cid], KIND_WEIGHTS["name"])
+        if jp_name.endswith("座"):
+            ta.add(jp_name[:-1], label, [cid], KIND_WEIGHTS["name"])
+        # normalize_prefix でひらがなにしたものが読みになる（和名はかな書きなので）
+        ta.add(jp_name.translate(_KATA_TO_HIRA), label, [cid], KIND_WEIGHTS["reading"])
+        ta.add(cid, label, [cid], KIND_WEIGHTS["id"])
+        ta.add(cid.replace(" ", ""), label, [cid], KIND_WEIGHTS["id"])
+
+    # keywords と inverted_index.json の見出し語: 語 -> 当たる星座
+    keyword_ids = {}
+    for c in constellations:
+        for kw in c.get("keywords", []):
+            keyword_ids.setdefault(kw, set()).add(c["id"])
+    path = Path(inverted_index_path)
+    if path.exists():
+        with path.open("r", encoding="utf-8") as f:
+            for term, ids in json.load(f).items():
+                keyword_ids.setdefault(term, set()).update(i for i in ids if i in names)
+
+    for kw, ids in keyword_ids.items():
+        # 数字だけの見出し語（月の番号）は候補にしない
+        if not ids or kw.isdigit():
+            continue
+        ids = sorted(ids)
+        if len(ids) == 1:
+            label = f"{kw} → {names[ids[0]]}"
+        else:
+            label = f"{kw}（{len(ids)}星座）"
+        ta.add(kw, label, ids, KIND_WEIGHTS["keyword"] / len(ids) ** 0.5)
+
+    ta.build()
+    return ta
+
+
+_typeahead = None
+
+
+def get_typeahead() -> Typeahead:
+    """共有の候補トライ（初回に作る）"""
+    global _typeahead
+    if _typeahead is None:
+        _typeahead = build_typeahead()
+    return _typeahead
+
+
+def benchmark(ta: Typeahead, n_queries: int = 20000, seed: int = 0):
+    """見出し語の先頭 1〜4 文字をランダムに引いて、1 回あたりの時間を測る"""
+    rng = random.Random(seed)
+    keys = [normalize_prefix(label.split("（")[0].split(" → ")[0]) for label in ta.labels]
+    prefixes = [k[:rng.randint(1, min(4, len(k)))] for k in rng.choices([k for k in keys if k], k=n_queries)]
+    start = time.perf_counter()
+    for p in prefixes:
+        ta.suggest(p)
+    us = (time.perf_counter() - start) * 1e6 / n_queries
+    print(f"候補 {len(ta)} 件 / ノード {ta.node_count()} 個: suggest {us:.1f} µs/回")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="入力中の候補（前方一致）")
+    parser.add_argument("--prefix", type=str, nargs="*", default=["おり", "カシ", "and", "冬", "英"])
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    typeahead = get_typeahead()
+    print(f"build: {(time.perf_counter() - start) * 1000:.1f} ms")
+    for prefix in args.prefix:
+        print(f"{prefix}: {[s['label'] for s in typeahead.suggest(prefix)]}")
+    benchmark(typeahead)
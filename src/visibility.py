@@ -0,0 +1,247 @@
+"""
+SkyLore - 星座の可視判定モジュール
+観測地（緯度・経度）と日時から、88星座の代表点（中心の赤経・赤緯）の
+高度・方位を NumPy で一括計算し、「今夜見える星座」と南中時刻を求める
+
+「夜」や「18時」は観測地の経度から求めた地方平均太陽時（UTC + 経度/15 時間）で数える。
+タイムゾーンなしの datetime は観測地の地方平均太陽時とみなす。
+"""
+import argparse
+import json
+import time
+from datetime import date, datetime, timedelta, timezone, tzinfo
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+
+from config import (
+    CONSTELLATION_COORDS_PATH,
+    VISIBILITY_HORIZON_DEG,
+    VISIBILITY_GRID_DEG,
+    VISIBILITY_TIME_BUCKET_MIN,
+)
+
+_UNIX_EPOCH_JD = 2440587.5
+_J2000_JD = 2451545.0
+# 恒星日に対する平均太陽日の比（恒星時は太陽時よりこの割合だけ速く進む）
+_SIDEREAL_RATE = 1.00273790935
+
+
+def observer_timezone(lon_deg: float) -> timezone:
+    """経度から求めた地方平均太陽時（UTC + 経度/15 時間、分単位に丸める）のタイムゾーン"""
+    return timezone(timedelta(minutes=round(lon_deg * 4)))
+
+
+def observer_local(lon_deg: float, when: datetime = None) -> datetime:
+    """when（None なら今）を観測地の地方平均太陽時にする。タイムゾーンなしは観測地の時刻とみなす"""
+    tz = observer_timezone(lon_deg)
+    if when is None:
+        return datetime.now(timezone.utc).astimezone(tz)
+    if when.tzinfo is None:
+        return when.replace(tzinfo=tz)
+    return when.astimezone(tz)
+
+
+def observer_night(lon_deg: float, when: datetime = None) -> date:
+    """when を含む夜の日付（観測地の 0〜11 時は前日の夜として扱う）"""
+    return (observer_local(lon_deg, when) - timedelta(hours=12)).date()
+
+
+def to_julian_dates(times, tz: tzinfo = timezone.utc) -> np.ndarray:
+    """datetime（タイムゾーン付き、なしなら tz とみなす）の列をユリウス日にする"""
+    stamps = []
+    for t in times:
+        if t.tzinfo is None:
+            t = t.replace(tzinfo=tz)
+        stamps.append(t.timestamp())
+    return np.asarray(stamps, dtype=np.float64) / 86400.0 + _UNIX_EPOCH_JD
+
+
+def local_sidereal_time(jd: np.ndarray, lon_deg: float) -> np.ndarray:
+    """地方恒星時（ラジアン）。GMST の簡易式（精度は数秒角で十分）"""
+    gmst_deg = 280.46061837 + 360.98564736629 * (jd - _J2000_JD)
+    return np.radians(np.mod(gmst_deg + lon_deg, 360.0))
+
+
+def altaz(ra: np.ndarray, dec: np.ndarray, lat_deg: float, lon_deg: float, jd: np.ndarray):
+    """
+    赤経・赤緯（ラジアン、形状 (N,)）と時刻（ユリウス日、形状 (T,)）から
+    高度・方位（度、形状 (T, N)）をまとめて計算する。方位は北から東回り。
+    """
+    lat = np.radians(lat_deg)
+    ha = local_sidereal_time(jd, lon_deg)[:, None] - ra[None, :]
+    sin_dec, cos_dec = np.sin(dec)[None, :], np.cos(dec)[None, :]
+    sin_lat, cos_lat = np.sin(lat), np.cos(lat)
+
+    sin_alt = sin_dec * sin_lat + cos_dec * cos_lat * np.cos(ha)
+    alt = np.arcsin(np.clip(sin_alt, -1.0, 1.0))
+    az = np.arctan2(-np.sin(ha) * cos_dec, sin_dec * cos_lat - cos_dec * sin_lat * np.cos(ha))
+    return np.degrees(alt), np.mod(np.degrees(az), 360.0)
+
+
+def night_times(night: date, start_hour: int = 18, end_hour: int = 30, step_min: int = 30,
+                tz: tzinfo = timezone.utc) -> list:
+    """night の夕方 start_hour 時から翌朝（end_hour - 24 時）までの時刻グリッド（tz の時刻）"""
+    base = datetime(night.year, night.month, night.day, tzinfo=tz)
+    n = (end_hour - start_hour) * 60 // step_min + 1
+    return [base + timedelta(hours=start_hour, minutes=i * step_min) for i in range(n)]
+
+
+class VisibilityEngine:
+    """88星座の代表点をまとめて持ち、可視判定を行うクラス"""
+
+    def __init__(self, coords_path: str | Path = CONSTELLATION_COORDS_PATH):
+        with Path(coords_path).open("r", encoding="utf-8") as f:
+            coords = json.load(f)
+        self.ids = [c["id"] for c in coords]
+        self.ra = np.radians(np.asarray([c["ra_hours"] for c in coords]) * 15.0)
+        self.dec = np.radians(np.asarray([c["dec_deg"] for c in coords]))
+
+    def altaz_at(self, lat: float, lon: float, times: list):
+        """時刻のリストに対する (高度, 方位) の配列（形状 (T, 88)）。タイムゾーンなしは観測地の時刻"""
+        return altaz(self.ra, self.dec, lat, lon, to_julian_dates(times, observer_timezone(lon)))
+
+    def visible_now(self, lat: float, lon: float, when: datetime,
+                    horizon_deg: float = VISIBILITY_HORIZON_DEG) -> dict:
+        """
+        ある時刻の各星座の高度・方位
+
+        Returns:
+            {id: {"altitude": 度, "azimuth": 度, "visible": bool}}
+        """
+        alt, az = self.altaz_at(lat, lon, [when])
+        return {
+            cid: {"altitude": float(alt[0, i]), "azimuth": float(az[0, i]),
+                  "visible": bool(alt[0, i] >= horizon_deg)}
+            for i, cid in enumerate(self.ids)
+        }
+
+    def night_summary(self, lat: float, lon: float, night: date,
+                      horizon_deg: float = VISIBILITY_HORIZON_DEG, step_min: int = 30) -> dict:
+        """
+        一晩（観測地の地方平均太陽時で 18時〜翌6時）の時刻グリッドで一括計算し、星座ごとにまとめる
+
+        Returns:
+            {id: {"visible": bool, "max_altitude": 度（夜のうちの最大）, "culmination": datetime | None,
+                  "visible_fraction": 0-1}}
+            culmination は南中（地方恒星時 = 赤経）の時刻。昼に南中する星座は None
+        """
+        times = night_times(night, step_min=step_min, tz=observer_timezone(lon))
+        alt, _ = self.altaz_at(lat, lon, times)
+        above = alt >= horizon_deg
+        best = np.argmax(alt, axis=0)
+        fraction = above.mean(axis=0)
+        transits = self.transit_times(lon, times[0], times[-1])
+
+        return {
+            cid: {
+                "visible": bool(above[:, i].any()),
+                "max_altitude": float(alt[best[i], i]),
+                "culmination": transits[i],
+                "visible_fraction": float(fraction[i]),
+            }
+            for i, cid in enumerate(self.ids)
+        }
+
+    def transit_times(self, lon: float, start: datetime, end: datetime) -> list:
+        """
+        start〜end の間に各星座が南中する（地方恒星時が赤経に等しくなる）時刻のリスト。
+        その間に南中しなければ None（南中は 1 恒星日に 1 回なので、12 時間の夜に 2 回は来ない）
+        """
+        lst0 = local_sidereal_time(to_julian_dates([start]), lon)[0]
+        # start から南中までの恒星時（ラジアン）を太陽時の日数にする
+        days = np.mod(self.ra - lst0, 2 * np.pi) / (2 * np.pi) / _SIDEREAL_RATE
+        span = (end - start).total_seconds() / 86400.0
+        return [start + timedelta(days=float(d)) if d <= span else None for d in days]
+
+
+# ================================================================
+# 共有エンジン + (観測地のグリッドセル, 時刻バケット) ごとのキャッシュ
+# ================================================================
+
+_engine = None
+
+
+def get_visibility_engine() -> VisibilityEngine:
+    global _engine
+    if _engine is None:
+        _engine = VisibilityEngine()
+    return _engine
+
+
+def _cell(lat: float, lon: float) -> tuple:
+    """緯度経度を VISIBILITY_GRID_DEG 度のグリッドセルに丸める"""
+    return (round(lat / VISIBILITY_GRID_DEG) * VISIBILITY_GRID_DEG,
+            round(lon / VISIBILITY_GRID_DEG) * VISIBILITY_GRID_DEG)
+
+
+@lru_cache(maxsize=1024)
+def _cached_night_summary(cell: tuple, night: date, horizon_deg: float) -> dict:
+    return get_visibility_engine().night_summary(cell[0], cell[1], night, horizon_deg)
+
+
+@lru_cache(maxsize=4096)
+def _cached_visible_at(cell: tuple, bucket: int, horizon_deg: float) -> dict:
+    when = datetime.fromtimestamp(bucket * 60, tz=timezone.utc)
+    return get_visibility_engine().visible_now(cell[0], cell[1], when, horizon_deg)
+
+
+def visible_tonight(lat: float, lon: float, when: datetime = None,
+                    horizon_deg: float = VISIBILITY_HORIZON_DEG) -> dict:
+    """
+    when を含む夜の night_summary を (グリッドセル, 夜の日付) ごとにキャッシュして返す。
+    夜の日付は観測地の地方平均太陽時で決める（0〜11時に聞かれたら前日の夜）。
+    """
+    cell = _cell(lat, lon)
+    return _cached_night_summary(cell, observer_night(cell[1], when), horizon_deg)
+
+
+def visible_at(lat: float, lon: float, when: datetime = None,
+               horizon_deg: float = VISIBILITY_HORIZON_DEG) -> dict:
+    """ある時刻の visible_now を (グリッドセル, VISIBILITY_TIME_BUCKET_MIN 分) ごとにキャッシュして返す"""
+    minutes = int(observer_local(lon, when).timestamp() // 60)
+    bucket = minutes - minutes % VISIBILITY_TIME_BUCKET_MIN
+    return _cached_visible_at(_cell(lat, lon), bucket, horizon_deg)
+
+
+# ================================================================
+# ベンチマーク
+# ================================================================
+
+def benchmark(n_locations: int = 1000, step_min: int = 10):
+    engine = VisibilityEngine()
+    rng = np.random.default_rng(0)
+    lats = rng.uniform(-60, 70, n_locations)
+    lons = rng.uniform(-180, 180, n_locations)
+    times = night_times(date(2025, 1, 15), step_min=step_min)
+    jd = to_julian_dates(times)
+
+    start = time.perf_counter()
+    for lat, lon in zip(lats, lons):
+        alt, _ = altaz(engine.ra, engine.dec, lat, lon, jd)
+        (alt >= VISIBILITY_HORIZON_DEG).any(axis=0)
+    sec = time.perf_counter() - start
+    n_points = n_locations * len(times) * len(engine.ids)
+    print(f"locations={n_locations} times={len(times)} constellations={len(engine.ids)}")
+    print(f"  {sec * 1000 / n_locations:.3f} ms/location, {n_points / sec / 1e6:.1f} M alt/az per sec")
+
+    start = time.perf_counter()
+    for _ in range(1000):
+        visible_tonight(35.68, 139.77, datetime(2025, 1, 15, 21, 0))
+    print(f"  cached visible_tonight: {(time.perf_counter() - start) * 1000:.3f} us/call")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="可視判定のベンチマーク")
+    parser.add_argument("--locations", type=int, default=1000)
+    parser.add_argument("--step_min", type=int, default=10)
+    args = parser.parse_args()
+
+    tonight = visible_tonight(35.68, 139.77, datetime(2025, 1, 15, 21, 0))
+    print("東京 2025-01-15 の夜に見える星座（最大高度順）:")
+    for cid, v in sorted(tonight.items(), key=lambda x: -x[1]["max_altitude"])[:10]:
+        transit = f"{v['culmination']:%H:%M}" if v["culmination"] else "夜のうちには南中しない"
+        print(f"- {cid}: 最大高度 {v['max_altitude']:.1f}° 南中 {transit}")
+    print()
+    benchmark(args.locations, args.step_min)
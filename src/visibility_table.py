@@ -0,0 +1,124 @@
+"""
+SkyLore - 可視判定テーブル（前計算済み）の検索モジュール
+visibility_table_build.py で作った (緯度帯 × 通日 × 時) のビット表を
+mmap で開き、「この場所・この時刻に見えるか」を O(1) のビット判定で返す
+
+表は地方平均太陽時で持つので、観測地の夜（18時〜翌6時など）の割合は経度によらず
+(緯度帯, 日付) だけで決まる。タイムゾーンなしの datetime は観測地の地方平均太陽時とみなす。
+"""
+import json
+import time
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
+
+import numpy as np
+
+from config import VISIBILITY_TABLE_DIR
+
+
+class VisibilityTable:
+    """mmap した可視ビット表"""
+
+    def __init__(self, table_dir: str | Path = VISIBILITY_TABLE_DIR):
+        table_dir = Path(table_dir)
+        with (table_dir / "visibility_meta.json").open("r", encoding="utf-8") as f:
+            meta = json.load(f)
+        self.ids = meta["ids"]
+        self.index = {cid: i for i, cid in enumerate(self.ids)}
+        self.lat_min = meta["lat_min"]
+        self.lat_step = meta["lat_step"]
+        self.n_lats = meta["n_lats"]
+        self.horizon_deg = meta["horizon_deg"]
+        self.bits = np.load(table_dir / "visibility_bits.npy", mmap_mode="r")
+        # (緯度帯, 年, 月, 開始時, 終了時) -> その月の宵の割合（month_fraction 用）
+        self._month_cache = {}
+
+    def _lat_idx(self, lat: float) -> int:
+        return min(max(round((lat - self.lat_min) / self.lat_step), 0), self.n_lats - 1)
+
+    def _cell(self, lat: float, lon: float, when: datetime):
+        """(緯度帯, 通日, 地方平均太陽時の時) のインデックスを求める"""
+        if when.tzinfo is None:
+            solar = when
+        else:
+            solar = when.astimezone(timezone.utc).replace(tzinfo=None) + timedelta(hours=lon / 15.0)
+        return self._lat_idx(lat), solar.timetuple().tm_yday - 1, solar.hour
+
+    def is_visible(self, constellation_id: str, lat: float, lon: float, when: datetime) -> bool:
+        """1 星座のビットを調べる"""
+        i = self.index[constellation_id]
+        row = self.bits[self._cell(lat, lon, when)]
+        return bool((row[i >> 3] >> (7 - (i & 7))) & 1)
+
+    def visible_mask(self, lat: float, lon: float, when: datetime) -> np.ndarray:
+        """その時刻の全星座分の bool 配列（self.ids の順）"""
+        row = self.bits[self._cell(lat, lon, when)]
+        return np.unpackbits(row)[:len(self.ids)].astype(bool)
+
+    def visible_ids(self, lat: float, lon: float, when: datetime) -> set:
+        mask = self.visible_mask(lat, lon, when)
+        return {cid for cid, v in zip(self.ids, mask) if v}
+
+    def _night_fraction(self, lat_idx: int, night: date, start_hour: int, end_hour: int) -> np.ndarray:
+        """緯度帯 lat_idx の night の start_hour 時〜翌 (end_hour - 24) 時（地方平均太陽時）の割合"""
+        rows = []
+        for h in range(start_hour, end_hour + 1):
+            day = night + timedelta(days=h // 24)
+            rows.append(self.bits[lat_idx, day.timetuple().tm_yday - 1, h % 24])
+        masks = np.unpackbits(np.asarray(rows), axis=-1)[:, :len(self.ids)]
+        return masks.mean(axis=0)
+
+    def night_fraction(self, lat: float, lon: float, night: date,
+                       start_hour: int = 18, end_hour: int = 30) -> dict:
+        """
+        観測地の night の start_hour 時〜翌 (end_hour - 24) 時のうち、見えている時間の割合。
+        時刻は観測地の地方平均太陽時なので、結果は経度によらない（lon は呼び出しの形を揃えるため）。
+        """
+        fraction = self._night_fraction(self._lat_idx(lat), night, start_hour, end_hour)
+        return dict(zip(self.ids, fraction.tolist()))
+
+    def month_fraction(self, lat: float, lon: float, months: list,
+                       start_hour: int = 19, end_hour: int = 24) -> dict:
+        """
+        指定した月（各月15日）の宵（start_hour〜end_hour 時）に見えている割合。
+        best_months の代わりに、月から「その頃見える星座」を判定するのに使う。
+        月ごとの割合は (緯度帯, 年, 月, 時間帯) ごとに覚えておく。
+        """
+        lat_idx = self._lat_idx(lat)
+        year = datetime.now(timezone.utc).year
+        fractions = []
+        for m in months:
+            if not 1 <= m <= 12:
+                continue
+            key = (lat_idx, year, m, start_hour, end_hour)
+            fraction = self._month_cache.get(key)
+            if fraction is None:
+                fraction = self._night_fraction(lat_idx, date(year, m, 15), start_hour, end_hour)
+                self._month_cache[key] = fraction
+            fractions.append(fraction)
+        if not fractions:
+            return {}
+        return dict(zip(self.ids, np.mean(fractions, axis=0).tolist()))
+
+
+_table = None
+
+
+def get_visibility_table() -> VisibilityTable | None:
+    """共有テーブルを返す（まだ作られていなければ None）"""
+    global _table
+    if _table is None and (VISIBILITY_TABLE_DIR / "visibility_bits.npy").exists():
+        _table = VisibilityTable()
+    return _table
+
+
+if __name__ == "__main__":
+    table = VisibilityTable()
+    when = datetime(2025, 1, 15, 21, 0)
+    print("東京 2025-01-15 21:00 に見える星座:", sorted(table.visible_ids(35.68, 139.77, when)))
+
+    n = 100000
+    start = time.perf_counter()
+    for _ in range(n):
+        table.is_visible("Orion", 35.68, 139.77, when)
+    print(f"is_visible: {(time.perf_counter() - start) / n * 1e6:.2f} us/call")
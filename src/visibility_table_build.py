@@ -0,0 +1,66 @@
+# visibility_table_build.py
+# 88星座の「見える / 見えない」を
+#   (緯度帯 × 通日 × 地方平均太陽時の時) のグリッドで前計算し、
+# 星座ごとの 1 bit に詰めた表（NumPy .npy）として保存するスクリプト
+#
+# 地方平均太陽時で持つので経度には依存しない（経度は検索時に時刻の補正だけで済む）。
+# 保存した表は visibility_table.VisibilityTable が mmap で開いて O(1) で引く。
+
+import json
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+from config import (
+    VISIBILITY_TABLE_DIR,
+    VISIBILITY_HORIZON_DEG,
+    VISIBILITY_TABLE_LAT_STEP,
+)
+from .visibility import VisibilityEngine, altaz, to_julian_dates
+
+# 通日は閏年も含めて 366 日分。基準年は 2024（閏年）を使う
+_REFERENCE_YEAR = 2024
+_N_DAYS = 366
+_N_HOURS = 24
+
+
+def build_visibility_table(horizon_deg: float = VISIBILITY_HORIZON_DEG,
+                           lat_step: float = VISIBILITY_TABLE_LAT_STEP):
+    """
+    bits[lat_idx, day, hour, :] に 88 星座分のビット（np.packbits、上位ビットから）を詰めて保存する。
+    hour は地方平均太陽時（経度 0 度の UT と同じ）の各時 30 分。
+    """
+    engine = VisibilityEngine()
+    lats = np.arange(-90.0, 90.0 + lat_step / 2, lat_step)
+
+    start = datetime(_REFERENCE_YEAR, 1, 1, 0, 30, tzinfo=timezone.utc)
+    times = [start + timedelta(days=d, hours=h) for d in range(_N_DAYS) for h in range(_N_HOURS)]
+    jd = to_julian_dates(times)
+
+    n_bytes = (len(engine.ids) + 7) // 8
+    bits = np.zeros((len(lats), _N_DAYS, _N_HOURS, n_bytes), dtype=np.uint8)
+    for i, lat in enumerate(lats):
+        alt, _ = altaz(engine.ra, engine.dec, float(lat), 0.0, jd)
+        visible = (alt >= horizon_deg).reshape(_N_DAYS, _N_HOURS, len(engine.ids))
+        bits[i] = np.packbits(visible, axis=-1)
+
+    VISIBILITY_TABLE_DIR.mkdir(exist_ok=True, parents=True)
+    np.save(VISIBILITY_TABLE_DIR / "visibility_bits.npy", bits)
+    meta = {
+        "ids": engine.ids,
+        "lat_min": float(lats[0]),
+        "lat_step": lat_step,
+        "n_lats": len(lats),
+        "n_days": _N_DAYS,
+        "n_hours": _N_HOURS,
+        "horizon_deg": horizon_deg,
+    }
+    with open(VISIBILITY_TABLE_DIR / "visibility_meta.json", "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+
+    print(f"✅ Built visibility table {bits.shape} ({bits.nbytes / 1024:.0f} KiB)")
+    print(f"📦 Saved to {VISIBILITY_TABLE_DIR.resolve()}")
+
+
+if __name__ == "__main__":
+    build_visibility_table()
@@ -0,0 +1,251 @@
+"""
+SkyLore - 起動時のキャッシュ温めモジュール
+デプロイ直後のプロセスはキャッシュが空で、最初にクイック検索や人気のクエリを
+投げた人がクエリ拡張・ベクトル検索・ストーリー生成の待ち時間をまるごと払うことになる。
+ここではクイック検索のプリセットとクエリログの上位のクエリを先に流して、
+クエリ拡張・検索結果・ストーリー（と、渡されれば関連星座つきのカード）のキャッシュを埋めておく。
+
+    python -m src.warmup --top-n 20 --budget 60
+
+同時実行数と時間の上限つきで動き、進み具合は get_warmup_status() で見られる。
+"""
+import argparse
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait
+from pathlib import Path
+
+from config import (
+    CONSTELLATION_DATA_PATH,
+    INDEX_DIR,
+    DEFAULT_LLM,
+    DEFAULT_TOP_K,
+    QUERY_LOG_PATH,
+    QUICK_SEARCH_PRESETS,
+    STORY_PREFETCH_TOP_N,
+    WARMUP_TOP_N,
+    WARMUP_QUERIES_PATH,
+    WARMUP_CONCURRENCY,
+    WARMUP_BUDGET_SEC,
+)
+from .query_log import read_query_log, normalize_query
+from .llm_scheduler import use_priority
+
+
+def warmup_queries(top_n: int = WARMUP_TOP_N, log_path: str | Path = QUERY_LOG_PATH,
+                   queries_path: str | Path | None = WARMUP_QUERIES_PATH) -> list:
+    """
+    温めるクエリの一覧（クイック検索のプリセット、クエリログで多い順に top_n 件、
+    queries_path の各行）。正規化して同じになるものは 1 つにまとめる。
+    """
+    candidates = list(QUICK_SEARCH_PRESETS.values())
+
+    if top_n > 0:
+        counts, surface = Counter(), {}
+        for record in read_query_log(log_path):
+            query = record.get("query")
+            if not query or record.get("error"):
+                continue
+            key = record.get("normalized_query") or normalize_query(query)
+            counts[key] += 1
+            surface.setdefault(key, query)
+        candidates += [surface[key] for key, _ in counts.most_common(top_n)]
+
+    if queries_path and Path(queries_path).exists():
+        with Path(queries_path).open("r", encoding="utf-8") as f:
+            candidates += [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+    queries, seen = [], set()
+    for query in candidates:
+        key = normalize_query(query)
+        if key and key not in seen:
+            seen.add(key)
+            queries.append(query)
+    return queries
+
+
+# ================================================================
+# 進み具合（プロセス内で 1 つ）
+# ================================================================
+
+_status_lock = threading.Lock()
+_status = {"state": "cold"}
+
+
+def _set_status(**fields):
+    with _status_lock:
+        _status.update(fields)
+
+
+def get_warmup_status() -> dict:
+    """
+    温めの進み具合を返す。state は
+    cold（未実行）/ warming（実行中）/ ready（全部終わった）/
+    partial（時間切れや失敗で一部だけ）/ skipped（API キーが無いなどで実行しなかった）
+    """
+    with _status_lock:
+        status = dict(_status)
+    if status["state"] == "warming":
+        status["elapsed_sec"] = time.time() - status["started"]
+    return status
+
+
+def run_warmup(queries: list, searcher, prefetcher=None, warm_card=None,
+               concurrency: int = WARMUP_CONCURRENCY, budget_sec: float = WARMUP_BUDGET_SEC,
+               top_k: int = DEFAULT_TOP_K, story_top_n: int = STORY_PREFETCH_TOP_N) -> dict:
+    """
+    各クエリについて クエリ拡張 -> 検索 -> 上位 story_top_n 件のストーリー生成 を行い、
+    共有キャッシュに結果を残す。warm_card(星座) を渡すと検索結果の全件について呼ぶ
+    （app.py の関連星座つきカードの HTML を作らせる）。
+
+    同時に走るのは concurrency 件まで。budget_sec を過ぎたら未着手のクエリは捨て、
+    実行中のものも次の段階には進まない。
+    """
+    from .query_expander import QueryExpander
+
+    started = time.time()
+    deadline = time.perf_counter() + budget_sec
+    _set_status(state="warming", started=started, finished=None, queries=len(queries),
+                done=0, failed=0, cut=0, stories=0, cards=0, stage_ms={}, errors=[])
+
+    try:
+        expander = QueryExpander(model=DEFAULT_LLM)
+    except ValueError as e:
+        _set_status(state="skipped", finished=time.time(), reason=str(e))
+        return get_warmup_status()
+
+    lock = threading.Lock()
+    claimed = set()   # ストーリー・カードを誰かが温め始めた星座（同じものを二重に作らない）
+    stage_ms = Counter()
+
+    def timed(stage, fn, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with lock:
+                stage_ms[stage] += (time.perf_counter() - start) * 1000
+
+    def claim(kind, cid):
+        with lock:
+            if (kind, cid) in claimed:
+                return False
+            claimed.add((kind, cid))
+            return True
+
+    def warm_one(query) -> bool:
+        # 時間切れで途中で抜けたら False
+        if time.perf_counter() > deadline:
+            return False
+        expanded = timed("expansion", expander.expand, query)
+        if time.perf_counter() > deadline:
+            return False
+        results = timed("search", searcher.search, expanded, top_k=top_k)
+
+        for rank, (constellation, _) in enumerate(results):
+            if time.perf_counter() > deadline:
+                return False
+            cid = constellation["id"]
+            if prefetcher is not None and rank < story_top_n and constellation.get("myth_summary") \
+                    and claim("story", cid):
+                timed("story", prefetcher.get_story, constellation)
+                with _status_lock:
+                    _status["stories"] += 1
+            if warm_card is not None and claim("card", cid):
+                timed("card", warm_card, constellation)
+                with _status_lock:
+                    _status["cards"] += 1
+        return True
+
+    def run_one(query):
+        # wait() が返る前に数え終わるよう、集計もワーカーの中で行う
+        try:
+            # 温めの API 呼び出しは利用者のリクエストより後回しにする
+            with use_priority("prefetch"):
+                completed = warm_one(query)
+        except Exception as e:
+            with _status_lock:
+                _status["failed"] += 1
+                _status["errors"].append(f"{query}: {type(e).__name__}: {e}")
+            return
+        with _status_lock:
+            _status["done" if completed else "cut"] += 1
+
+    pool = ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="warmup")
+    futures = [pool.submit(run_one, query) for query in queries]
+    _, not_done = wait(futures, timeout=max(0.0, deadline - time.perf_counter()))
+    # 時間切れ: 未着手のものは捨てる（実行中のものは今の段階を終えたら抜ける）
+    pool.shutdown(wait=False, cancel_futures=True)
+
+    with _status_lock:
+        timed_out = bool(not_done) or _status["cut"] > 0
+        complete = not timed_out and _status["failed"] == 0
+        _status.update(state="ready" if complete else "partial", finished=time.time(),
+                       elapsed_sec=time.time() - started, timed_out=timed_out,
+                       stage_ms={k: round(v, 1) for k, v in stage_ms.items()})
+    return get_warmup_status()
+
+
+def start_background_warmup(searcher, prefetcher=None, warm_card=None, queries: list | None = None,
+                            **kwargs) -> threading.Thread:
+    """run_warmup をデーモンスレッドで始める（起動をブロックしない）"""
+    if queries is None:
+        queries = warmup_queries()
+    _set_status(state="warming", started=time.time(), queries=len(queries), done=0, failed=0)
+    thread = threading.Thread(target=run_warmup, args=(queries, searcher, prefetcher, warm_card),
+                              kwargs=kwargs, name="warmup", daemon=True)
+    thread.start()
+    return thread
+
+
+def format_status(status: dict) -> str:
+    """サイドバーや CLI 向けの 1 行表示"""
+    state = status["state"]
+    if state == "cold":
+        return "キャッシュ: 未準備"
+    if state == "skipped":
+        return f"キャッシュ: 温めをスキップ（{status.get('reason', '')}）"
+    progress = f"{status.get('done', 0)}/{status.get('queries', 0)} クエリ"
+    elapsed = f"{status.get('elapsed_sec', 0.0):.1f} 秒"
+    label = {"warming": "準備中", "ready": "準備完了", "partial": "一部のみ準備"}[state]
+    return f"キャッシュ: {label}（{progress}、{elapsed}）"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="人気のクエリでキャッシュを温め、温める前後の応答時間を比べる")
+    parser.add_argument("--top-n", type=int, default=WARMUP_TOP_N, help="クエリログから使う件数")
+    parser.add_argument("--queries-file", type=str, default=WARMUP_QUERIES_PATH)
+    parser.add_argument("--log", type=str, default=str(QUERY_LOG_PATH))
+    parser.add_argument("--concurrency", type=int, default=WARMUP_CONCURRENCY)
+    parser.add_argument("--budget", type=float, default=WARMUP_BUDGET_SEC, help="秒")
+    parser.add_argument("--no-stories", action="store_true", help="ストーリーは生成しない")
+    args = parser.parse_args()
+
+    from .query_expander import QueryExpander, get_expansion_cache
+    from .searcher import ConstellationSearcher, get_search_cache
+    from .story_prefetch import StoryPrefetcher
+
+    queries = warmup_queries(args.top_n, args.log, args.queries_file)
+    print(f"warmup queries ({len(queries)}): {queries}")
+    searcher = ConstellationSearcher(CONSTELLATION_DATA_PATH, INDEX_DIR)
+    prefetcher = None if args.no_stories else StoryPrefetcher(model=DEFAULT_LLM)
+
+    status = run_warmup(queries, searcher, prefetcher, concurrency=args.concurrency,
+                        budget_sec=args.budget)
+    print(format_status(status))
+    print(f"  stage_ms={status.get('stage_ms')} stories={status.get('stories', 0)}")
+    for error in status.get("errors", [])[:10]:
+        print(f"  error: {error}")
+    print(f"  expansion cache={get_expansion_cache().stats()}")
+    print(f"  search cache={get_search_cache().stats()}")
+
+    # 温めたあとの応答時間（クエリ拡張 + 検索）
+    if status["state"] in ("ready", "partial"):
+        expander = QueryExpander(model=DEFAULT_LLM)
+        start = time.perf_counter()
+        for query in queries:
+            searcher.search(expander.expand(query), top_k=DEFAULT_TOP_K)
+        warm_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        cold_ms = sum(status.get("stage_ms", {}).get(s, 0.0) for s in ("expansion", "search")) / len(queries)
+        print(f"  per query: cold {cold_ms:.1f} ms -> warm {warm_ms:.2f} ms")
@@ -0,0 +1,132 @@
+"""
+ストーリーの開閉でカード本体（関連星座の検索・整形）が作り直されないことを確かめるテスト
+
+Streamlit の AppTest で app.py を動かし、キャッシュ付き関数の本体が実行された回数を数える。
+OpenAI には繋がらないアドレスを渡しておく（ストーリー生成は失敗して元の神話が表示される）。
+"""
+import json
+import sys
+import threading
+from collections import Counter
+from functools import partial
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("streamlit.testing.v1")
+from streamlit.testing.v1 import AppTest
+from streamlit.testing.v1 import local_script_runner
+
+ROOT = Path(__file__).resolve().parent.parent
+APP_PATH = ROOT / "app.py"
+COUNTED = ("get_related_constellations", "format_myth_for_related", "build_card_html")
+# スクリプト全体の再実行で必ず走る関数（キャッシュされないので、開閉がフラグメントだけの再実行かを見分けられる）
+SCRIPT = ("main", "init_session_state")
+
+
+@pytest.fixture
+def app_env(monkeypatch):
+    monkeypatch.setenv("SKYLORE_QUERY_LOG", "0")
+    monkeypatch.setenv("SKYLORE_WARMUP", "0")
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    monkeypatch.setenv("OPENAI_BASE_URL", "http://127.0.0.1:9/v1")
+    monkeypatch.syspath_prepend(str(ROOT))
+    monkeypatch.chdir(ROOT)
+
+
+class CallCounter:
+    """app.py で定義された関数の本体が実行された回数を数える（キャッシュに当たった呼び出しは数えない）"""
+
+    def __init__(self, names=COUNTED + SCRIPT + ("render_constellation_card",)):
+        self.names = set(names)
+        self.counts = Counter()
+
+    def _profile(self, frame, event, arg):
+        code = frame.f_code
+        if event == "call" and code.co_name in self.names and code.co_filename == str(APP_PATH):
+            self.counts[code.co_name] += 1
+
+    def __enter__(self):
+        self.counts.clear()
+        sys.setprofile(self._profile)
+        threading.setprofile(self._profile)
+        return self
+
+    def __exit__(self, *exc):
+        sys.setprofile(None)
+        threading.setprofile(None)
+
+
+class FragmentClicks:
+    """
+    ボタンをブラウザと同じように押す。
+
+    AppTest はボタンがフラグメントの中にあってもスクリプト全体を再実行するので、描画された
+    Delta を記録しておき、ボタンの Delta に fragment_id があればそのフラグメントだけの再実行にする
+    （フラグメントの外のボタンなら、ブラウザと同じく全体の再実行のまま）。
+    """
+
+    def __init__(self, monkeypatch):
+        self.monkeypatch = monkeypatch
+        self.msgs = []
+        parse = local_script_runner.parse_tree_from_messages
+
+        def record(msgs):
+            self.msgs = list(msgs)
+            return parse(msgs)
+
+        monkeypatch.setattr(local_script_runner, "parse_tree_from_messages", record)
+
+    def fragment_id(self, key: str) -> str:
+        for msg in self.msgs:
+            if msg.HasField("delta") and key in msg.delta.new_element.button.id:
+                return msg.delta.fragment_id
+        raise KeyError(key)
+
+    def click(self, at: AppTest, key: str):
+        fragment_id = self.fragment_id(key)
+        rerun_data = local_script_runner.RerunData
+        if fragment_id:
+            self.monkeypatch.setattr(local_script_runner, "RerunData",
+                                     partial(rerun_data, fragment_id_queue=[fragment_id],
+                                             is_fragment_scoped_rerun=True))
+        try:
+            at.button(key=key).click().run()
+        finally:
+            self.monkeypatch.setattr(local_script_runner, "RerunData", rerun_data)
+        return fragment_id
+
+
+def _constellations(n=2):
+    with (ROOT / "data" / "constellation_data_with_keywords.json").open(encoding="utf-8") as f:
+        data = json.load(f)
+    return [c for c in data if c.get("myth_summary")][:n]
+
+
+def test_story_toggle_does_not_rebuild_cards(app_env, monkeypatch):
+    clicks = FragmentClicks(monkeypatch)
+    at = AppTest.from_file(str(APP_PATH), default_timeout=120)
+    at.run()
+    # 検索はせず、結果がセッションにある状態からカードを描く
+    at.session_state["search_results"] = [(c, 1.0) for c in _constellations()]
+
+    with CallCounter() as first:
+        at.run()
+    assert not at.exception
+    assert first.counts["build_card_html"] == 2
+    assert first.counts["main"] == 1
+
+    cid = at.session_state["search_results"][0][0]["id"]
+    key = f"story_{cid}_0"
+    for opened in (True, False):
+        with CallCounter() as toggle:
+            assert clicks.click(at, key), "ストーリーボタンがフラグメントの外にある"
+        assert not at.exception
+        assert (cid in at.session_state["expanded_story_ids"]) is opened
+        # 開閉ではカードのフラグメントだけを再実行する（main は走らない）。
+        # キャッシュ済みのカード HTML を使い、関連星座の検索も整形もしない
+        assert toggle.counts["render_constellation_card"] == 1
+        assert {name: toggle.counts[name] for name in SCRIPT} == dict.fromkeys(SCRIPT, 0)
+        assert {name: toggle.counts[name] for name in COUNTED} == dict.fromkeys(COUNTED, 0)
+        # フラグメントだけの再実行では描かれた要素がそのフラグメント分になるので、次の開閉の前に全体を描き直す
+        at.run()